@@ -0,0 +1,95 @@
+import io
+import os
+import posixpath
+import re
+import threading
+import zipfile
+from datetime import datetime
+
+# FB_POSTS_DIR and MST_POSTS_DIR can be the export .zip itself. Files inside it are addressed as
+# <zip file>/<member path>, e.g. facebook.zip/your_facebook_activity/posts/media/x.jpg, and are read in place by
+# random access through the zip directory, nothing is extracted to disk. Plain paths are served by the file system.
+
+_zips = dict()
+_lock = threading.Lock()
+
+
+def split_zip(file_name):
+    # (zip file, member) for a path going through a .zip file, (None, file_name) otherwise
+    index = file_name.lower().find('.zip/')
+    while index >= 0:
+        if os.path.isfile(file_name[:index + 4]):
+            return file_name[:index + 4], posixpath.normpath(file_name[index + 5:].lstrip('/'))
+        index = file_name.lower().find('.zip/', index + 1)
+    return None, file_name
+
+
+def _zip(zip_file):
+    # one handle per process: forked workers must not share the file offset with the parent. Members of a handle can
+    # be read by several threads at once
+    key = (os.getpid(), zip_file)
+    with _lock:
+        if key not in _zips:
+            _zips[key] = zipfile.ZipFile(zip_file)
+        return _zips[key]
+
+
+def archive_root(location, pattern, parent=None):
+    # The directory holding the posts files inside an export .zip, media uris are relative to it: the shallowest one
+    # with a file matching the importer pattern, in a directory named parent if given. A directory is its own root
+    if not zipfile.is_zipfile(location):
+        return location
+    roots = set()
+    for name in _zip(location).namelist():
+        root, file_name = posixpath.split(name)
+        if re.fullmatch(pattern, file_name) and (parent is None or posixpath.basename(root) == parent):
+            roots.add(root)
+    if not roots:
+        raise Exception(f'No {pattern} file found in {location}')
+    return f'{location}/{min(roots, key=lambda root: (root.count("/"), root))}'
+
+
+def list_dir(root):
+    # names of the files directly in the directory
+    zip_file, member = split_zip(root)
+    if zip_file is None:
+        return [name for name in os.listdir(root) if os.path.isfile(os.path.join(root, name))]
+    prefix = '' if member == '.' else f'{member}/'
+    return [name[len(prefix):] for name in _zip(zip_file).namelist()
+            if name.startswith(prefix) and '/' not in name[len(prefix):] and not name.endswith('/')]
+
+
+def file_exists(file_name):
+    zip_file, member = split_zip(file_name)
+    if zip_file is None:
+        return os.path.exists(file_name)
+    try:
+        _zip(zip_file).getinfo(member)
+    except KeyError:
+        return False
+    return True
+
+
+def file_stat(file_name):
+    # (size, mtime in ns), members have the zip entry time
+    zip_file, member = split_zip(file_name)
+    if zip_file is None:
+        stat = os.stat(file_name)
+        return stat.st_size, stat.st_mtime_ns
+    info = _zip(zip_file).getinfo(member)
+    return info.file_size, int(datetime(*info.date_time).timestamp()) * 1000000000
+
+
+def file_size(file_name):
+    return file_stat(file_name)[0]
+
+
+def open_file(file_name, mode='r'):
+    # a member is opened as a seekable binary stream, text mode decodes it as UTF-8
+    zip_file, member = split_zip(file_name)
+    if zip_file is None:
+        return open(file_name, mode)
+    file = _zip(zip_file).open(member)
+    if 'b' in mode:
+        return file
+    return io.TextIOWrapper(file, encoding='utf-8')
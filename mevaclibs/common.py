@@ -1,3 +1,5 @@
+import hashlib
+from mevaclibs.archive import open_file
 from zoneinfo import ZoneInfo
 from datetime import datetime
 
@@ -11,9 +13,21 @@ class Utils:
     def as_timestamp_to_epoch(date_string):
         return Utils.fix_date(datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%SZ"))
 
+    @staticmethod
+    def twitter_timestamp_to_epoch(date_string):
+        # Wed Oct 10 20:19:24 +0000 2018
+        return int(datetime.strptime(date_string, '%a %b %d %H:%M:%S %z %Y').timestamp())
+
     @staticmethod
     def fix_date(datetime_obj):
         # Fixing Zulu
         datetime_obj = datetime_obj.replace(tzinfo=ZoneInfo('UTC'))
         return int(datetime_obj.timestamp())
 
+    @staticmethod
+    def file_digest(file_name):
+        sha = hashlib.sha256()
+        with open_file(file_name, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
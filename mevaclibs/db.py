@@ -0,0 +1,44 @@
+import sqlite3
+
+
+class BatchWriter:
+    # Buffers rows per table and writes them with one executemany per table and one commit per batch.
+    # Rows conflicting with existing keys are ignored and counted as duplicates. Tables are always written in the order
+    # they were first used in, so triggers of a table can read the rows its rows refer to.
+    def __init__(self, conn: sqlite3.Connection, batch_size=1000):
+        self._conn = conn
+        self._batch_size = max(batch_size, 1)
+        self._rows = dict()
+        self._pending = 0
+        self._inserted = dict()
+        self._duplicates = dict()
+        # WAL + NORMAL sync: a commit no longer waits for fsync, the durability point is the checkpoint
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+
+    def insert(self, table, columns, row):
+        self._rows.setdefault((table, columns), list()).append(row)
+        self._pending += 1
+        if self._pending >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        c = self._conn.cursor()
+        for (table, columns), rows in self._rows.items():
+            if not rows:
+                continue
+            c.executemany(f'INSERT OR IGNORE INTO {table} ({", ".join(columns)}) '
+                          f'VALUES ({", ".join("?" * len(columns))})', rows)
+            # rows of this table only, total_changes also counts the writes of the report triggers
+            inserted = c.rowcount
+            self._inserted[table] = self._inserted.get(table, 0) + inserted
+            self._duplicates[table] = self._duplicates.get(table, 0) + len(rows) - inserted
+            rows.clear()
+        self._conn.commit()
+        self._pending = 0
+
+    def inserted(self, table):
+        return self._inserted.get(table, 0)
+
+    def duplicates(self, table):
+        return self._duplicates.get(table, 0)
@@ -1,4 +1,11 @@
 import os
+from mevaclibs.archive import archive_root
+
+# posts files of the exports, they locate the posts directory inside an export .zip
+FB_POST_FILES = r'your_posts.*\.json'
+MST_POST_FILES = r'outbox\.json'
+# big exports are split into tweets.js, tweets-part1.js ... tweets-partN.js, older ones have tweet.js
+TW_POST_FILES = r'tweets?(-part\d+)?\.js'
 
 
 class LoadEnv(object):
@@ -9,10 +16,37 @@ class LoadEnv(object):
         self._stat_fb_media = list()
         self._stat_mst_posts = list()
         self._stat_mst_media = list()
+        self._stat_tw_posts = list()
+        self._stat_tw_media = list()
         self._db_file = os.environ.get('DB_FILE', '/app/db/evacuator.db')
         self._env['fb_posts_dir'] = os.environ.get('FB_POSTS_DIR', '')
         self._env['mst_posts_dir'] = os.environ.get('MST_POSTS_DIR', '')
+        # not asked for, only the twitter commands use it
+        self._tw_posts_dir = os.environ.get('TW_POSTS_DIR', './twposts')
         self._env['filter_out_at'] = os.environ.get('FILTER_OUT_AT', 'True')
+        self._load_workers = int(os.environ.get('LOAD_WORKERS', os.cpu_count() or 1))
+        if self._load_workers < 1:
+            self._load_workers = 1
+        self._load_batch_size = int(os.environ.get('LOAD_BATCH_SIZE', '1000'))
+        self._load_incremental = os.environ.get('LOAD_INCREMENTAL', 'True')
+        self._metrics_file = os.environ.get('METRICS_FILE', '')
+        self._metrics_interval = int(os.environ.get('METRICS_INTERVAL', '10'))
+        if self._metrics_interval < 1:
+            self._metrics_interval = 10
+        self._push_targets = os.environ.get('PUSH_TARGETS', '')
+        self._report_period = os.environ.get('REPORT_PERIOD', 'year').lower()
+        if self._report_period not in ('year', 'month'):
+            raise Exception(f'REPORT_PERIOD must be year or month, got {self._report_period}')
+        # long posts are split on load, the limit must match the one used for push
+        self._text_size_limit = int(os.environ.get('MASTODON_TEXT_SIZE_LIMIT', '500'))
+        if self._text_size_limit < 20:
+            self._text_size_limit = 500
+        self._media_optimize_dir = os.environ.get('MEDIA_OPTIMIZE_DIR',
+                                                  f'{os.path.dirname(os.path.abspath(self._db_file))}/media')
+        self._media_max_pixels = int(os.environ.get('MEDIA_MAX_PIXELS', '8294400'))
+        self._media_quality = int(os.environ.get('MEDIA_JPEG_QUALITY', '85'))
+        if self._load_batch_size < 1:
+            self._load_batch_size = 1000
         if not self._env['fb_posts_dir']:
             if os.path.exists('./posts'):
                 self._env['fb_posts_dir'] = './posts'
@@ -33,6 +67,24 @@ class LoadEnv(object):
     def mst_posts_dir(self):
         return self._env['mst_posts_dir']
 
+    @property
+    def tw_posts_dir(self):
+        return self._tw_posts_dir
+
+    @property
+    def fb_posts_root(self):
+        # directory of your_posts*.json and the media, inside the export if FB_POSTS_DIR is the .zip file
+        return archive_root(self._env['fb_posts_dir'], FB_POST_FILES, 'posts')
+
+    @property
+    def mst_posts_root(self):
+        return archive_root(self._env['mst_posts_dir'], MST_POST_FILES)
+
+    @property
+    def tw_posts_root(self):
+        # the data directory of the export, tweets.js or tweet.js in older ones
+        return archive_root(self._tw_posts_dir, TW_POST_FILES)
+
     @property
     def stat_fb_posts(self):
         return self._stat_fb_posts
@@ -65,6 +117,22 @@ class LoadEnv(object):
     def stat_mst_media(self, value):
         self._stat_mst_media = value
 
+    @property
+    def stat_tw_posts(self):
+        return self._stat_tw_posts
+
+    @stat_tw_posts.setter
+    def stat_tw_posts(self, value):
+        self._stat_tw_posts = value
+
+    @property
+    def stat_tw_media(self):
+        return self._stat_tw_media
+
+    @stat_tw_media.setter
+    def stat_tw_media(self, value):
+        self._stat_tw_media = value
+
     @property
     def db_file(self):
         return self._db_file
@@ -73,24 +141,90 @@ class LoadEnv(object):
     def filter_out_at(self):
         return self._env['filter_out_at'].lower() == 'true'
 
+    @property
+    def load_workers(self):
+        return self._load_workers
+
+    @property
+    def load_batch_size(self):
+        return self._load_batch_size
+
+    @property
+    def load_incremental(self):
+        return self._load_incremental.lower() == 'true'
+
+    @property
+    def text_size_limit(self):
+        return self._text_size_limit
+
+    @property
+    def metrics_file(self):
+        return self._metrics_file
+
+    @property
+    def metrics_interval(self):
+        return self._metrics_interval
+
+    @property
+    def report_period(self):
+        return self._report_period
+
+    @property
+    def push_targets(self):
+        return self._push_targets
+
+    @property
+    def media_optimize_dir(self):
+        return self._media_optimize_dir
+
+    @property
+    def media_max_pixels(self):
+        return self._media_max_pixels
+
+    @property
+    def media_quality(self):
+        return self._media_quality
+
 
 class PushEnv(object):
 
-    def __init__(self):
+    def __init__(self, **overrides):
+        # overrides: MASTODON_* settings of one push target, taken before the environment
+        def setting(name, default):
+            return str(overrides.get(name, os.environ.get(name, default)))
+
         self._env = dict()
-        self._env['client_access_token'] = os.environ.get('MASTODON_CLIENT_ACCESS_TOKEN', '')
-        self._env['domain'] = os.environ.get('MASTODON_DOMAIN', '')
-        self._ratelimit_retries = int(os.environ.get('MASTODON_RATELIMIT_RETRIES', '3'))
-        self._text_size_limit = int(os.environ.get('MASTODON_TEXT_SIZE_LIMIT', '500'))
-        self._visibility = os.environ.get('MASTODON_VISIBILITY', 'private')
-        self._media_timeout = os.environ.get('MASTODON_MEDIA_TIMEOUT', '10')
-        self._media_retries = os.environ.get('MASTODON_MEDIA_RETRIES', '3')
-        self._date_tags = os.environ.get('MASTODON_DATE_TAGS', 'True')
+        self._env['client_access_token'] = setting('MASTODON_CLIENT_ACCESS_TOKEN', '')
+        self._env['domain'] = setting('MASTODON_DOMAIN', '')
+        self._ratelimit_retries = int(setting('MASTODON_RATELIMIT_RETRIES', '3'))
+        self._text_size_limit = int(setting('MASTODON_TEXT_SIZE_LIMIT', '500'))
+        self._visibility = setting('MASTODON_VISIBILITY', 'private')
+        self._media_timeout = setting('MASTODON_MEDIA_TIMEOUT', '10')
+        self._media_retries = setting('MASTODON_MEDIA_RETRIES', '3')
+        self._media_workers = int(setting('MASTODON_MEDIA_WORKERS', '4'))
+        self._media_lookahead = int(setting('MASTODON_MEDIA_LOOKAHEAD', '0'))
+        self._media_size_limit = int(setting('MASTODON_MEDIA_SIZE_LIMIT', '99'))
+        self._async_concurrency = int(setting('MASTODON_ASYNC_CONCURRENCY', '8'))
+        self._http_pool_size = int(setting('MASTODON_HTTP_POOL_SIZE', '10'))
+        self._http_timeout = float(setting('MASTODON_HTTP_TIMEOUT', '60'))
+        self._http_retries = int(setting('MASTODON_HTTP_RETRIES', '3'))
+        self._http_backoff = float(setting('MASTODON_HTTP_BACKOFF', '1'))
+        self._date_tags = setting('MASTODON_DATE_TAGS', 'True')
         if self._text_size_limit < 20:
             self._text_size_limit = 500
-        self._ratelimit_limit = 0
-        self._ratelimit_remaining = 0
-        self._ratelimit_reset = 1000
+        if self._media_workers < 1:
+            self._media_workers = 1
+        if self._media_lookahead < 0:
+            self._media_lookahead = 0
+        if self._media_size_limit < 1:
+            self._media_size_limit = 99
+        if self._async_concurrency < 1:
+            self._async_concurrency = 1
+        # every upload thread and in-flight async call needs its own connection
+        if self._http_pool_size < max(self._media_workers, self._async_concurrency) + 1:
+            self._http_pool_size = max(self._media_workers, self._async_concurrency) + 1
+        if self._http_retries < 0:
+            self._http_retries = 0
         for key, value in self._env.items():
             if not value:
                 self._env[key] = input(f'Type {key.replace("_", " ")}: ').strip()
@@ -105,6 +239,13 @@ class PushEnv(object):
     def domain(self):
         return self._env['domain']
 
+    @property
+    def api_url(self):
+        # MASTODON_DOMAIN is a host name, or a URL with the scheme and port for a local test server
+        if '://' in self._env['domain']:
+            return self._env['domain'].rstrip('/')
+        return f'https://{self._env["domain"]}'
+
     @property
     def media_timeout(self):
         return int(self._media_timeout)
@@ -113,6 +254,19 @@ class PushEnv(object):
     def media_retries(self):
         return int(self._media_retries)
 
+    @property
+    def media_workers(self):
+        return self._media_workers
+
+    @property
+    def media_lookahead(self):
+        return self._media_lookahead
+
+    @property
+    def media_size_limit(self):
+        # MB in the settings, bytes for the client
+        return self._media_size_limit * 1024 * 1024
+
     @property
     def visibility(self):
         if self._visibility == 'public':
@@ -123,30 +277,24 @@ class PushEnv(object):
             return 'private'
 
     @property
-    def ratelimit_limit(self):
-        return self._ratelimit_limit
-
-    @ratelimit_limit.setter
-    def ratelimit_limit(self, value):
-        self._ratelimit_limit = value
+    def async_concurrency(self):
+        return self._async_concurrency
 
     @property
-    def ratelimit_remaining(self):
-        return self._ratelimit_remaining
+    def http_pool_size(self):
+        return self._http_pool_size
 
-    @ratelimit_remaining.setter
-    def ratelimit_remaining(self, value):
-        self._ratelimit_remaining = value
+    @property
+    def http_timeout(self):
+        return self._http_timeout
 
     @property
-    def ratelimit_reset(self):
-        return self._ratelimit_reset
+    def http_retries(self):
+        return self._http_retries
 
-    @ratelimit_reset.setter
-    def ratelimit_reset(self, value):
-        if value < 0:
-            value = 0
-        self._ratelimit_reset = value + 3
+    @property
+    def http_backoff(self):
+        return self._http_backoff
 
     @property
     def ratelimit_retries(self):
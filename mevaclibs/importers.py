@@ -1,231 +1,347 @@
-from mevaclibs.envs import LoadEnv
-from os import walk
+from mevaclibs.envs import FB_POST_FILES, TW_POST_FILES, LoadEnv
 from os import path
+from functools import partial
+from collections import deque
+import html
 import logging
-import json
+import re
 import sqlite3
 from time import strftime, localtime
 from tabulate import tabulate
+from mevaclibs.archive import file_exists, list_dir, open_file
 from mevaclibs.common import Utils
-from bs4 import BeautifulSoup
+from mevaclibs.db import BatchWriter
+from mevaclibs.metrics import Metrics
+from mevaclibs.pipeline import transform
+from mevaclibs.report import Report
+from mevaclibs.streams import JsonStream
+from mevaclibs.text import html_to_text, split_status
+from mevaclibs.watermark import Watermark
+
+
+def _natural_key(filename):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', filename)]
+
+
+def _parse_fb_post(post, text_size_limit):
+    # Runs in a worker process: converts a your_posts*.json item into a (timestamp, text, media uris, status parts)
+    # tuple, None for items which are not imported
+    text = ''
+    data = post.get('data')
+    timestamp = post.get('timestamp')
+    formatted_timestamp = strftime("%d-%m-%Y %H:%M:%S", localtime(timestamp))
+    if data and data[0].get('post', '') != '':
+        text = data[0].get('post').encode('latin1').decode('utf8')
+    attachments = post.get('attachments')
+    if text == '' and not attachments:
+        return None
+    uris = list()
+    if attachments:
+        for attachment in attachments[0].get('data', []):
+            media = attachment.get('media')
+            link = attachment.get('external_context', {}).get('url', '')
+            # process photos and videos
+            if media:
+                if len(uris) > 3:
+                    logging.warning(
+                        f'Post from {formatted_timestamp} '
+                        f'has more then 4 attachments, trimmed to 4')
+                    break
+                uri = media.get('uri').partition('posts/')[2]
+                if uri and uri not in uris:
+                    uris.append(uri)
+            # process links
+            if link != '' and text.find(link) == -1:
+                text += f'\n{link}'
+                logging.warning(f'Added link {link} to post from {formatted_timestamp}')
+    # the status starts with the post date header added on push
+    return timestamp, text, uris, split_status(text, text_size_limit, len(formatted_timestamp) + 1)
 
 
 class FbImporter:
     def __init__(self, load_env: LoadEnv):
         self._conn = sqlite3.connect(load_env.db_file)
         self._env = load_env
+        self._metrics = Metrics('load', load_env.metrics_file, load_env.metrics_interval)
+        self._stat_periods = list()
         if not path.exists(self._env.fb_posts_dir):
             raise Exception(f'Facebook posts dir {self._env.fb_posts_dir} does not exist')
-        self._facebook_post_file = None
-        self._posts = dict()
-        for (_, dir_names, filenames) in walk(f'{self._env.fb_posts_dir}'):
-            for filename in filenames:
-                if filename.startswith('your_posts'):
-                    if self._facebook_post_file is not None:
-                        raise Exception(
-                            f'More then one facebook backup dir. {filenames} found when {self._facebook_post_file} '
-                            f'exists')
-                    self._facebook_post_file = filename
-                    logging.info(f'Facebook post file: {self._facebook_post_file}')
-            break
-        if self._facebook_post_file is None:
+        self._fb_posts_root = self._env.fb_posts_root
+        self._facebook_post_files = list()
+        # big exports are split into your_posts_1.json ... your_posts_N.json
+        for filename in sorted(list_dir(self._fb_posts_root), key=_natural_key):
+            if re.fullmatch(FB_POST_FILES, filename):
+                self._facebook_post_files.append(filename)
+                logging.info(f'Facebook post file: {filename}')
+        if not self._facebook_post_files:
             logging.warning(f'Facebook post file not detected in {self._env.fb_posts_dir}')
-        self._prepare_db()
+        self.prepare_db(self._conn)
+        Report.prepare_db(self._conn)
 
     def load_fb_posts(self, dry_run=True):
-        c = self._conn.cursor()
-        if self._facebook_post_file is None:
+        if not self._facebook_post_files:
             raise Exception(f'Facebook post file not detected in {self._env.fb_posts_dir}')
-        with open(f'{self._env.fb_posts_dir}/{self._facebook_post_file}') as fb_posts:
-            self._posts = json.load(fb_posts)
         posts_count = 0
         media_count = 0
-        for post in self._posts:
-            text = ''
-            data = post.get('data')
-            timestamp = post.get('timestamp')
+        writer = BatchWriter(self._conn, self._env.load_batch_size)
+        watermark = Watermark(self._conn, 'facebook', self._env.load_incremental)
+        # posts are converted in worker processes, results are consumed in file order by the single DB writer
+        records = transform(partial(_parse_fb_post, text_size_limit=self._env.text_size_limit),
+                            self._iter_fb_posts(watermark), self._env.load_workers)
+        self._metrics.start('facebook')
+        for record in records:
+            self._metrics.inc('posts')
+            self._metrics.tick()
+            if record is None:
+                self._metrics.inc('skipped')
+                continue
+            timestamp, text, uris, parts = record
             formatted_timestamp = strftime("%d-%m-%Y %H:%M:%S", localtime(timestamp))
-            if data and data[0].get('post', '') != '':
-                text = data[0].get('post').encode('latin1').decode('utf8')
-            attachments = post.get('attachments')
-            if text != '' or attachments:
-                posts_count += 1
-                try:
-                    # process attachments
-                    if attachments:
-                        post_media_count = 0
-                        for attachment in attachments[0].get('data', []):
-                            media = attachment.get('media')
-                            link = attachment.get('external_context', {}).get('url', '')
-                            # process photos and videos
-                            if media:
-                                if post_media_count > 3:
-                                    logging.warning(
-                                        f'Post from {formatted_timestamp} '
-                                        f'has more then 4 attachments, trimmed to 4')
-                                    break
-                                uri = media.get('uri').partition('posts/')[2]
-                                if uri:
-                                    try:
-                                        logging.info(f'Dry-run {dry_run}. '
-                                                     f'Adding attachment {uri} to post from {formatted_timestamp}')
-                                        if not dry_run:
-                                            c.execute('INSERT INTO fb_media (post_id, uri) VALUES (?, ?)',
-                                                      (timestamp, uri))
-                                        media_count += 1
-                                        post_media_count += 1
-                                    except sqlite3.IntegrityError:
-                                        logging.warning(
-                                            f'Attachment {uri} already exists')
-                            # process links
-                            if link != '' and text.find(link) == -1:
-                                text += f'\n{link}'
-                                logging.warning(f'Added link {link} to post from {formatted_timestamp}')
-                    # process post
-                    logging.info(f'Dry-run {dry_run}. Inserting post from {formatted_timestamp}')
-                    if not dry_run:
-                        c.execute('INSERT INTO fb_posts (id, text) VALUES (?, ?)',
-                                  (timestamp, text))
-                    self._conn.commit()
-                except sqlite3.IntegrityError:
-                    logging.warning(
-                        f'Post from {formatted_timestamp} already exists')
+            posts_count += 1
+            # process attachments
+            for uri in uris:
+                logging.debug(f'Dry-run {dry_run}. '
+                              f'Adding attachment {uri} to post from {formatted_timestamp}')
+                if not dry_run:
+                    writer.insert('fb_media', ('post_id', 'uri'), (timestamp, uri))
+                media_count += 1
+                self._metrics.inc('media')
+            # process post
+            logging.debug(f'Dry-run {dry_run}. Inserting post from {formatted_timestamp}')
+            if not dry_run:
+                writer.insert('fb_posts', ('id', 'text'), (timestamp, text))
+                for part_number, part in enumerate(parts, 1):
+                    writer.insert('fb_parts', ('post_id', 'part', 'text', 'size_limit'),
+                                  (timestamp, part_number, part, self._env.text_size_limit))
+        writer.flush()
+        if not dry_run:
+            watermark.save()
+        self._metrics.report()
 
+        logging.info(f'Skipped {watermark.skipped_files} unchanged files, {watermark.skipped_items} posts loaded by '
+                     f'previous runs')
         logging.info(f'Loaded {posts_count} posts, {media_count} media files')
+        if not dry_run:
+            logging.info(f'Inserted {writer.inserted("fb_posts")} posts ({writer.duplicates("fb_posts")} already '
+                         f'exist), {writer.inserted("fb_media")} media files ({writer.duplicates("fb_media")} already '
+                         f'exist)')
+
+    def _iter_fb_posts(self, watermark):
+        # big exports are split into your_posts_1.json ... your_posts_N.json, the files are read in order
+        for filename in self._facebook_post_files:
+            if watermark.unchanged(f'{self._fb_posts_root}/{filename}'):
+                logging.info(f'Skip unchanged Facebook post file {filename}')
+                continue
+            with watermark.open(f'{self._fb_posts_root}/{filename}') as fb_posts:
+                for post in JsonStream(fb_posts).items():
+                    if not watermark.seen(post.get('timestamp')):
+                        yield post
 
     def collect_stat(self):
-        c = self._conn.cursor()
-        result = c.execute('SELECT COUNT (*) FROM fb_posts').fetchone()
-        self._env.stat_fb_posts.append(['Imported', result[0]])
-        result = c.execute('SELECT COUNT (*) FROM fb_posts WHERE posted != 0').fetchone()
-        self._env.stat_fb_posts.append(['Pushed', result[0]])
-        result = c.execute('SELECT COUNT (*) FROM fb_posts WHERE posted = 2').fetchone()
-        self._env.stat_fb_posts.append(['Partially pushed', result[0]])
-        result = c.execute('SELECT COUNT (*) FROM fb_posts WHERE length(text) > 500').fetchone()
-        self._env.stat_fb_posts.append(['Long posts', result[0]])
-        result = c.execute('SELECT COUNT (*) FROM fb_media').fetchone()
-        self._env.stat_fb_media.append(['Imported', result[0]])
-        result = c.execute('SELECT COUNT (*) FROM fb_media WHERE posted != 0').fetchone()
-        self._env.stat_fb_media.append(['Pushed', result[0]])
+        report = Report(self._conn, self._env.text_size_limit, self._env.report_period)
+        self._env.stat_fb_posts, self._env.stat_fb_media, self._stat_periods = report.facebook()
 
-    def _prepare_db(self):
-        c = self._conn.cursor()
+    @staticmethod
+    def prepare_db(conn):
+        # also run by the pusher: databases loaded by an older version have no fb_parts
+        c = conn.cursor()
         c.execute('CREATE TABLE IF NOT EXISTS fb_posts (id INTEGER PRIMARY KEY, text TEXT, posted INTEGER default 0)')
         c.execute(
             'CREATE TABLE IF NOT EXISTS fb_media (id INTEGER PRIMARY KEY, post_id INTEGER, uri TEXT, '
             'posted INTEGER default 0)')
         c.execute('CREATE UNIQUE INDEX IF NOT EXISTS fb_media_post_id_uri ON fb_media (post_id, uri)')
-        self._conn.commit()
+        # statuses a post is pushed as, planned on load for the text size limit
+        c.execute('CREATE TABLE IF NOT EXISTS fb_parts (post_id INTEGER, part INTEGER, text TEXT, size_limit INTEGER, '
+                  'posted INTEGER default 0, PRIMARY KEY (post_id, part))')
+        conn.commit()
 
     def print_stat(self):
         print(tabulate(self._env.stat_fb_posts, headers=['FB Posts', 'Count'], tablefmt='presto'))
         print('')
         print(tabulate(self._env.stat_fb_media, headers=['FB Media', 'Count'], tablefmt='presto'))
+        if self._stat_periods:
+            print('')
+            print(tabulate(self._stat_periods, headers=[self._env.report_period.capitalize(), 'Posts', 'Pushed',
+                                                        'Partially pushed', 'Statuses to push', 'Media',
+                                                        'Media pushed'], tablefmt='presto', disable_numparse=True,
+                           colalign=('left',) + ('right',) * 6))
+
+
+def _parse_mst_post(post, filter_out_at):
+    # Converts an outbox item into a (post_id, parent_id, original_date, privacy, language, text, sensitive, media uris,
+    # activity id) tuple, None for items which are not imported
+    if post.get('type', '') == 'Announce':
+        logging.warning(f'Skip Announce post. Post id: {post.get("id")}')
+        return None
+    if not post.get('to', []):
+        privacy = 'direct'
+    elif post.get('to')[0][-6:] == 'Public':
+        privacy = 'public'
+    else:
+        privacy = 'private'
+    object_id = post.get('object', {})
+    split_object_id = object_id.get('id', '').rsplit('/', 1)
+    post_id = int(split_object_id[-1])
+    parent_id = 0
+    in_reply_to = post['object'].get('inReplyTo', None)
+    if in_reply_to:
+        split_parent_id = in_reply_to.rsplit('/', 1)
+        # skip replies to external comments
+        if split_parent_id[0] != split_object_id[0]:
+            logging.warning(f'Skip external comment reply. Post id: {post.get("id")}')
+            return None
+        parent_id = int(split_parent_id[-1])
+    if len(post.get('cc', [])) > 1:
+        logging.warning(f'Skip post with more then one recipient and no inReplyTo. Post id: {post.get("id")}')
+        return None
+    original_date = Utils.as_timestamp_to_epoch(post.get('published', '1900-01-01T00:00:00Z'))
+    if post['object'].get('sensitive', False):
+        sensitive = 1
+    else:
+        sensitive = 0
+    language, text = list(post['object']['contentMap'].items())[0]
+    text = html_to_text(text)
+    text = text.replace('#\n', '#')
+    text = text.replace('@\n', '@')
+    if text != '' and filter_out_at and text[0] == '@':
+        logging.warning(f'Skip post with mention at the beginning (the last relpy leakage dirty fix). Post id:'
+                        f' {post.get("id")}')
+        return None
+    if text == '' and not post['object']['attachment']:
+        return None
+    uris = [attachment['url'] for attachment in post['object']['attachment'] if attachment['url']]
+    return post_id, parent_id, original_date, privacy, language, text, sensitive, uris, post.get('id')
+
 
+class _ThreadImporter:
+    # Load of the sources imported as reply threads, Mastodon and Twitter. Records of the source parser are
+    # (id, parent_id, <_columns after them>..., media uris, archive item id), written to <_source>_posts and
+    # <_source>_media
+    _source = None
+    _columns = None
+    # logged for the replies whose parent is neither in the archive nor in the DB
+    _orphan_warning = None
+
+    def _load_threads(self, records, writer, dry_run):
+        # Reply graph: ids of accepted posts and replies waiting for their parent. A reply is written right after its
+        # parent, so threads don't depend on the archive order and no per-reply DB lookups are needed.
+        # Returns (posts, media) counts
+        accepted = set()
+        pending = dict()
+        posts_count = 0
+        media_count = 0
+        for record in records:
+            self._metrics.inc('posts')
+            self._metrics.tick()
+            if record is None:
+                self._metrics.inc('skipped')
+                continue
+            parent_id = record[1]
+            if parent_id and parent_id not in accepted:
+                pending.setdefault(parent_id, list()).append(record)
+                continue
+            posts, media = self._write_thread(record, accepted, pending, writer, dry_run)
+            posts_count += posts
+            media_count += media
+        # the rest can be replies to posts loaded by a previous run
+        for parent_id in self._get_post_ids(list(pending)):
+            for record in pending.pop(parent_id):
+                posts, media = self._write_thread(record, accepted, pending, writer, dry_run)
+                posts_count += posts
+                media_count += media
+        for records in pending.values():
+            for record in records:
+                logging.warning(f'{self._orphan_warning}: {record[-1]}')
+        return posts_count, media_count
+
+    def _write_thread(self, record, accepted, pending, writer, dry_run):
+        # writes the post and then all its waiting replies, parents first
+        posts_count = 0
+        media_count = 0
+        ready = deque([record])
+        while ready:
+            record = ready.popleft()
+            post_id, uris = record[0], record[-2]
+            accepted.add(post_id)
+            posts_count += 1
+            # process post, it is written before its attachments, the report counts media by the post date
+            logging.debug(f'Dry-run {dry_run}. Inserting post {post_id}')
+            if not dry_run:
+                writer.insert(f'{self._source}_posts', self._columns, record[:len(self._columns)])
+            # process attachments
+            for uri in uris:
+                logging.debug(f'Dry-run {dry_run}. Adding attachment {uri} to post {post_id}')
+                if not dry_run:
+                    writer.insert(f'{self._source}_media', ('post_id', 'uri'), (post_id, uri))
+                media_count += 1
+                self._metrics.inc('media')
+            ready.extend(pending.pop(post_id, []))
+        return posts_count, media_count
+
+    def _get_post_ids(self, post_ids):
+        # the ones already in the DB
+        c = self._conn.cursor()
+        result = list()
+        for i in range(0, len(post_ids), 500):
+            chunk = post_ids[i:i + 500]
+            c.execute(f'SELECT id FROM {self._source}_posts WHERE id IN ({", ".join("?" * len(chunk))})', chunk)
+            result.extend(row[0] for row in c.fetchall())
+        return result
+
+
+class MstImporter(_ThreadImporter):
+    _source = 'mst'
+    _columns = ('id', 'parent_id', 'original_date', 'privacy', 'language', 'text', 'sensitive')
+    _orphan_warning = 'Skip external comment thread. Post id'
 
-class MstImporter:
     def __init__(self, load_env: LoadEnv):
         self._conn = sqlite3.connect(load_env.db_file)
         self._env = load_env
+        self._metrics = Metrics('load', load_env.metrics_file, load_env.metrics_interval)
+        self._stat_periods = list()
         if not path.exists(self._env.mst_posts_dir):
             raise Exception(f'Mastodon posts dir {self._env.mst_posts_dir} does not exist')
-        self._mst_post_file = f'{self._env.mst_posts_dir}/outbox.json'
-        if not path.exists(self._mst_post_file):
+        self._mst_post_file = f'{self._env.mst_posts_root}/outbox.json'
+        if not file_exists(self._mst_post_file):
             raise Exception(f'Mastodon post file {self._mst_post_file} does not exist')
-        self._posts = dict()
         self._prepare_db()
 
     def load_mst_posts(self, dry_run=True):
-        c = self._conn.cursor()
-        with open(f'{self._mst_post_file}') as mst_posts:
-            self._posts = json.load(mst_posts).get('orderedItems', [])
-        posts_count = 0
-        media_count = 0
-        for post in self._posts:
-            # parse post
-            if post.get('type', '') == 'Announce':
-                logging.warning(f'Skip Announce post. Post id: {post.get("id")}')
-                continue
-            if not post.get('to', []):
-                privacy = 'direct'
-            elif post.get('to')[0][-6:] == 'Public':
-                privacy = 'public'
-            else:
-                privacy = 'private'
-            object_id = post.get('object', {})
-            split_object_id = object_id.get('id', '').rsplit('/', 1)
-            post_id = int(split_object_id[-1])
-            parent_id = 0
-            in_reply_to = post['object'].get('inReplyTo', None)
-            if in_reply_to:
-                split_parent_id = in_reply_to.rsplit('/', 1)
-                # skip replies to external comments
-                if split_parent_id[0] != split_object_id[0]:
-                    logging.warning(f'Skip external comment reply. Post id: {post.get("id")}')
-                    continue
-                parent_id = split_parent_id[-1]
-                if self._get_mst_post_by_id(parent_id)[0] != 1:
-                    logging.warning(f'Skip external comment thread. Post id: {post.get("id")}')
-                    continue
-            if len(post.get('cc', [])) > 1:
-                logging.warning(f'Skip post with more then one recipient and no inReplyTo. Post id: {post.get("id")}')
-                continue
-            original_date = Utils.as_timestamp_to_epoch(post.get('published', '1900-01-01T00:00:00Z'))
-            if post['object'].get('sensitive', False):
-                sensitive = 1
-            else:
-                sensitive = 0
-            language, text = list(post['object']['contentMap'].items())[0]
-            text = BeautifulSoup(text, 'html.parser').get_text(separator='\n')
-            text = text.replace('#\n', '#')
-            text = text.replace('@\n', '@')
-            if text != '' and self._env.filter_out_at and text[0] == '@':
-                logging.warning(f'Skip post with mention at the beginning (the last relpy leakage dirty fix). Post id:'
-                                f' {post.get("id")}')
-                continue
-            if text != '' or post['object']['attachment']:
-                posts_count += 1
-                try:
-                    post_media_count = 0
-                    # process attachments
-                    for attachment in post['object']['attachment']:
-                        if attachment['url']:
-                            try:
-                                logging.info(f'Dry-run {dry_run}. '
-                                             f'Adding attachment {attachment["url"]} to post {post_id}')
-                                if not dry_run:
-                                    c.execute('INSERT INTO mst_media (post_id, uri) VALUES (?, ?)',
-                                              (post_id, attachment['url']))
-                                media_count += 1
-                                post_media_count += 1
-                            except sqlite3.IntegrityError:
-                                logging.warning(
-                                    f'Attachment {attachment["url"]} already exists')
-                    # process post
-                    logging.info(f'Dry-run {dry_run}. Inserting post  {post_id}')
-                    if not dry_run:
-                        c.execute(
-                            'INSERT INTO mst_posts (id, parent_id, original_date, privacy, language, text, sensitive)'
-                            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
-                            (post_id, parent_id, original_date, privacy, language, text, sensitive))
-                    self._conn.commit()
-                except sqlite3.IntegrityError:
-                    logging.warning(
-                        f'Post {post_id} already exists')
+        writer = BatchWriter(self._conn, self._env.load_batch_size)
+        watermark = Watermark(self._conn, 'mastodon', self._env.load_incremental)
+        # posts are converted in worker processes, the reply graph is built in the archive order. Replies to posts
+        # skipped by the watermark find their parents in the DB
+        records = transform(partial(_parse_mst_post, filter_out_at=self._env.filter_out_at),
+                            self._iter_mst_posts(watermark), self._env.load_workers)
+        self._metrics.start('mastodon')
+        posts_count, media_count = self._load_threads(records, writer, dry_run)
+        writer.flush()
+        if not dry_run:
+            watermark.save()
+        self._metrics.report()
 
+        logging.info(f'Skipped {watermark.skipped_files} unchanged files, {watermark.skipped_items} posts loaded by '
+                     f'previous runs')
         logging.info(f'Loaded {posts_count} posts, {media_count} media files')
+        if not dry_run:
+            logging.info(f'Inserted {writer.inserted("mst_posts")} posts ({writer.duplicates("mst_posts")} already '
+                         f'exist), {writer.inserted("mst_media")} media files ({writer.duplicates("mst_media")} '
+                         f'already exist)')
+
+    def _iter_mst_posts(self, watermark):
+        # outbox.json can be hundreds of MB, stream orderedItems instead of loading the whole document
+        if watermark.unchanged(self._mst_post_file):
+            logging.info(f'Skip unchanged Mastodon post file {self._mst_post_file}')
+            return
+        with watermark.open(self._mst_post_file) as mst_posts:
+            for post in JsonStream(mst_posts).items('orderedItems'):
+                published = post.get('published')
+                if not watermark.seen(Utils.as_timestamp_to_epoch(published) if published else None):
+                    yield post
 
-    #
     def collect_stat(self):
-        c = self._conn.cursor()
-        result = c.execute('SELECT COUNT (*) FROM mst_posts').fetchone()
-        self._env.stat_mst_posts.append(['Imported', result[0]])
-        result = c.execute('SELECT COUNT (*) FROM mst_posts WHERE posted != 0').fetchone()
-        self._env.stat_mst_posts.append(['Pushed', result[0]])
-        result = c.execute('SELECT COUNT (*) FROM mst_media').fetchone()
-        self._env.stat_mst_media.append(['Imported', result[0]])
-        result = c.execute('SELECT COUNT (*) FROM mst_media WHERE posted != 0').fetchone()
-        self._env.stat_mst_media.append(['Pushed', result[0]])
+        report = Report(self._conn, self._env.text_size_limit, self._env.report_period)
+        self._env.stat_mst_posts, self._env.stat_mst_media, self._stat_periods = report.mastodon()
 
     def _prepare_db(self):
         c = self._conn.cursor()
@@ -237,13 +353,164 @@ class MstImporter:
         c.execute('CREATE UNIQUE INDEX IF NOT EXISTS mst_media_post_id_uri ON mst_media (post_id, uri)')
         c.execute('CREATE INDEX IF NOT EXISTS mst_parent_id ON mst_posts (parent_id)')
         self._conn.commit()
-
-    def _get_mst_post_by_id(self, post_id):
-        c = self._conn.cursor()
-        result = c.execute('SELECT COUNT(*) FROM mst_posts WHERE id = ?', (post_id,)).fetchone()
-        return result
+        Report.prepare_db(self._conn)
 
     def print_stat(self):
         print(tabulate(self._env.stat_mst_posts, headers=['Mastodon Posts', 'Count'], tablefmt='presto'))
         print('')
         print(tabulate(self._env.stat_mst_media, headers=['Mastodon Media', 'Count'], tablefmt='presto'))
+        if self._stat_periods:
+            print('')
+            print(tabulate(self._stat_periods, headers=[self._env.report_period.capitalize(), 'Posts', 'Pushed',
+                                                        'Failed', 'Media', 'Media pushed'], tablefmt='presto',
+                           disable_numparse=True, colalign=('left',) + ('right',) * 5))
+
+
+def _parse_tw_post(item, account_id, media_dir):
+    # Converts a tweets.js item into a (post_id, parent_id, original_date, language, text, sensitive, media uris,
+    # tweet id) tuple, None for items which are not imported
+    tweet = item.get('tweet', item)
+    post_id = int(tweet['id_str'])
+    text = tweet.get('full_text', '')
+    if tweet.get('retweeted') or text.startswith('RT @'):
+        logging.warning(f'Skip retweet. Tweet id: {post_id}')
+        return None
+    parent_id = 0
+    if tweet.get('in_reply_to_status_id_str'):
+        # self-replies make threads, replies to other accounts are not imported
+        if account_id and tweet.get('in_reply_to_user_id_str') != account_id:
+            logging.warning(f'Skip reply to another account. Tweet id: {post_id}')
+            return None
+        parent_id = int(tweet['in_reply_to_status_id_str'])
+        text = re.sub(r'^(@\w+\s+)+', '', text)
+    entities = tweet.get('entities', {})
+    uris = list()
+    for media in tweet.get('extended_entities', entities).get('media', []):
+        # the t.co link of the media is in the text, the file is <tweet id>-<file name> in the media directory
+        if media.get('url'):
+            text = text.replace(media['url'], '')
+        url = media.get('media_url_https', '')
+        if media.get('type') in ('video', 'animated_gif'):
+            variants = [variant for variant in media.get('video_info', {}).get('variants', [])
+                        if variant.get('content_type') == 'video/mp4']
+            if variants:
+                url = max(variants, key=lambda variant: int(variant.get('bitrate', 0)))['url']
+        uri = f'{media_dir}/{post_id}-{url.split("?")[0].rsplit("/", 1)[-1]}'
+        if url and uri not in uris:
+            uris.append(uri)
+    if len(uris) > 4:
+        logging.warning(f'Tweet {post_id} has more then 4 attachments, trimmed to 4')
+        uris = uris[:4]
+    for url in entities.get('urls', []):
+        text = text.replace(url['url'], url.get('expanded_url') or url['url'])
+    text = html.unescape(text).strip()
+    if text == '' and not uris:
+        return None
+    # und, zxx and other codes Mastodon doesn't know are left to the server language detection
+    language = tweet.get('lang', '') if len(tweet.get('lang', '')) == 2 else ''
+    sensitive = 1 if tweet.get('possibly_sensitive') else 0
+    return (post_id, parent_id, Utils.twitter_timestamp_to_epoch(tweet['created_at']), language, text, sensitive, uris,
+            tweet['id_str'])
+
+
+def _skip_js_assignment(file):
+    # the archive .js files are JSON assigned to a variable: window.YTD.tweets.part0 = [...]
+    while True:
+        char = file.read(1)
+        if char in ('=', ''):
+            return file
+
+
+class TwImporter(_ThreadImporter):
+    # tweets have no visibility of their own, MASTODON_VISIBILITY is used on push
+    _source = 'tw'
+    _columns = ('id', 'parent_id', 'original_date', 'language', 'text', 'sensitive')
+    _orphan_warning = 'Skip reply to a tweet which is not in the archive. Tweet id'
+
+    def __init__(self, load_env: LoadEnv):
+        self._conn = sqlite3.connect(load_env.db_file)
+        self._env = load_env
+        self._metrics = Metrics('load', load_env.metrics_file, load_env.metrics_interval)
+        self._stat_periods = list()
+        if not path.exists(self._env.tw_posts_dir):
+            raise Exception(f'Twitter posts dir {self._env.tw_posts_dir} does not exist')
+        self._tw_posts_root = self._env.tw_posts_root
+        self._tw_post_files = list()
+        for filename in sorted(list_dir(self._tw_posts_root), key=_natural_key):
+            if re.fullmatch(TW_POST_FILES, filename):
+                self._tw_post_files.append(filename)
+                logging.info(f'Twitter post file: {filename}')
+        if not self._tw_post_files:
+            raise Exception(f'Twitter post file not detected in {self._env.tw_posts_dir}')
+        self._prepare_db()
+
+    def load_tw_posts(self, dry_run=True):
+        writer = BatchWriter(self._conn, self._env.load_batch_size)
+        watermark = Watermark(self._conn, 'twitter', self._env.load_incremental)
+        media_dir = 'tweets_media' if self._tw_post_files[0].startswith('tweets') else 'tweet_media'
+        records = transform(partial(_parse_tw_post, account_id=self._account_id(), media_dir=media_dir),
+                            self._iter_tw_posts(watermark), self._env.load_workers)
+        self._metrics.start('twitter')
+        # tweets.js is newest first, replies wait for their parents
+        posts_count, media_count = self._load_threads(records, writer, dry_run)
+        writer.flush()
+        if not dry_run:
+            watermark.save()
+        self._metrics.report()
+
+        logging.info(f'Skipped {watermark.skipped_files} unchanged files, {watermark.skipped_items} posts loaded by '
+                     f'previous runs')
+        logging.info(f'Loaded {posts_count} posts, {media_count} media files')
+        if not dry_run:
+            logging.info(f'Inserted {writer.inserted("tw_posts")} posts ({writer.duplicates("tw_posts")} already '
+                         f'exist), {writer.inserted("tw_media")} media files ({writer.duplicates("tw_media")} '
+                         f'already exist)')
+
+    def _account_id(self):
+        # replies to this account are self-replies. Without account.js all replies are kept until the end of the load
+        # and the ones to tweets which are not in the archive are skipped then
+        account_file = f'{self._tw_posts_root}/account.js'
+        if not file_exists(account_file):
+            return None
+        with open_file(account_file) as account:
+            for item in JsonStream(_skip_js_assignment(account)).items():
+                return item.get('account', {}).get('accountId')
+        return None
+
+    def _iter_tw_posts(self, watermark):
+        # the files are streamed, 100k+ tweet archives are never loaded as a whole
+        for filename in self._tw_post_files:
+            if watermark.unchanged(f'{self._tw_posts_root}/{filename}'):
+                logging.info(f'Skip unchanged Twitter post file {filename}')
+                continue
+            with watermark.open(f'{self._tw_posts_root}/{filename}') as tw_posts:
+                for post in JsonStream(_skip_js_assignment(tw_posts)).items():
+                    created_at = post.get('tweet', post).get('created_at')
+                    if not watermark.seen(Utils.twitter_timestamp_to_epoch(created_at) if created_at else None):
+                        yield post
+
+    def collect_stat(self):
+        report = Report(self._conn, self._env.text_size_limit, self._env.report_period)
+        self._env.stat_tw_posts, self._env.stat_tw_media, self._stat_periods = report.twitter()
+
+    def _prepare_db(self):
+        c = self._conn.cursor()
+        c.execute('CREATE TABLE IF NOT EXISTS tw_posts (id INTEGER PRIMARY KEY, parent_id INTEGER default 0, '
+                  'original_date INTEGER default 0, privacy TEXT, language TEXT, text TEXT, '
+                  'sensitive INTEGER default 0, posted INTEGER default 0)')
+        c.execute('CREATE TABLE IF NOT EXISTS tw_media (id INTEGER PRIMARY KEY, post_id INTEGER, uri TEXT, '
+                  'posted INTEGER default 0)')
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS tw_media_post_id_uri ON tw_media (post_id, uri)')
+        c.execute('CREATE INDEX IF NOT EXISTS tw_parent_id ON tw_posts (parent_id)')
+        self._conn.commit()
+        Report.prepare_db(self._conn)
+
+    def print_stat(self):
+        print(tabulate(self._env.stat_tw_posts, headers=['Twitter Posts', 'Count'], tablefmt='presto'))
+        print('')
+        print(tabulate(self._env.stat_tw_media, headers=['Twitter Media', 'Count'], tablefmt='presto'))
+        if self._stat_periods:
+            print('')
+            print(tabulate(self._stat_periods, headers=[self._env.report_period.capitalize(), 'Posts', 'Pushed',
+                                                        'Failed', 'Media', 'Media pushed'], tablefmt='presto',
+                           disable_numparse=True, colalign=('left',) + ('right',) * 5))
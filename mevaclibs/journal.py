@@ -0,0 +1,52 @@
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+# Mastodon keeps the idempotency keys of an account for an hour
+_IDEMPOTENCY_TTL = 3600
+
+
+class Journal:
+    # In-flight journal of the push: every status and media request gets an Idempotency-Key which is saved to the
+    # internal DB before the request is sent and dropped once the result is saved with the post. A request cut off by
+    # a crash is resent with the same key on the next run, and the server answers it with the status it created the
+    # first time instead of posting a duplicate, so requests can overlap without checking what landed.
+    # Thread-safe: media uploads take their keys in worker threads, so the journal uses its own connection.
+
+    def __init__(self, db_file):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, timeout=30)
+        # a key must outlive a crash of the process, not of the OS: in WAL mode the commit needs no fsync then
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS push_journal (source TEXT, item TEXT, key TEXT, '
+                           'started INTEGER, PRIMARY KEY (source, item))')
+        self._conn.commit()
+        self.resumed = 0
+        pending = self._conn.execute('SELECT COUNT (*) FROM push_journal').fetchone()[0]
+        if pending:
+            logging.info(f'{pending} requests of an interrupted push are resent with their idempotency keys')
+
+    def key(self, source, item):
+        # item: the post, part or media row the request is for
+        with self._lock:
+            row = self._conn.execute('SELECT key, started FROM push_journal WHERE source = ? AND item = ?',
+                                     (source, item)).fetchone()
+            if row:
+                self.resumed += 1
+                if time.time() - row[1] > _IDEMPOTENCY_TTL:
+                    logging.warning(f'Request for {source} {item} was sent over an hour ago, the server may have '
+                                    f'forgotten its key and post it twice')
+                return row[0]
+            key = uuid.uuid4().hex
+            self._conn.execute('INSERT INTO push_journal (source, item, key, started) VALUES (?, ?, ?, ?)',
+                               (source, item, key, int(time.time())))
+            self._conn.commit()
+        return key
+
+    def done(self, source, items):
+        with self._lock:
+            self._conn.executemany('DELETE FROM push_journal WHERE source = ? AND item = ?',
+                                   [(source, item) for item in items])
+            self._conn.commit()
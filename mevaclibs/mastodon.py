@@ -1,39 +1,88 @@
+import asyncio
+import heapq
 import requests
-import datetime
+import random
+import threading
 import time
 import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from http import HTTPStatus
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 
+from mevaclibs.archive import file_size
 from mevaclibs.envs import PushEnv
-from mevaclibs.common import Utils
+from mevaclibs.metrics import Metrics
+from mevaclibs.multipart import MultipartFile
+from mevaclibs.ratelimit import RateLimiter
+from mevaclibs.text import split_status
+
+# uploads from this size on report their progress
+_PROGRESS_MIN_SIZE = 16 * 1024 * 1024
 
 
 class Mastodon:
 
-    def __init__(self, env: PushEnv):
+    def __init__(self, env: PushEnv, limiter: RateLimiter = None, metrics: Metrics = None):
         self._env = env
+        self._metrics = metrics or Metrics('push')
+        # Mastodon limits media uploads and status deletions separately from the rest of the API
+        self._limiter = limiter or RateLimiter()
 
-        self._headers = {'Authorization': f'Bearer {self._env.token}'}
-        self._endpoint = f'https://{self._env.domain}'
+        self._endpoint = self._env.api_url
+        # one keep-alive connection pool for all calls and upload threads
+        self._session = requests.Session()
+        self._session.headers.update({'Authorization': f'Bearer {self._env.token}'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._env.http_pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._poller = MediaPoller(self._poll_media, self._env.media_timeout * self._env.media_retries,
+                                   self._env.media_timeout)
 
-    def _update_rate_limits(self, result):
-        self._env.ratelimit_limit = int(result.headers.get('x-ratelimit-limit'))
-        self._env.ratelimit_remaining = int(result.headers.get('x-ratelimit-remaining'))
-        self._env.ratelimit_reset = Utils.mastodon_timestamp_to_epoch(
-            result.headers.get('x-ratelimit-reset')) - int(datetime.datetime.now().timestamp())
+    def _update_rate_limits(self, result, bucket):
+        self._limiter.update(bucket, result.headers)
+
+    def _request(self, method, endpoint, bucket, **kwargs):
+        # Transient failures (connection errors, 5xx) are retried with jittered exponential backoff. Rate-limit and
+        # client errors are returned to the caller
+        retries = self._env.http_retries
+        for attempt in range(retries + 1):
+            # a streamed request body is read to the end by the failed attempt
+            if hasattr(kwargs.get('data'), 'seek'):
+                kwargs['data'].seek(0)
+            self._metrics.inc('ratelimit_sleep_seconds', self._limiter.acquire(bucket))
+            try:
+                result = self._session.request(method, endpoint, timeout=self._env.http_timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exc:
+                # the server may have taken a request whose answer timed out, only a repeatable one is sent again
+                repeatable = method == 'GET' or 'Idempotency-Key' in kwargs.get('headers', {})
+                if attempt == retries or (isinstance(exc, requests.exceptions.ReadTimeout) and not repeatable):
+                    raise
+                logging.warning(f'Connection error on {method} {endpoint}: {exc}. Retry {attempt + 1}/{retries}')
+                self._metrics.inc('retries')
+            else:
+                self._update_rate_limits(result, bucket)
+                if result.status_code < HTTPStatus.INTERNAL_SERVER_ERROR or attempt == retries:
+                    return result
+                logging.warning(f'Server error {result.status_code} on {method} {endpoint}. '
+                                f'Retry {attempt + 1}/{retries}')
+                self._metrics.inc('retries')
+            time.sleep(self._env.http_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
 
     def verify_credentials(self):
         endpoint = f'{self._endpoint}/api/v1/apps/verify_credentials'
-        result = requests.get(endpoint, headers=self._headers)
-        self._update_rate_limits(result)
+        result = self._request('GET', endpoint, 'statuses')
         result.raise_for_status()
 
         return result.json().get('name', '')
 
     def _post_item(self, item_type, data, media_ids=None, visibility='private', in_reply_to_id='0', lang='',
-                   sensitivity=0, dry_run=True):
+                   sensitivity=0, dry_run=True, idempotency_key=None):
+        # a request resent with the same idempotency key is answered with the status created by the first one
         result = None
+        bucket = 'media' if item_type == 'media' else 'statuses'
+        headers = {'Idempotency-Key': idempotency_key} if idempotency_key else dict()
         for n in range(self._env.ratelimit_retries):
             try:
                 if item_type == 'post':
@@ -43,83 +92,92 @@ class Mastodon:
                     if in_reply_to_id and in_reply_to_id != '0':
                         payload['in_reply_to_id'] = in_reply_to_id
                     if not dry_run:
-                        result = requests.post(endpoint, headers=self._headers, json=payload)
-                        self._update_rate_limits(result)
+                        self.wait_for_media(media_ids)
+                        result = self._request('POST', endpoint, bucket, json=payload, headers=headers)
                         result.raise_for_status()
+                        self._metrics.inc('statuses')
                 elif item_type == 'media':
                     endpoint = f'{self._endpoint}/api/v2/media'
                     if not dry_run:
-                        with open(data, 'rb') as file:
-                            result = requests.post(endpoint, headers=self._headers, files={'file': file})
-                            self._update_rate_limits(result)
+                        # the body is streamed from disk, big videos are never loaded into memory
+                        with MultipartFile(data, 'file', self._upload_progress(data)) as body:
+                            result = self._request('POST', endpoint, bucket, data=body,
+                                                   headers=dict(headers, **{'Content-Type': body.content_type}))
                             result.raise_for_status()
+                            self._metrics.inc('media')
+                            self._metrics.inc('media_bytes', body.size)
                             if result.status_code == HTTPStatus.ACCEPTED:
-                                self._wait_for_media(result.json().get('id', '0'))
+                                # still processed by the server, the status using it waits for the poller
+                                self._poller.track(result.json().get('id', '0'))
                 else:
                     raise Exception(f'Unknown post data type {item_type}')
                 break
             except HTTPError as exc:
                 code = exc.response.status_code
                 if code == HTTPStatus.TOO_MANY_REQUESTS:
-                    logging.warning(f'API rate-limit exceeded. Sleeping for: '
-                                    f'{datetime.timedelta(seconds=self._env.ratelimit_reset)}')
-                    time.sleep(self._env.ratelimit_reset)
+                    logging.warning(f'API rate-limit exceeded for {bucket}')
+                    self._metrics.inc('ratelimited')
+                    self._limiter.exhaust(bucket)
                     continue
                 elif code == HTTPStatus.UNPROCESSABLE_ENTITY:
                     logging.error(f'Client Error: Unprocessable Entity for {item_type}, {data}, {media_ids}. Skipping')
+                    self._metrics.inc('skipped')
                     return '0'
                 raise
         if dry_run:
             return '0'
         return result.json().get('id', '0')
 
-    def post_fb_status(self, text: str, media_ids=None, visibility='private', dry_run=True):
+    def post_fb_status(self, text, media_ids=None, visibility='private', dry_run=True, in_reply_to_id='0',
+                       idempotency_keys=None):
+        # text is a status or its parts planned on load. Every part replies to the previous one, media is attached to
+        # the first one. idempotency_keys: one per part
         result = list()
         if media_ids and len(media_ids) > 4:
-            media_ids = media_ids[:4]
             logging.warning(
                 f'{len(media_ids)} media files attached but only 4 allowed. {len(media_ids) - 4} file(s) was dropped')
-        if text:
-            if len(text) <= self._env.text_size_limit:
-                result.append(self._post_item('post', text, media_ids, visibility, dry_run=dry_run))
-            else:
-                post_number = 1
-                text_prefix = ''
-                words = text.split(' ')
-                text_to_post = ''
-                sub_result = ''
-                for word in words:
-                    if len(str(post_number)) + 2 + len(text_prefix) + 1 + len(text_to_post) + 1 + len(
-                            word) < self._env.text_size_limit:
-                        text_to_post = text_to_post + ' ' + word
-                    else:
-                        text_to_post = f'{post_number}. {text_prefix} {text_to_post}'
-                        sub_result = self._post_item('post', text_to_post, media_ids, visibility, sub_result, dry_run)
-                        result.append(sub_result)
-                        text_to_post = word
-                        text_prefix = '->'
-                        # Attach media only to the first post
-                        if post_number == 1:
-                            media_ids = None
-                        post_number += 1
-                if text_to_post:
-                    text_to_post = f'{post_number}. {text_prefix} {text_to_post}'
-                    result.append(self._post_item('post', text_to_post, media_ids, visibility, sub_result, dry_run))
-
-        elif media_ids:
-            result.append(self._post_item('post', text, media_ids, visibility, dry_run=dry_run))
-        else:
+            media_ids = media_ids[:4]
+        parts = split_status(text, self._env.text_size_limit) if isinstance(text, str) else text
+        if not any(parts) and not media_ids:
             raise Exception('Neither text nor media provided for post. Exiting')
-
+        for part, idempotency_key in zip(parts, idempotency_keys or [None] * len(parts)):
+            post_id = self._post_item('post', part, media_ids, visibility, in_reply_to_id, dry_run=dry_run,
+                                      idempotency_key=idempotency_key)
+            result.append(post_id)
+            if post_id != '0':
+                in_reply_to_id = post_id
+            media_ids = None
         return result
 
     def post_mst_status(self, text: str, lang='en', media_ids=None, visibility='private', sensitivity=0,
-                        in_reply_to_id='0', dry_run=True):
+                        in_reply_to_id='0', dry_run=True, idempotency_key=None):
         return self._post_item('post', text, media_ids, visibility, in_reply_to_id, lang=lang,
-                               sensitivity=sensitivity, dry_run=dry_run)
+                               sensitivity=sensitivity, dry_run=dry_run, idempotency_key=idempotency_key)
 
-    def upload_media(self, media_file, dry_run=True):
-        return self._post_item('media', media_file, dry_run=dry_run)
+    def upload_media(self, media_file, dry_run=True, idempotency_key=None):
+        # a dry run doesn't read the media, files missing in the archive are only reported by the real push
+        if dry_run:
+            return self._post_item('media', media_file, dry_run=dry_run)
+        size = file_size(media_file)
+        if size > self._env.media_size_limit:
+            logging.error(f'Media file {media_file} is {size} bytes, over the {self._env.media_size_limit} bytes '
+                          f'limit. Skipping')
+            self._metrics.inc('skipped')
+            return '0'
+        return self._post_item('media', media_file, dry_run=dry_run, idempotency_key=idempotency_key)
+
+    @staticmethod
+    def _upload_progress(media_file):
+        # large uploads are logged every 10%
+        reported = [0]
+
+        def progress(sent, total):
+            step = sent * 10 // total
+            if total >= _PROGRESS_MIN_SIZE and step > reported[0]:
+                reported[0] = step
+                logging.info(f'Uploading {media_file}: {step * 10}% of {total} bytes')
+
+        return progress
 
     def delete_entity(self, status_id):
         if status_id == '0':
@@ -128,27 +186,122 @@ class Mastodon:
         endpoint = f'{self._endpoint}/api/v1/statuses/{status_id}'
         for n in range(self._env.ratelimit_retries):
             try:
-                result = requests.delete(endpoint, headers=self._headers)
-                self._update_rate_limits(result)
+                result = self._request('DELETE', endpoint, 'delete')
                 result.raise_for_status()
                 break
             except HTTPError as exc:
                 code = exc.response.status_code
                 if code == HTTPStatus.TOO_MANY_REQUESTS:
-                    logging.warning(f'API rate-limit exceeded. Sleeping for: '
-                                    f'{datetime.timedelta(seconds=self._env.ratelimit_reset)}')
-                    time.sleep(self._env.ratelimit_reset)
+                    logging.warning('API rate-limit exceeded for delete')
+                    self._metrics.inc('ratelimited')
+                    self._limiter.exhaust('delete')
                     continue
                 raise
         return result.json().get('id', '0')
 
-    def _wait_for_media(self, media_id):
-        if media_id != '0':
-            endpoint = f'{self._endpoint}/api/v1/media'
-            for i in range(self._env.media_retries):
-                logging.info(f'Waiting for media {media_id} to be processed. Round {i}')
-                result = requests.get(f'{endpoint}/{media_id}', headers=self._headers)
-                if result.status_code == HTTPStatus.PARTIAL_CONTENT:
-                    time.sleep(self._env.media_timeout)
-                else:
-                    break
+    def media_ready(self, media_id):
+        return self._poller.ready(media_id)
+
+    def wait_for_media(self, media_ids):
+        for media_id in media_ids or []:
+            self._poller.ready(media_id).result()
+
+    def _poll_media(self, media_id):
+        # True when the media is processed
+        result = self._request('GET', f'{self._endpoint}/api/v1/media/{media_id}', 'statuses')
+        if result.status_code == HTTPStatus.PARTIAL_CONTENT:
+            return False
+        result.raise_for_status()
+        return True
+
+
+class MediaPoller:
+    # Background poller for media still processed by the server (upload answered 202). Every pending media is polled
+    # with its own growing interval until ready or until the deadline, so uploads and unrelated posts don't wait.
+
+    def __init__(self, poll, deadline, max_interval):
+        self._poll = poll
+        self._deadline = deadline
+        self._max_interval = max(max_interval, 1)
+        self._cond = threading.Condition()
+        self._queue = list()
+        self._futures = dict()
+        self._thread = None
+
+    def track(self, media_id):
+        future = Future()
+        with self._cond:
+            self._futures[media_id] = future
+            heapq.heappush(self._queue, (time.time() + 1, media_id, 1, time.time() + self._deadline))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='media-poller', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def ready(self, media_id):
+        with self._cond:
+            future = self._futures.get(media_id)
+        if future is None:
+            future = Future()
+            future.set_result(media_id)
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue or self._queue[0][0] > time.time():
+                    self._cond.wait(self._queue[0][0] - time.time() if self._queue else None)
+                check, media_id, interval, deadline = heapq.heappop(self._queue)
+            try:
+                done = self._poll(media_id)
+            except Exception as exc:
+                logging.warning(f'Media {media_id} status check failed: {exc}')
+                done = False
+            if not done and time.time() + interval < deadline:
+                logging.debug(f'Media {media_id} is still being processed')
+                interval = min(interval * 2, self._max_interval)
+                with self._cond:
+                    heapq.heappush(self._queue, (time.time() + interval, media_id, interval, deadline))
+                continue
+            if not done:
+                logging.warning(f'Media {media_id} is not processed in {self._deadline}s, posting anyway')
+            with self._cond:
+                future = self._futures.pop(media_id)
+            future.set_result(media_id)
+
+
+class AsyncMastodon:
+    # asyncio API over the pooled client. Calls run in a bounded pool, so up to `concurrency` requests are in flight
+    # while the shared session and rate limiter keep the global budget
+
+    def __init__(self, mst: Mastodon, concurrency=8):
+        self._mst = mst
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def run(self, func, *args, **kwargs):
+        # runs a blocking call (client method or a wrapper around it) in the client pool
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def verify_credentials(self):
+        return await self.run(self._mst.verify_credentials)
+
+    async def post_fb_status(self, text, media_ids=None, visibility='private', dry_run=True, in_reply_to_id='0',
+                             idempotency_keys=None):
+        return await self.run(self._mst.post_fb_status, text, media_ids, visibility, dry_run, in_reply_to_id,
+                              idempotency_keys)
+
+    async def post_mst_status(self, text: str, lang='en', media_ids=None, visibility='private', sensitivity=0,
+                              in_reply_to_id='0', dry_run=True, idempotency_key=None):
+        return await self.run(self._mst.post_mst_status, text, lang, media_ids, visibility, sensitivity,
+                              in_reply_to_id, dry_run, idempotency_key)
+
+    async def upload_media(self, media_file, dry_run=True, idempotency_key=None):
+        return await self.run(self._mst.upload_media, media_file, dry_run, idempotency_key)
+
+    async def wait_for_media(self, media_ids):
+        # waits without blocking the event loop or a pool thread
+        await asyncio.gather(*(asyncio.wrap_future(self._mst.media_ready(media_id)) for media_id in media_ids or []))
+
+    async def delete_entity(self, status_id):
+        return await self.run(self._mst.delete_entity, status_id)
@@ -0,0 +1,77 @@
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+from mevaclibs.archive import file_stat
+from mevaclibs.common import Utils
+
+
+class MediaCache:
+    # Content-addressed cache of uploaded media: file sha256 -> Mastodon media id, stored in the internal DB.
+    # Mastodon attaches a media to one status only, so an upload is reused for the same content within the same post
+    # (duplicate attachments, re-push after a crash) until the post status is published. Only the media of a post
+    # with several uploads is hashed to find duplicates, a single upload is keyed by its path, size and mtime.
+    # Thread-safe: uploads run in worker threads, so the cache uses its own connection.
+
+    def __init__(self, db_file):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, timeout=30)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS media_cache (digest TEXT, source TEXT, post_id INTEGER, '
+                           'media_id TEXT, attached INTEGER default 0, PRIMARY KEY (digest, source, post_id))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS media_cache_post ON media_cache (source, post_id)')
+        self._conn.commit()
+        self._pending = dict()
+        self.uploaded = 0
+        self.reused = 0
+
+    def upload(self, media_file, source, post_id, upload, dry_run=True, post_uploads=1):
+        # post_uploads: the number of media uploaded for the post
+        if dry_run:
+            return upload(media_file, dry_run)
+        key = (self._content_key(media_file, post_uploads), source, post_id)
+        with self._lock:
+            row = self._conn.execute('SELECT media_id FROM media_cache WHERE digest = ? AND source = ? AND post_id = ? '
+                                     'AND attached = 0', key).fetchone()
+            if row:
+                self.reused += 1
+                return row[0]
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = Future()
+        if not owner:
+            # the same content is being uploaded by another thread
+            media_id = pending.result()
+            if media_id != '0':
+                with self._lock:
+                    self.reused += 1
+            return media_id
+        try:
+            media_id = upload(media_file, dry_run)
+        except BaseException as exc:
+            with self._lock:
+                del self._pending[key]
+            pending.set_exception(exc)
+            raise
+        with self._lock:
+            del self._pending[key]
+            self.uploaded += 1
+            if media_id != '0':
+                self._conn.execute('INSERT OR REPLACE INTO media_cache (digest, source, post_id, media_id) '
+                                   'VALUES (?, ?, ?, ?)', (*key, media_id))
+                self._conn.commit()
+        pending.set_result(media_id)
+        return media_id
+
+    @staticmethod
+    def _content_key(media_file, post_uploads):
+        if post_uploads > 1:
+            return Utils.file_digest(media_file)
+        size, mtime = file_stat(media_file)
+        return f'{media_file}:{size}:{mtime}'
+
+    def attach(self, source, post_id):
+        with self._lock:
+            self._conn.execute('UPDATE media_cache SET attached = 1 WHERE source = ? AND post_id = ?',
+                               (source, post_id))
+            self._conn.commit()
@@ -0,0 +1,120 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+# counter name -> help text, the Prometheus metric is mevac_<name>_total
+COUNTERS = {
+    'posts': 'Archive posts processed',
+    'statuses': 'Statuses posted',
+    'media': 'Media files uploaded (found on load)',
+    'media_bytes': 'Media bytes uploaded',
+    'ratelimit_sleep_seconds': 'Time spent waiting for the API rate-limit',
+    'ratelimited': 'Requests answered with 429',
+    'retries': 'Requests retried after a connection or server error',
+    'skipped': 'Items skipped: not imported, unprocessable (422) or too large',
+}
+
+
+class Metrics:
+    # Counters of a load or push run, shared by the pusher, the API client and upload threads. Progress with the ETA
+    # is logged every `interval` seconds and written to the export file if set: JSON for *.json, the Prometheus text
+    # format otherwise (node_exporter textfile collector, *.prom)
+
+    def __init__(self, operation, export_file='', interval=10):
+        self._lock = threading.Lock()
+        self._operation = operation
+        self._export_file = export_file
+        self._interval = interval
+        self.start('')
+
+    def start(self, source, total=0):
+        # total is the number of posts to process, 0 if unknown (no ETA then)
+        with self._lock:
+            self._source = source
+            self._counters = dict.fromkeys(COUNTERS, 0)
+            self._total = total
+            self._start = time.time()
+            self._next_report = self._start + self._interval
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            total = self._total
+        counters['ratelimit_sleep_seconds'] = round(counters['ratelimit_sleep_seconds'], 3)
+        elapsed = max(time.time() - self._start, 0.001)
+        posts_rate = counters['posts'] / elapsed
+        remaining = max(total - counters['posts'], 0)
+        return {
+            'operation': self._operation,
+            'source': self._source,
+            'timestamp': int(time.time()),
+            'elapsed_seconds': round(elapsed, 3),
+            'posts_pending': remaining,
+            'posts_per_second': round(posts_rate, 3),
+            'media_per_second': round(counters['media'] / elapsed, 3),
+            'eta_seconds': round(remaining / posts_rate) if total and posts_rate else None,
+            **counters,
+        }
+
+    def tick(self):
+        # called after every post, reports and exports at most once per interval
+        if time.time() >= self._next_report:
+            self._next_report = time.time() + self._interval
+            self.report()
+
+    def report(self):
+        snapshot = self.snapshot()
+        progress = f'{snapshot["posts"]}/{snapshot["posts"] + snapshot["posts_pending"]}' if self._total \
+            else snapshot['posts']
+        message = (f'{self._operation.capitalize()} {self._source}: {progress} posts, '
+                   f'{snapshot["posts_per_second"]:.1f} posts/s, {snapshot["media_per_second"]:.1f} media/s')
+        if self._operation == 'push':
+            message += f', rate-limit sleep {snapshot["ratelimit_sleep_seconds"]:.0f}s'
+        if snapshot['eta_seconds'] is not None:
+            message += f', ETA {datetime.timedelta(seconds=snapshot["eta_seconds"])}'
+        logging.info(message)
+        if self._export_file:
+            self.export(snapshot)
+
+    def export(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        if self._export_file.endswith('.json'):
+            content = json.dumps(snapshot, indent=2)
+        else:
+            content = self._prometheus(snapshot)
+        # the collector may read the file at any time, replace it in one step
+        with open(f'{self._export_file}.tmp', 'w') as file:
+            file.write(content)
+        os.replace(f'{self._export_file}.tmp', self._export_file)
+
+    def _prometheus(self, snapshot):
+        labels = f'{{operation="{self._operation}",source="{self._source}"}}'
+        lines = list()
+        for name, description in COUNTERS.items():
+            lines.append(f'# HELP mevac_{name}_total {description}')
+            lines.append(f'# TYPE mevac_{name}_total counter')
+            lines.append(f'mevac_{name}_total{labels} {snapshot[name]}')
+        for name in ('posts_pending', 'posts_per_second', 'media_per_second', 'elapsed_seconds', 'eta_seconds'):
+            if snapshot[name] is not None:
+                lines.append(f'# TYPE mevac_{name} gauge')
+                lines.append(f'mevac_{name}{labels} {snapshot[name]}')
+        return '\n'.join(lines) + '\n'
+
+    def stat(self):
+        # rows for the summary table printed after the run
+        snapshot = self.snapshot()
+        return [['Posts', snapshot['posts']],
+                ['Statuses posted', snapshot['statuses']],
+                ['Media uploaded, bytes', snapshot['media_bytes']],
+                ['Posts per second', f'{snapshot["posts_per_second"]:.2f}'],
+                ['Rate-limit sleep, s', f'{snapshot["ratelimit_sleep_seconds"]:.0f}'],
+                ['Rate-limited requests', snapshot['ratelimited']],
+                ['Retried requests', snapshot['retries']],
+                ['Skipped', snapshot['skipped']]]
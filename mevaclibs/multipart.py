@@ -0,0 +1,70 @@
+import mimetypes
+import uuid
+from os import path
+from mevaclibs.archive import file_size, open_file
+
+
+class MultipartFile:
+    # Read-only multipart/form-data body with one file field. The file is read from disk as the connection consumes
+    # the body, so an upload of any size only needs the socket buffer instead of the whole encoded request.
+    # The body length is known upfront and is sent as Content-Length; seek(0) rewinds it for a retry.
+
+    def __init__(self, file_name, field='file', progress=None):
+        self._file_name = file_name
+        self._progress = progress
+        self._boundary = uuid.uuid4().hex
+        content_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+        self._head = (f'--{self._boundary}\r\n'
+                      f'Content-Disposition: form-data; name="{field}"; filename="{path.basename(file_name)}"\r\n'
+                      f'Content-Type: {content_type}\r\n\r\n').encode()
+        self._tail = f'\r\n--{self._boundary}--\r\n'.encode()
+        self.size = file_size(file_name)
+        self._file = open_file(file_name, 'rb')
+        self._position = 0
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self._boundary}'
+
+    def __len__(self):
+        return len(self._head) + self.size + len(self._tail)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise Exception(f'Multipart body of {self._file_name} can only be rewound')
+        self._file.seek(0)
+        self._position = 0
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self) - self._position
+        chunks = list()
+        while size > 0 and self._position < len(self):
+            head_end = len(self._head)
+            file_end = head_end + self.size
+            if self._position < head_end:
+                chunk = self._head[self._position:self._position + size]
+            elif self._position < file_end:
+                chunk = self._file.read(min(size, file_end - self._position))
+                if not chunk:
+                    raise Exception(f'Media file {self._file_name} was truncated during upload')
+                if self._progress:
+                    self._progress(self._position + len(chunk) - head_end, self.size)
+            else:
+                chunk = self._tail[self._position - file_end:self._position - file_end + size]
+            chunks.append(chunk)
+            self._position += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
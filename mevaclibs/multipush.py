@@ -0,0 +1,93 @@
+from mevaclibs.envs import LoadEnv, PushEnv
+from mevaclibs.importers import FbImporter
+from mevaclibs.optimizer import MediaOptimizer
+from mevaclibs.pusher import Pusher, AsyncPusher
+from mevaclibs.report import Report
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+import json
+import logging
+import sqlite3
+import threading
+import time
+from tabulate import tabulate
+
+# source -> pusher method
+_SOURCES = {'facebook': 'push_fb_posts', 'mastodon': 'push_mst_posts', 'twitter': 'push_tw_posts'}
+
+
+class MultiPusher:
+    # Pushes the sources loaded into one database to their own accounts at once: one thread and one Pusher per target,
+    # each with its own client, connection pool and rate-limit budget, so the run takes as long as the slowest account
+    # instead of the sum of all of them. PUSH_TARGETS is a JSON file with a list of targets:
+    #   [{"source": "facebook", "account": "fb", "token": "...", "MASTODON_VISIBILITY": "public"}, ...]
+    # other MASTODON_* keys override the settings for the target, a source can be pushed to one account only
+
+    def __init__(self, load_env: LoadEnv, async_push=False):
+        self._load_env = load_env
+        self._async_push = async_push
+        self._stat = list()
+        if not load_env.push_targets or not path.exists(load_env.push_targets):
+            raise Exception(f'Push targets file {load_env.push_targets} does not exist')
+        with open(load_env.push_targets) as file:
+            targets = json.load(file)
+        self._targets = list()
+        for target in targets:
+            if target.get('source') not in _SOURCES:
+                raise Exception(f'Unknown push target source {target.get("source")}, expected one of '
+                                f'{", ".join(_SOURCES)}')
+            if not target.get('token'):
+                raise Exception(f'No token for the {target["source"]} push target')
+            if target['source'] in (known['source'] for known, _ in self._targets):
+                raise Exception(f'Source {target["source"]} has more than one push target')
+            target.setdefault('account', target['source'])
+            overrides = {name: value for name, value in target.items() if name.startswith('MASTODON_')}
+            # the settings are read here, a missing one is asked for before the workers start. The target token wins
+            # over a MASTODON_CLIENT_ACCESS_TOKEN key
+            self._targets.append((target, PushEnv(**dict(overrides, MASTODON_CLIENT_ACCESS_TOKEN=target['token']))))
+        if not self._targets:
+            raise Exception(f'No push targets in {load_env.push_targets}')
+        # the schema and the triggers are created once, not by the pushers racing each other
+        conn = sqlite3.connect(load_env.db_file)
+        MediaOptimizer.prepare_db(conn)
+        FbImporter.prepare_db(conn)
+        Report.prepare_db(conn)
+        conn.close()
+
+    def push(self, dry_run=True, retry=False):
+        with ThreadPoolExecutor(max_workers=len(self._targets)) as executor:
+            results = list(executor.map(lambda target: self._push_target(*target, dry_run, retry), self._targets))
+        self._stat = results
+        failed = [row[0] for row in results if row[-1] != 'done']
+        if failed:
+            raise Exception(f'Push failed for {", ".join(failed)}')
+
+    def _push_target(self, target, push_env, dry_run, retry):
+        # runs in a worker thread, the pusher and its DB connection are made here
+        threading.current_thread().name = f'push-{target["account"]}'
+        start = time.time()
+        pusher = None
+        try:
+            pusher_class = AsyncPusher if self._async_push else Pusher
+            pusher = pusher_class(self._load_env, push_env, self._metrics_file(target['source']))
+            logging.info(f'Pushing {target["source"]} to {target["account"]}')
+            getattr(pusher, _SOURCES[target['source']])(dry_run=dry_run, retry=retry)
+            state = 'done'
+        except Exception as exc:
+            logging.error(f'Push of {target["source"]} to {target["account"]} failed: {exc}')
+            state = f'failed: {exc}'
+        snapshot = pusher.metrics.snapshot() if pusher else dict.fromkeys(('posts', 'statuses', 'ratelimited'), 0)
+        return [target['account'], target['source'], snapshot['posts'], snapshot['statuses'],
+                snapshot['ratelimited'], f'{time.time() - start:.1f}', state]
+
+    def _metrics_file(self, source):
+        # one export file per target: metrics.prom -> metrics-facebook.prom
+        if not self._load_env.metrics_file:
+            return ''
+        root, extension = path.splitext(self._load_env.metrics_file)
+        return f'{root}-{source}{extension}'
+
+    def print_stat(self):
+        print(tabulate(self._stat, headers=['Account', 'Source', 'Posts', 'Statuses posted', 'Rate-limited', 'Time, s',
+                                            'State'], tablefmt='presto', disable_numparse=True,
+                       colalign=('left', 'left', 'right', 'right', 'right', 'right', 'left')))
@@ -0,0 +1,125 @@
+from mevaclibs.envs import LoadEnv
+from mevaclibs.archive import file_exists, file_size, open_file
+from mevaclibs.common import Utils
+from concurrent.futures import ProcessPoolExecutor
+from importlib.util import find_spec
+from os import getpid, makedirs, path, remove, replace
+import logging
+import sqlite3
+import time
+from tabulate import tabulate
+
+_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.webp': 'WEBP'}
+
+
+def _optimize_media_file(task):
+    # Runs in a worker process: downscales the image to max_pixels and re-encodes it without metadata.
+    # Returns (uri, digest, optimized file or None if not worth it, bytes in, bytes out, seconds)
+    # Pillow is only needed by the optimize command
+    from PIL import Image, ImageOps
+    uri, source, target_dir, max_pixels, quality = task
+    start = time.time()
+    extension = path.splitext(source)[1].lower()
+    bytes_in = file_size(source)
+    digest = Utils.file_digest(source)
+    target = f'{target_dir}/{digest}-{max_pixels}-{quality}{extension}'
+    # Files with the same content share the target, it is only written when smaller and never removed, so a task
+    # finding it can use it while another one optimizes the same content
+    if path.exists(target):
+        return uri, digest, target, bytes_in, path.getsize(target), time.time() - start
+    temp = f'{target}.{getpid()}.tmp'
+    try:
+        with open_file(source, 'rb') as file, Image.open(file) as image:
+            # orientation is stored in EXIF, apply it before the metadata is dropped
+            image = ImageOps.exif_transpose(image)
+            width, height = image.size
+            if width * height > max_pixels:
+                scale = (max_pixels / (width * height)) ** 0.5
+                image = image.resize((max(int(width * scale), 1), max(int(height * scale), 1)), Image.LANCZOS)
+            if _FORMATS[extension] == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(temp, format=_FORMATS[extension], quality=quality, optimize=True,
+                       icc_profile=image.info.get('icc_profile'))
+    except Exception as exc:
+        logging.warning(f'Media file {source} is not optimized: {exc}')
+        if path.exists(temp):
+            remove(temp)
+        return uri, digest, None, bytes_in, bytes_in, time.time() - start
+    bytes_out = path.getsize(temp)
+    if bytes_out >= bytes_in:
+        remove(temp)
+        return uri, digest, None, bytes_in, bytes_in, time.time() - start
+    replace(temp, target)
+    return uri, digest, target, bytes_in, bytes_out, time.time() - start
+
+
+class MediaOptimizer:
+    # Optional pre-push stage: optimized copies of the archive images are stored in MEDIA_OPTIMIZE_DIR under the
+    # source file hash and are uploaded by the pusher instead of the originals made with the current settings
+    def __init__(self, load_env: LoadEnv):
+        if find_spec('PIL') is None:
+            raise Exception('Media optimization needs Pillow, install it with pip install Pillow')
+        self._conn = sqlite3.connect(load_env.db_file)
+        self._env = load_env
+        self._stat = list()
+        self.prepare_db(self._conn)
+
+    @staticmethod
+    def prepare_db(conn):
+        c = conn.cursor()
+        c.execute('CREATE TABLE IF NOT EXISTS media_optimized (source TEXT, uri TEXT, settings TEXT, digest TEXT, '
+                  'path TEXT, bytes_in INTEGER, bytes_out INTEGER, PRIMARY KEY (source, uri))')
+        conn.commit()
+
+    @staticmethod
+    def settings(load_env: LoadEnv):
+        return f'{load_env.media_max_pixels}-{load_env.media_quality}'
+
+    def optimize_media(self, media_source, media_root, dry_run=True):
+        c = self._conn.cursor()
+        settings = self.settings(self._env)
+        c.execute(f'SELECT DISTINCT m.uri FROM {media_source}_media m LEFT JOIN media_optimized o '
+                  f'ON o.source = ? AND o.uri = m.uri AND o.settings = ? WHERE m.posted = 0 AND o.uri IS NULL',
+                  (media_source, settings))
+        tasks = list()
+        for (uri,) in c.fetchall():
+            source = f'{media_root}/{uri}'
+            if path.splitext(uri)[1].lower() not in _FORMATS:
+                continue
+            if not file_exists(source):
+                logging.warning(f'Media file {source} does not exist')
+                continue
+            tasks.append((uri, source, self._env.media_optimize_dir, self._env.media_max_pixels,
+                          self._env.media_quality))
+        logging.info(f'Dry-run {dry_run}. Optimizing {len(tasks)} media files')
+        files_count = 0
+        bytes_in = 0
+        bytes_out = 0
+        seconds = list()
+        if not dry_run and tasks:
+            makedirs(self._env.media_optimize_dir, exist_ok=True)
+            start = time.time()
+            with ProcessPoolExecutor(max_workers=self._env.load_workers) as executor:
+                for uri, digest, target, file_in, file_out, file_seconds in executor.map(_optimize_media_file,
+                                                                                         tasks, chunksize=4):
+                    logging.debug(f'Optimized {uri}: {file_in} -> {file_out} bytes in {file_seconds:.2f}s')
+                    c.execute('INSERT OR REPLACE INTO media_optimized (source, uri, settings, digest, path, bytes_in, '
+                              'bytes_out) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (media_source, uri, settings, digest, target, file_in, file_out))
+                    files_count += 1
+                    bytes_in += file_in
+                    bytes_out += file_out
+                    seconds.append(file_seconds)
+            self._conn.commit()
+            logging.info(f'Optimized {files_count} media files in {time.time() - start:.1f}s')
+        self._stat.append(['Optimized', files_count])
+        self._stat.append(['Bytes before', bytes_in])
+        self._stat.append(['Bytes after', bytes_out])
+        self._stat.append(['Bytes saved', bytes_in - bytes_out])
+        if seconds:
+            self._stat.append(['Avg time per file, s', f'{sum(seconds) / len(seconds):.3f}'])
+            self._stat.append(['Max time per file, s', f'{max(seconds):.3f}'])
+
+    def print_stat(self):
+        print(tabulate(self._stat, headers=['Media optimization', 'Count'], tablefmt='presto', disable_numparse=True,
+                       colalign=('left', 'right')))
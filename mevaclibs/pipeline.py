@@ -0,0 +1,28 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+
+def _transform_chunk(func, chunk):
+    return [func(item) for item in chunk]
+
+
+def transform(func, items, workers=1, chunk_size=500):
+    # Applies func to items in worker processes and yields the results in the input order. Items are sent in chunks
+    # to amortize pickling, at most two chunks per worker are in flight, so a streamed archive is never read ahead
+    # further than that. func must be a picklable module level function (or a partial of one).
+    items = iter(items)
+    if workers <= 1:
+        yield from map(func, items)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        while True:
+            while len(in_flight) < workers * 2:
+                chunk = list(islice(items, chunk_size))
+                if not chunk:
+                    break
+                in_flight.append(executor.submit(_transform_chunk, func, chunk))
+            if not in_flight:
+                break
+            yield from in_flight.popleft().result()
@@ -1,112 +1,379 @@
 from mevaclibs.envs import PushEnv, LoadEnv
-from mevaclibs.mastodon import Mastodon
+from mevaclibs.importers import FbImporter
+from mevaclibs.journal import Journal
+from mevaclibs.mastodon import Mastodon, AsyncMastodon
+from mevaclibs.mediacache import MediaCache
+from mevaclibs.metrics import Metrics
+from mevaclibs.optimizer import MediaOptimizer
+from mevaclibs.report import Report
+from mevaclibs.text import split_status
+import asyncio
 import sqlite3
 from os import path
+from concurrent.futures import Future, ThreadPoolExecutor
 import logging
 from time import strftime, localtime
+from tabulate import tabulate
+
+# sources pushed as threads, one status per post: DB table prefix -> metrics source name
+_THREAD_SOURCES = {'mst': 'mastodon', 'tw': 'twitter'}
 
 
 class Pusher:
 
-    def __init__(self, load_env: LoadEnv, push_env: PushEnv):
-        self._mst = Mastodon(push_env)
-        self._conn = sqlite3.connect(load_env.db_file)
+    def __init__(self, load_env: LoadEnv, push_env: PushEnv, metrics_file=None):
+        # metrics_file: the export file of this pusher, METRICS_FILE by default
+        self._metrics = Metrics('push', load_env.metrics_file if metrics_file is None else metrics_file,
+                                load_env.metrics_interval)
+        self._mst = Mastodon(push_env, metrics=self._metrics)
+        # other pushers of a multi-account push write to the same database
+        self._conn = sqlite3.connect(load_env.db_file, timeout=30)
         self._load_env = load_env
         self._push_env = push_env
+        self._media_pool = ThreadPoolExecutor(max_workers=push_env.media_workers)
+        self._media_cache = MediaCache(load_env.db_file)
+        self._journal = Journal(load_env.db_file)
+        MediaOptimizer.prepare_db(self._conn)
+        # databases loaded by an older version get the post parts and the report counters before the push
+        FbImporter.prepare_db(self._conn)
+        Report.prepare_db(self._conn)
         if not path.exists(self._load_env.fb_posts_dir):
             raise Exception(f'Facebook posts dir {self._load_env.fb_posts_dir} does not exist')
 
     def push_fb_posts(self, dry_run=True, retry=False):
-        c = self._conn.cursor()
+        fb_posts, plans, media_condition = self._fb_push_plan(retry)
+        result = list()
+        uploads = dict()
+        for n, fb_post in enumerate(fb_posts):
+            # media of the upcoming posts is uploaded in the background while this one is being posted
+            for next_post in fb_posts[n:n + 1 + self._push_env.media_lookahead]:
+                if next_post[0] not in uploads:
+                    uploads[next_post[0]] = self._start_post_media(next_post[0], media_condition, 'fb',
+                                                                   self._load_env.fb_posts_root, dry_run,
+                                                                   self._media_pool.submit)
+            media_post_ids = self._finish_post_media(uploads.pop(fb_post[0]), 'fb')
+            parts, status = self._fb_status(fb_post, plans, media_post_ids, n, len(fb_posts), dry_run)
+            if status:
+                result.extend(self._mark_fb_post(fb_post[0], parts, self._mst.post_fb_status(*status), dry_run))
+            self._metrics.inc('posts')
+            self._metrics.tick()
+        self._metrics.report()
+        return result
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    def print_stat(self):
+        stat = self._metrics.stat() + [['Media uploaded', self._media_cache.uploaded],
+                                       ['Media uploads saved', self._media_cache.reused],
+                                       ['Interrupted requests resent', self._journal.resumed]]
+        print(tabulate(stat, headers=['Push', 'Count'], tablefmt='presto', disable_numparse=True,
+                       colalign=('left', 'right')))
+
+    @staticmethod
+    def _push_conditions(retry):
         if retry:
-            post_condition = '2'
-            media_condition = 'AND posted != 0'
-        else:
-            post_condition = '0'
-            media_condition = 'AND posted = 0'
+            return '2', 'AND posted != 0'
+        return '0', 'AND posted = 0'
 
+    def _fb_push_plan(self, retry):
+        # the posts to push, their status parts planned on load and the condition of their media to push
+        post_condition, media_condition = self._push_conditions(retry)
+        c = self._conn.cursor()
         c.execute('SELECT * FROM fb_posts WHERE posted = ?', (post_condition,))
-        fb_post_posted = 1
         fb_posts = c.fetchall()
-        fb_posts_count = len(fb_posts)
+        self._metrics.start('facebook', len(fb_posts))
+        return fb_posts, self._load_fb_parts(post_condition), media_condition
+
+    def _load_fb_parts(self, post_condition):
+        # status parts of the posts to push planned on load: post id -> [(part, text, posted, size limit)]
+        c = self._conn.cursor()
+        c.execute('SELECT p.post_id, p.part, p.text, p.posted, p.size_limit FROM fb_parts p JOIN fb_posts f '
+                  'ON f.id = p.post_id WHERE f.posted = ? ORDER BY p.post_id, p.part', (post_condition,))
+        plans = dict()
+        for post_id, part, text, posted, size_limit in c.fetchall():
+            plans.setdefault(post_id, list()).append((part, text, posted, size_limit))
+        return plans
+
+    def _fb_status(self, fb_post, plans, media_post_ids, n, count, dry_run):
+        # the post parts and the post_fb_status arguments, no status for a post without text and media
+        formatted_timestamp = strftime("%d-%m-%Y %H:%M:%S", localtime(fb_post[0]))
+        logging.debug(f'Dry-run {dry_run}. {n + 1}/{count} '
+                      f'Posting toot from {formatted_timestamp}: {fb_post[1][:20]}')
+        if fb_post[1] == '' and not media_post_ids:
+            return None, None
+        parts, texts, media_post_ids, in_reply_to = self._fb_post_parts(fb_post, plans, formatted_timestamp,
+                                                                        media_post_ids, dry_run)
+        return parts, (texts, media_post_ids, self._push_env.visibility, dry_run, in_reply_to,
+                       self._fb_keys(fb_post[0], parts, dry_run))
+
+    def _fb_post_parts(self, fb_post, plans, formatted_timestamp, media_post_ids, dry_run):
+        # Returns the post parts, texts of the parts still to post, media ids for them and the status they reply to.
+        # Posts loaded by an older version or planned for another size limit are split here.
+        header = f'{formatted_timestamp}\r'
+        limit = self._push_env.text_size_limit
+        parts = plans.pop(fb_post[0], None)
+        if not parts or (parts[0][3] != limit and all(part[2] == 0 for part in parts)):
+            parts = [(n, text, 0, limit) for n, text in enumerate(split_status(fb_post[1], limit, len(header)), 1)]
+            if not dry_run:
+                c = self._conn.cursor()
+                c.execute('DELETE FROM fb_parts WHERE post_id = ?', (fb_post[0],))
+                c.executemany('INSERT INTO fb_parts (post_id, part, text, size_limit) VALUES (?, ?, ?, ?)',
+                              [(fb_post[0], n, text, limit) for n, text, _, _ in parts])
+                self._conn.commit()
+        # a retry posts only the failed parts, they continue the thread
+        pending = [part for part in parts if part[2] == 0]
+        posted = [part for part in parts[:pending[0][0] - 1] if part[2] != 0] if pending else parts
+        in_reply_to = str(posted[-1][2]) if posted else '0'
+        texts = [header + text if n == 1 else text for n, text, _, _ in pending]
+        return parts, texts, media_post_ids if pending and pending[0][0] == 1 else None, in_reply_to
+
+    def _journal_key(self, source, item, dry_run):
+        # dry runs send nothing
+        return None if dry_run else self._journal.key(source, item)
+
+    def _fb_keys(self, fb_post_id, parts, dry_run):
+        return [self._journal_key('fb', f'{fb_post_id}/{part[0]}', dry_run) for part in parts if part[2] == 0]
+
+    def _mark_fb_post(self, fb_post_id, parts, post_ids, dry_run):
+        # returns the status ids of all post parts
+        new_ids = iter(post_ids)
+        part_ids = [next(new_ids) if part[2] == 0 else str(part[2]) for part in parts]
+        result_post_id = part_ids[0]
+        for post_id in part_ids:
+            if post_id == '0':
+                # to mark the post as partially posted if one of the parts failed
+                result_post_id = '2'
+                break
+        if not dry_run:
+            c = self._conn.cursor()
+            c.executemany('UPDATE fb_parts SET posted = ? WHERE post_id = ? AND part = ?',
+                          [(post_id, fb_post_id, part[0]) for part, post_id in zip(parts, part_ids) if part[2] == 0])
+            c.execute('UPDATE fb_posts SET posted = ? WHERE id = ?', (result_post_id, fb_post_id,))
+            self._conn.commit()
+            self._journal.done('fb', [f'{fb_post_id}/{part[0]}' for part in parts if part[2] == 0])
+            # media is attached to the first part
+            if post_ids and part_ids[0] != '0' and parts[0][2] == 0:
+                self._media_cache.attach('fb', fb_post_id)
+        return part_ids
+
+    def _mark_mst_post(self, mst_post_id, post_id, dry_run, source='mst'):
+        if post_id == '0':
+            post_id = '2'
+        if not dry_run:
+            c = self._conn.cursor()
+            c.execute(f'UPDATE {source}_posts SET posted = ? WHERE id = ?', (post_id, mst_post_id,))
+            self._conn.commit()
+            self._journal.done(source, [f'{mst_post_id}', f'{mst_post_id}/tags'])
+            if post_id != '2':
+                self._media_cache.attach(source, mst_post_id)
+        return post_id
+
+    @staticmethod
+    def _date_tags_text(text, post_date):
+        return (f'{" ".join(text.split()[:8])}...\n Posted #{strftime("day%d%b%Y", post_date)} '
+                f'#{strftime("%b%Y", post_date)} #{strftime("year%Y", post_date)}')
+
+    def _mst_push_order(self, parent_id, post_condition, source='mst'):
+        # All pending posts are loaded in one query and the thread forest is walked without recursion: every post
+        # comes right before its replies, siblings in the database order
+        c = self._conn.cursor()
+        c.execute(f'SELECT * FROM {source}_posts WHERE posted = ? ORDER BY id', (post_condition,))
+        replies = dict()
+        for mst_post in c.fetchall():
+            replies.setdefault(mst_post[1], list()).append(mst_post)
         result = list()
-        for fb_post in fb_posts:
-            formatted_timestamp = strftime("%d-%m-%Y %H:%M:%S", localtime(fb_post[0]))
-            media_post_ids = self._push_post_media(fb_post[0], media_condition, 'fb',
-                                                   self._load_env.fb_posts_dir, dry_run)
-            logging.info(f'Dry-run {dry_run}. {fb_post_posted}/{fb_posts_count} '
-                         f'Posting toot from {formatted_timestamp}: {fb_post[1][:20]}')
-            if fb_post[1] != '' or media_post_ids:
-                post_ids = self._mst.post_fb_status(f'{formatted_timestamp}\r{fb_post[1]}', media_post_ids,
-                                                    visibility=self._push_env.visibility, dry_run=dry_run)
-                result_post_id = post_ids[0]
-                for post_id in post_ids:
-                    if post_id == '0':
-                        # to mark the post as partially posted if one of the parts failed
-                        result_post_id = '2'
-                        break
-                if not dry_run:
-                    c.execute('UPDATE fb_posts SET posted = ? WHERE id = ?', (result_post_id, fb_post[0],))
-                    self._conn.commit()
-                result = result + post_ids
-                fb_post_posted += 1
+        stack = list(reversed(replies.pop(int(parent_id), [])))
+        while stack:
+            mst_post = stack.pop()
+            result.append(mst_post)
+            stack.extend(reversed(replies.pop(mst_post[0], [])))
         return result
 
     def push_mst_posts(self, parent_id='0', in_reply_to='0', dry_run=True, retry=False):
-        if parent_id != '0':
-            logging.info(f'Pushing reply for parent_id {parent_id}')
-        c = self._conn.cursor()
-        if retry:
-            post_condition = '2'
-            media_condition = 'AND posted != 0'
-        else:
-            post_condition = '0'
-            media_condition = 'AND posted = 0'
-
-        c.execute('SELECT * FROM mst_posts WHERE posted = ? and parent_id = ?',
-                  (post_condition, parent_id))
-        mst_posts = c.fetchall()
-        mst_post_posted = 1
-        mst_posts_count = len(mst_posts)
+        return self._push_threads('mst', parent_id, in_reply_to, dry_run, retry)
+
+    def push_tw_posts(self, dry_run=True, retry=False):
+        return self._push_threads('tw', '0', '0', dry_run, retry)
+
+    def _visibility(self, privacy):
+        # tweets have no visibility of their own
+        return privacy or self._push_env.visibility
+
+    def _push_threads(self, source, parent_id, in_reply_to, dry_run, retry):
+        mst_posts, media_condition, media_root = self._thread_push_plan(source, parent_id, retry)
+        # Mastodon status ids of the pushed posts the replies are sent to
+        reply_to = {int(parent_id): in_reply_to}
         result = list()
-        for mst_post in mst_posts:
-            media_post_ids = self._push_post_media(mst_post[0], media_condition, 'mst',
-                                                   self._load_env.mst_posts_dir, dry_run)
-            post_date = localtime(mst_post[2])
-
-            logging.info(f'Dry-run {dry_run}. {mst_post_posted}/{mst_posts_count} '
-                         f'Posting toot from {strftime("%d-%m-%Y %H:%M:%S", post_date)}: {mst_post[5][:20]}')
-            post_id = self._mst.post_mst_status(mst_post[5], mst_post[4], media_post_ids, mst_post[3], mst_post[6],
-                                                in_reply_to, dry_run)
-            if post_id == '0':
-                post_id = '2'
-            if not dry_run:
-                c.execute('UPDATE mst_posts SET posted = ? WHERE id = ?', (post_id, mst_post[0],))
-                self._conn.commit()
-            result.append(post_id)
-            mst_post_posted += 1
-            # Thread processing
-            if parent_id == '0' and self._push_env.date_tags and post_id != '2':
-                tagged_ext = (
-                    f'{" ".join(mst_post[5].split()[:8])}...\n Posted #{strftime("day%d%b%Y", post_date)} '
-                    f'#{strftime("%b%Y", post_date)} #{strftime("year%Y", post_date)}')
-                self._mst.post_mst_status(tagged_ext, mst_post[4], None, mst_post[3], mst_post[6], post_id, dry_run)
-            result = result + self.push_mst_posts(str(mst_post[0]), post_id, dry_run, retry)
+        for n, mst_post in enumerate(mst_posts):
+            media_post_ids = self._push_post_media(mst_post[0], media_condition, source, media_root, dry_run)
+            post_id = self._mst.post_mst_status(*self._thread_status(source, mst_post, media_post_ids, reply_to, n,
+                                                                     len(mst_posts), dry_run))
+            # Thread processing. The date tags reply is posted before the post is marked, a crash resends both
+            tags = self._date_tags_status(source, mst_post, post_id, dry_run)
+            if tags:
+                self._mst.post_mst_status(*tags)
+            reply_to[mst_post[0]] = self._mark_mst_post(mst_post[0], post_id, dry_run, source)
+            result.append(reply_to[mst_post[0]])
+            self._metrics.inc('posts')
+            self._metrics.tick()
+        self._metrics.report()
         return result
 
+    def _thread_push_plan(self, source, parent_id, retry):
+        # the posts to push in thread order, the condition of their media to push and the media root
+        post_condition, media_condition = self._push_conditions(retry)
+        mst_posts = self._mst_push_order(parent_id, post_condition, source)
+        self._metrics.start(_THREAD_SOURCES[source], len(mst_posts))
+        return mst_posts, media_condition, getattr(self._load_env, f'{source}_posts_root')
+
+    def _thread_status(self, source, mst_post, media_post_ids, reply_to, n, count, dry_run):
+        # post_mst_status arguments of the post, a reply is sent to the status of its parent
+        if mst_post[1]:
+            logging.debug(f'Pushing reply for parent_id {mst_post[1]}')
+        logging.debug(f'Dry-run {dry_run}. {n + 1}/{count} '
+                      f'Posting toot from {strftime("%d-%m-%Y %H:%M:%S", localtime(mst_post[2]))}: {mst_post[5][:20]}')
+        return (mst_post[5], mst_post[4], media_post_ids, self._visibility(mst_post[3]), mst_post[6],
+                reply_to[mst_post[1]], dry_run, self._journal_key(source, f'{mst_post[0]}', dry_run))
+
+    def _date_tags_status(self, source, mst_post, post_id, dry_run):
+        # post_mst_status arguments of the date tags reply to a pushed thread start, None if there is none
+        if mst_post[1] != 0 or not self._push_env.date_tags or post_id == '0':
+            return None
+        return (self._date_tags_text(mst_post[5], localtime(mst_post[2])), mst_post[4], None,
+                self._visibility(mst_post[3]), mst_post[6], post_id, dry_run,
+                self._journal_key(source, f'{mst_post[0]}/tags', dry_run))
+
     def _push_post_media(self, post_id, media_condition, media_source, media_root, dry_run=True):
-        media_post_ids = list()
-        c = self._conn.cursor()
-        c.execute(f'SELECT * FROM {media_source}_media WHERE post_id = ? {media_condition}', (post_id,))
-        post_medias = c.fetchall()
+        return self._finish_post_media(
+            self._start_post_media(post_id, media_condition, media_source, media_root, dry_run,
+                                   self._media_pool.submit), media_source)
+
+    def _start_post_media(self, post_id, media_condition, media_source, media_root, dry_run, submit):
+        # Starts the post media uploads with submit(func, *args), the media pool or the client pool of the engine.
+        # Returns (media row id, pending upload or posted media id) pairs
+        uploads = list()
+        post_medias = self._select_post_media(post_id, media_condition, media_source)
+        post_uploads = sum(1 for post_media in post_medias if post_media[3] == 0)
         for post_media in post_medias:
-            media_file = f'{media_root}/{post_media[2]}'
+            media_file = self._media_file(media_source, media_root, post_media[2])
             if post_media[3] == 0:
-                logging.info(f'Dry-run {dry_run}. Posting media {media_file}')
-                media_post_id = self._mst.upload_media(media_file, dry_run)
+                logging.debug(f'Dry-run {dry_run}. Posting media {media_file}')
+                uploads.append((post_media[0], submit(
+                    self._media_cache.upload, media_file, media_source, post_id,
+                    self._upload_media(media_source, post_media[0]), dry_run, post_uploads)))
             else:
-                media_post_id = post_media[3]
-            media_post_ids.append(media_post_id)
-            c.execute(f'UPDATE {media_source}_media SET posted = ? WHERE id = ?', (media_post_id, post_media[0],))
-            self._conn.commit()
-        return media_post_ids
+                uploads.append((post_media[0], post_media[3]))
+        return uploads
+
+    def _upload_media(self, media_source, media_row_id):
+        # the key is taken when the file is sent, uploads saved by the cache need none
+        def upload(media_file, dry_run):
+            return self._mst.upload_media(media_file, dry_run,
+                                          self._journal_key(media_source, f'media/{media_row_id}', dry_run))
+
+        return upload
+
+    def _select_post_media(self, post_id, media_condition, media_source):
+        c = self._conn.cursor()
+        c.execute(f'SELECT * FROM {media_source}_media WHERE post_id = ? {media_condition}', (post_id,))
+        return c.fetchall()
+
+    def _media_file(self, media_source, media_root, uri):
+        # optimized copy made by 'mevac optimize' with the current settings, if any
+        c = self._conn.cursor()
+        result = c.execute('SELECT path FROM media_optimized WHERE source = ? AND uri = ? AND settings = ?',
+                           (media_source, uri, MediaOptimizer.settings(self._load_env))).fetchone()
+        if result and result[0] and path.exists(result[0]):
+            return result[0]
+        return f'{media_root}/{uri}'
+
+    def _finish_post_media(self, uploads, media_source):
+        # waits for the post uploads, the status can be posted once all its media ids are known
+        return self._save_post_media(media_source, [(media_row_id, upload.result(), True) if isinstance(upload, Future)
+                                                    else (media_row_id, upload, False)
+                                                    for media_row_id, upload in uploads])
+
+    def _save_post_media(self, media_source, media):
+        # media: (media row id, media id, uploaded now) of the post, returns the media ids
+        c = self._conn.cursor()
+        c.executemany(f'UPDATE {media_source}_media SET posted = ? WHERE id = ?',
+                      [(media_post_id, media_row_id) for media_row_id, media_post_id, _ in media])
+        self._conn.commit()
+        self._journal.done(media_source, [f'media/{media_row_id}' for media_row_id, _, uploaded in media if uploaded])
+        return [media_post_id for _, media_post_id, _ in media]
+
+
+class AsyncPusher(Pusher):
+    # asyncio push engine. Keeps the same posted state in the DB as Pusher, a migration can be resumed with either
+    # engine. Media of the upcoming posts is uploaded concurrently within the global budget, statuses are posted in
+    # order, so the timeline order is the same
+
+    def __init__(self, load_env: LoadEnv, push_env: PushEnv, metrics_file=None):
+        super().__init__(load_env, push_env, metrics_file)
+        self._amst = AsyncMastodon(self._mst, push_env.async_concurrency)
+
+    def push_fb_posts(self, dry_run=True, retry=False):
+        return asyncio.run(self._push_fb_posts(dry_run, retry))
+
+    def push_mst_posts(self, parent_id='0', in_reply_to='0', dry_run=True, retry=False):
+        return asyncio.run(self._push_threads_async('mst', parent_id, in_reply_to, dry_run, retry))
+
+    def push_tw_posts(self, dry_run=True, retry=False):
+        return asyncio.run(self._push_threads_async('tw', '0', '0', dry_run, retry))
+
+    async def _push_fb_posts(self, dry_run, retry):
+        fb_posts, plans, media_condition = self._fb_push_plan(retry)
+        window = self._push_env.async_concurrency * 2
+        result = list()
+        uploads = dict()
+        for n, fb_post in enumerate(fb_posts):
+            for next_post in fb_posts[n:n + window]:
+                if next_post[0] not in uploads:
+                    uploads[next_post[0]] = asyncio.create_task(self._upload_post_media(
+                        next_post[0], media_condition, 'fb', self._load_env.fb_posts_root, dry_run))
+            parts, status = self._fb_status(fb_post, plans, await uploads.pop(fb_post[0]), n, len(fb_posts), dry_run)
+            if status:
+                await self._amst.wait_for_media(status[1])
+                post_ids = await self._amst.post_fb_status(*status)
+                result.extend(self._mark_fb_post(fb_post[0], parts, post_ids, dry_run))
+            self._metrics.inc('posts')
+            self._metrics.tick()
+        self._metrics.report()
+        return result
+
+    async def _push_threads_async(self, source, parent_id, in_reply_to, dry_run, retry):
+        mst_posts, media_condition, media_root = self._thread_push_plan(source, parent_id, retry)
+        window = self._push_env.async_concurrency * 2
+        reply_to = {int(parent_id): in_reply_to}
+        result = list()
+        uploads = dict()
+        for n, mst_post in enumerate(mst_posts):
+            # media of the upcoming posts is uploaded concurrently, across thread levels
+            for next_post in mst_posts[n:n + window]:
+                if next_post[0] not in uploads:
+                    uploads[next_post[0]] = asyncio.create_task(self._upload_post_media(
+                        next_post[0], media_condition, source, media_root, dry_run))
+            status = self._thread_status(source, mst_post, await uploads.pop(mst_post[0]), reply_to, n,
+                                         len(mst_posts), dry_run)
+            await self._amst.wait_for_media(status[2])
+            post_id = await self._amst.post_mst_status(*status)
+            tags = self._date_tags_status(source, mst_post, post_id, dry_run)
+            if tags:
+                await self._amst.post_mst_status(*tags)
+            reply_to[mst_post[0]] = self._mark_mst_post(mst_post[0], post_id, dry_run, source)
+            result.append(reply_to[mst_post[0]])
+            self._metrics.inc('posts')
+            self._metrics.tick()
+        self._metrics.report()
+        return result
+
+    async def _upload_post_media(self, post_id, media_condition, media_source, media_root, dry_run=True):
+        # the DB is only touched from the event loop thread, uploads run in the client pool
+        uploads = self._start_post_media(post_id, media_condition, media_source, media_root, dry_run,
+                                         lambda *args: asyncio.ensure_future(self._amst.run(*args)))
+        return self._save_post_media(media_source, [(media_row_id, await upload, True)
+                                                    if isinstance(upload, asyncio.Future)
+                                                    else (media_row_id, upload, False)
+                                                    for media_row_id, upload in uploads])
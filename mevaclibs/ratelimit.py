@@ -0,0 +1,68 @@
+import datetime
+import logging
+import threading
+import time
+
+from mevaclibs.common import Utils
+
+
+class _Bucket:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.reset = 0.0
+        self.next_slot = 0.0
+
+
+class RateLimiter:
+    # Paces API calls from the live x-ratelimit-* headers instead of waiting for 429. Every bucket (group of
+    # endpoints limited together by the server) spreads its remaining calls evenly until the window reset.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = dict()
+
+    def _bucket(self, name):
+        with self._lock:
+            return self._buckets.setdefault(name, _Bucket())
+
+    def acquire(self, name):
+        # Blocks until a call from the bucket can be sent, returns the time slept
+        bucket = self._bucket(name)
+        with bucket.lock:
+            now = time.time()
+            if bucket.remaining is None or bucket.reset <= now:
+                # nothing known about the current window yet, the response headers will tell
+                return 0
+            if bucket.remaining > 0:
+                slot = max(now, bucket.next_slot)
+                bucket.next_slot = slot + (bucket.reset - slot) / bucket.remaining
+                bucket.remaining -= 1
+            else:
+                # waiting calls are released one per second after the reset until new headers arrive
+                slot = max(bucket.reset, bucket.next_slot)
+                bucket.next_slot = slot + 1
+                logging.warning(f'API rate-limit for {name} reached. Sleeping for: '
+                                f'{datetime.timedelta(seconds=int(slot - now))}')
+        wait = slot - now
+        if wait > 0:
+            time.sleep(wait)
+            return wait
+        return 0
+
+    def update(self, name, headers):
+        remaining = headers.get('x-ratelimit-remaining')
+        reset = headers.get('x-ratelimit-reset')
+        if remaining is None or reset is None:
+            return
+        bucket = self._bucket(name)
+        with bucket.lock:
+            bucket.remaining = int(remaining)
+            bucket.reset = Utils.mastodon_timestamp_to_epoch(reset) + 1
+
+    def exhaust(self, name):
+        # 429 received, wait for the window reset before the next call
+        bucket = self._bucket(name)
+        with bucket.lock:
+            bucket.remaining = 0
+            if bucket.reset <= time.time():
+                bucket.reset = time.time() + 60
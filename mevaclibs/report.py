@@ -0,0 +1,175 @@
+from mevaclibs.text import split_status
+from time import gmtime, strftime, localtime
+
+# Counters kept up to date by triggers on every insert, delete and posted state change, so the report reads a few
+# hundred counter rows instead of scanning the archive tables.
+# counter -> (table, condition, month of the row, size limit of the row), NEW/OLD is substituted for {row}
+_COUNTERS = {
+    'fb_posts': ('fb_posts', '1', "strftime('%Y-%m', {row}.id, 'unixepoch')", '0'),
+    'fb_statuses': ('fb_parts', '1', "strftime('%Y-%m', {row}.post_id, 'unixepoch')", '0'),
+    # first parts are the posts planned on load, by the size limit they were planned for
+    'fb_plans': ('fb_parts', '{row}.part = 1', "strftime('%Y-%m', {row}.post_id, 'unixepoch')", '{row}.size_limit'),
+    'fb_long': ('fb_parts', '{row}.part = 2', "strftime('%Y-%m', {row}.post_id, 'unixepoch')", '0'),
+    'fb_media': ('fb_media', '1', "strftime('%Y-%m', {row}.post_id, 'unixepoch')", '0'),
+    'mst_posts': ('mst_posts', '1', "strftime('%Y-%m', {row}.original_date, 'unixepoch')", '0'),
+    # the post is written before its media on load
+    'mst_media': ('mst_media', '1', "(SELECT strftime('%Y-%m', original_date, 'unixepoch') FROM mst_posts "
+                                    "WHERE id = {row}.post_id)", '0'),
+    'tw_posts': ('tw_posts', '1', "strftime('%Y-%m', {row}.original_date, 'unixepoch')", '0'),
+    'tw_media': ('tw_media', '1', "(SELECT strftime('%Y-%m', original_date, 'unixepoch') FROM tw_posts "
+                                  "WHERE id = {row}.post_id)", '0'),
+}
+# posted is 0 before the push, 2 if the push failed (some of the parts for a long post) and the status id after it
+PENDING = 0
+PUSHED = 1
+FAILED = 2
+_STATE = 'CASE {row}.posted WHEN 0 THEN 0 WHEN 2 THEN 2 ELSE 1 END'
+
+
+class Report:
+    # Archive statistics from the counters: totals by push state and a breakdown by year or month.
+    # Statuses are counted for the current text size limit, posts planned on load for another limit (or loaded by an
+    # older version) are split again here, as the pusher does.
+
+    def __init__(self, conn, text_size_limit, period='year'):
+        self._conn = conn
+        self._text_size_limit = text_size_limit
+        self._period = period
+        self.prepare_db(conn)
+
+    @staticmethod
+    def prepare_db(conn):
+        # Creates the counters and the triggers of the archive tables which exist, counters of a table are filled
+        # from its rows once, when its triggers are created
+        c = conn.cursor()
+        c.execute('CREATE TABLE IF NOT EXISTS stat_counters (counter TEXT, month TEXT, state INTEGER, '
+                  'size_limit INTEGER, count INTEGER, PRIMARY KEY (counter, month, state, size_limit))')
+        tables = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        triggers = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+        for table in sorted({table for table, _, _, _ in _COUNTERS.values()}):
+            if table not in tables or f'stat_{table}_insert' in triggers:
+                continue
+            counters = {counter: spec[1:] for counter, spec in _COUNTERS.items() if spec[0] == table}
+            c.execute(f'CREATE TRIGGER stat_{table}_insert AFTER INSERT ON {table} BEGIN '
+                      f'{Report._count_sql(counters, "NEW", "+")} END')
+            c.execute(f'CREATE TRIGGER stat_{table}_delete AFTER DELETE ON {table} BEGIN '
+                      f'{Report._count_sql(counters, "OLD", "-")} END')
+            c.execute(f'CREATE TRIGGER stat_{table}_update AFTER UPDATE OF posted ON {table} '
+                      f'WHEN {_STATE.format(row="OLD")} != {_STATE.format(row="NEW")} BEGIN '
+                      f'{Report._count_sql(counters, "OLD", "-")} {Report._count_sql(counters, "NEW", "+")} END')
+            # one aggregate pass per counter over the rows loaded before the triggers existed
+            for counter, (condition, month, size_limit) in counters.items():
+                c.execute(f"INSERT INTO stat_counters (counter, month, state, size_limit, count) "
+                          f"SELECT ?, COALESCE({month.format(row=table)}, ''), {_STATE.format(row=table)}, "
+                          f"{size_limit.format(row=table)}, COUNT (*) FROM {table} "
+                          f"WHERE {condition.format(row=table)} GROUP BY 2, 3, 4", (counter,))
+        conn.commit()
+
+    @staticmethod
+    def _count_sql(counters, row, sign):
+        # one upsert per counter of the table, SELECT ... WHERE adds nothing for rows out of the counter condition
+        return ' '.join(f"INSERT INTO stat_counters (counter, month, state, size_limit, count) "
+                        f"SELECT '{counter}', COALESCE({month.format(row=row)}, ''), {_STATE.format(row=row)}, "
+                        f"{size_limit.format(row=row)}, {sign}1 WHERE {condition.format(row=row)} "
+                        f"ON CONFLICT (counter, month, state, size_limit) DO UPDATE SET count = count {sign} 1;"
+                        for counter, (condition, month, size_limit) in counters.items())
+
+    def _counters(self, prefix):
+        # counter -> period -> state -> count, first parts planned for another size limit are also in fb_plans_stale
+        result = dict()
+        c = self._conn.cursor()
+        c.execute('SELECT counter, month, state, size_limit, count FROM stat_counters WHERE counter LIKE ? '
+                  'AND count != 0', (f'{prefix}_%',))
+        for counter, month, state, size_limit, count in c.fetchall():
+            period = month[:4] if self._period == 'year' else month
+            states = result.setdefault(counter, dict()).setdefault(period or 'unknown', dict())
+            states[state] = states.get(state, 0) + count
+            if counter == 'fb_plans' and size_limit != self._text_size_limit:
+                states = result.setdefault('fb_plans_stale', dict()).setdefault(period or 'unknown', dict())
+                states[state] = states.get(state, 0) + count
+        return result
+
+    @staticmethod
+    def _total(counters, counter, *states):
+        return sum(count for period in counters.get(counter, {}).values()
+                   for state, count in period.items() if not states or state in states)
+
+    def _fb_replanned(self):
+        # Posts the pusher splits again: post period -> (posts, pending statuses planned, statuses now).
+        # Only read when the counters show such posts, it is a scan of the posts table
+        result = dict()
+        c = self._conn.cursor()
+        c.execute('SELECT f.id, f.text, (SELECT COUNT (*) FROM fb_parts WHERE post_id = f.id) FROM fb_posts f '
+                  'LEFT JOIN fb_parts p ON p.post_id = f.id AND p.part = 1 WHERE f.posted IN (0, 2) AND '
+                  '(p.post_id IS NULL OR (p.size_limit != ? AND NOT EXISTS (SELECT 1 FROM fb_parts '
+                  'WHERE post_id = f.id AND posted != 0)))', (self._text_size_limit,))
+        for post_id, text, planned in c.fetchall():
+            header = f'{strftime("%d-%m-%Y %H:%M:%S", localtime(post_id))}\r'
+            # the counters are kept by UTC months
+            period = strftime('%Y' if self._period == 'year' else '%Y-%m', gmtime(post_id))
+            posts, before, after = result.get(period, (0, 0, 0))
+            result[period] = (posts + 1, before + planned,
+                              after + len(split_status(text, self._text_size_limit, len(header))))
+        return result
+
+    def facebook(self):
+        # returns (posts rows, media rows, period rows)
+        counters = self._counters('fb')
+        # posts planned for another size limit or loaded by an older version without the parts
+        replan = (self._total(counters, 'fb_plans_stale', PENDING) or
+                  self._total(counters, 'fb_posts') > self._total(counters, 'fb_plans'))
+        replanned = self._fb_replanned() if replan else dict()
+        # difference of the statuses split for the current limit and the ones planned on load
+        replanned_statuses = sum(after - before for _, before, after in replanned.values())
+        statuses_to_push = self._total(counters, 'fb_statuses', PENDING) + replanned_statuses
+        media_to_push = self._total(counters, 'fb_media', PENDING)
+        posts = [['Imported', self._total(counters, 'fb_posts')],
+                 ['Pushed', self._total(counters, 'fb_posts', PUSHED, FAILED)],
+                 ['Partially pushed', self._total(counters, 'fb_posts', FAILED)],
+                 ['Not pushed', self._total(counters, 'fb_posts', PENDING)],
+                 ['Long posts', self._total(counters, 'fb_long')],
+                 ['Split again on push', sum(posts for posts, _, _ in replanned.values())],
+                 ['Statuses', self._total(counters, 'fb_statuses') + replanned_statuses],
+                 ['Statuses to push', statuses_to_push],
+                 # one call per status part and per media upload, rate-limit pauses and media polling excluded
+                 ['API calls to push', statuses_to_push + media_to_push]]
+        media = [['Imported', self._total(counters, 'fb_media')],
+                 ['Pushed', self._total(counters, 'fb_media', PUSHED, FAILED)],
+                 ['Not pushed', media_to_push]]
+        periods = list()
+        for period in sorted(set(counters.get('fb_posts', {})) | set(counters.get('fb_media', {}))):
+            states = counters.get('fb_posts', {}).get(period, {})
+            media_states = counters.get('fb_media', {}).get(period, {})
+            _, before, after = replanned.get(period, (0, 0, 0))
+            periods.append([period, sum(states.values()), states.get(PUSHED, 0) + states.get(FAILED, 0),
+                            states.get(FAILED, 0),
+                            counters.get('fb_statuses', {}).get(period, {}).get(PENDING, 0) + after - before,
+                            sum(media_states.values()), media_states.get(PUSHED, 0) + media_states.get(FAILED, 0)])
+        return posts, media, periods
+
+    def mastodon(self):
+        # returns (posts rows, media rows, period rows)
+        return self._threads('mst')
+
+    def twitter(self):
+        return self._threads('tw')
+
+    def _threads(self, source):
+        # Posts pushed one status each, Mastodon and Twitter. As for Facebook, pushed posts and media are the ones the
+        # push has reached, failed ones included
+        counters = self._counters(source)
+        posts = [['Imported', self._total(counters, f'{source}_posts')],
+                 ['Pushed', self._total(counters, f'{source}_posts', PUSHED, FAILED)],
+                 ['Failed', self._total(counters, f'{source}_posts', FAILED)],
+                 ['Not pushed', self._total(counters, f'{source}_posts', PENDING)]]
+        media = [['Imported', self._total(counters, f'{source}_media')],
+                 ['Pushed', self._total(counters, f'{source}_media', PUSHED, FAILED)],
+                 ['Not pushed', self._total(counters, f'{source}_media', PENDING)]]
+        periods = list()
+        for period in sorted(set(counters.get(f'{source}_posts', {})) | set(counters.get(f'{source}_media', {}))):
+            states = counters.get(f'{source}_posts', {}).get(period, {})
+            media_states = counters.get(f'{source}_media', {}).get(period, {})
+            periods.append([period, sum(states.values()), states.get(PUSHED, 0) + states.get(FAILED, 0),
+                            states.get(FAILED, 0),
+                            sum(media_states.values()), media_states.get(PUSHED, 0) + media_states.get(FAILED, 0)])
+        return posts, media, periods
@@ -0,0 +1,80 @@
+import json
+import re
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class JsonStream:
+    # Incremental reader for archive JSON files. Yields the items of a top-level array (or of an array stored under
+    # a top-level key) one by one, keeping only the current item and one read chunk in memory.
+    def __init__(self, file, chunk_size=65536):
+        self._file = file
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def items(self, key=None):
+        if key is not None:
+            self._expect('{')
+            while True:
+                if self._peek() in ('}', ''):
+                    return
+                name = self._next_value()
+                self._expect(':')
+                if name == key:
+                    break
+                self._next_value()
+                if self._peek() == ',':
+                    self._pos += 1
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._next_value()
+            char = self._peek()
+            self._pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise Exception(f'Malformed JSON array: unexpected {char!r} after item')
+
+    def _fill(self, size):
+        chunk = self._file.read(size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill(self._chunk_size):
+                return ''
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise Exception(f'Malformed JSON: expected {char!r} at offset {self._pos}')
+        self._pos += 1
+
+    def _next_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # incomplete item, read more. Growing the read size with the pending data keeps re-parsing linear
+                if not self._fill(max(self._chunk_size, len(self._buffer) - self._pos)):
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self._buffer) and not self._eof and self._fill(self._chunk_size):
+                continue
+            self._pos = end
+            return value
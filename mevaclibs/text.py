@@ -0,0 +1,115 @@
+import html
+import re
+
+# Mastodon counts every link as 23 characters and a remote mention without its domain
+URL_LENGTH = 23
+_URL = re.compile(r'https?://\S+?(?=[.,:;!?\'")\]]*(?:\s|$))')
+_MENTION = re.compile(r'(@\w+)@[\w-]+(?:\.[\w-]+)+')
+
+
+def status_length(text):
+    # length of the text as counted by the Mastodon status validator
+    size = len(text)
+    for match in _URL.finditer(text):
+        size += URL_LENGTH - len(match.group())
+    for match in _MENTION.finditer(_URL.sub('', text)):
+        size -= len(match.group()) - len(match.group(1))
+    return size
+
+
+def _part_room(limit, reserve, part_number):
+    # characters left for the words of the part after its "N. -> " prefix
+    prefix = len(f'{part_number}. ') + (3 if part_number > 1 else 0)
+    return limit - prefix - (reserve if part_number == 1 else 0)
+
+
+def _part_text(part_number, words):
+    return f'{part_number}. {"-> " if part_number > 1 else ""}{" ".join(words)}'
+
+
+def split_status(text, limit, reserve=0):
+    # Splits a text over the status size limit into numbered parts "1. ...", "2. -> ...", the first part keeps
+    # `reserve` characters for a header added on push. Words are kept whole unless a single word is longer than a part.
+    # One pass over the words, the length of a part is counted as the words are added.
+    if status_length(text) + reserve <= limit:
+        return [text]
+    parts = list()
+    words = list()
+    size = 0
+    room = _part_room(limit, reserve, 1)
+    for word in text.split(' '):
+        # only links and mentions are counted differently
+        weight = status_length(word) if ':' in word or '@' in word else len(word)
+        if words and size + 1 + weight > room:
+            parts.append(_part_text(len(parts) + 1, words))
+            room = _part_room(limit, reserve, len(parts) + 1)
+            words = list()
+            size = 0
+        cut = False
+        while weight > room and word:
+            # a cut link still counts in full, the piece is shortened so it fits anyway
+            cut = max(room - URL_LENGTH if _URL.search(word) and room > 2 * URL_LENGTH else room, 1)
+            parts.append(_part_text(len(parts) + 1, [word[:cut]]))
+            room = _part_room(limit, reserve, len(parts) + 1)
+            word = word[cut:]
+            weight = status_length(word)
+        if word or not cut:
+            size += weight + (1 if words else 0)
+            words.append(word)
+    if words:
+        parts.append(_part_text(len(parts) + 1, words))
+    return parts
+
+
+# Mastodon status HTML: tags (attribute values may contain '>'), comments and declarations end a text node
+_HTML_TAG = re.compile(r'<(?:!--.*?(?:--!?>|$)|(/?)([a-zA-Z][^\s/>]*)(?:[^>"\']|"[^"]*"|\'[^\']*\')*>|[!?][^>]*>)',
+                       re.S)
+_HTML_SPACES = re.compile(r'[ \t\n\r\f]*')
+_HTML_PRESERVE = ('pre', 'textarea')
+_HTML_VOID = ('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta', 'param',
+              'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer')
+
+
+def html_to_text(content):
+    # Text of the status HTML, same as BeautifulSoup(content, 'html.parser').get_text(separator='\n'): every text
+    # node on its own line, whitespace-only nodes collapsed to a space or a newline, except in <pre>.
+    # One scan over the tags instead of building a tree, made for the small tag set Mastodon produces.
+    strings = list()
+    # open elements, only to know when a <pre> is closed by the end tag of its parent
+    stack = list()
+    # <br> etc. are closed on the start tag, a later </br> is dropped without ending the text node
+    closed_void = list()
+    text = list()
+    position = 0
+    for tag in _HTML_TAG.finditer(content):
+        text.append(content[position:tag.start()])
+        position = tag.end()
+        name = tag.group(2) and tag.group(2).lower()
+        if tag.group(1) and name in closed_void:
+            closed_void.remove(name)
+            continue
+        if any(text):
+            strings.append(_html_string(''.join(text), stack))
+        text = list()
+        if not name:
+            continue
+        if tag.group(1):
+            if name in stack:
+                del stack[len(stack) - 1 - stack[::-1].index(name):]
+        elif name in _HTML_VOID:
+            if not tag.group().endswith('/>'):
+                closed_void.append(name)
+        elif not tag.group().endswith('/>'):
+            stack.append(name)
+    text.append(content[position:])
+    if any(text):
+        strings.append(_html_string(''.join(text), stack))
+    return '\n'.join(strings)
+
+
+def _html_string(data, stack):
+    if '&' in data:
+        data = html.unescape(data)
+    if _HTML_SPACES.fullmatch(data) and not any(name in _HTML_PRESERVE for name in stack):
+        return '\n' if '\n' in data else ' '
+    return data
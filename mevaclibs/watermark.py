@@ -0,0 +1,108 @@
+import hashlib
+import io
+import os
+import sqlite3
+from contextlib import contextmanager
+from mevaclibs.archive import file_stat, open_file
+from mevaclibs.common import Utils
+
+
+class Watermark:
+    # Load state of a source (facebook, mastodon) for incremental re-loads: the date range of the items loaded by
+    # complete loads and the fingerprint (size, mtime, SHA-256) of every archive file read. Unchanged files are not
+    # read again, items of a changed file dated inside the loaded range are dropped before they are parsed. The state
+    # is saved after a complete load only, an interrupted one is redone in full.
+    # A file is read once: the digest of a loaded file is taken as it is loaded, a file is only hashed by itself to
+    # confirm a matching size and mtime.
+    # A newer archive holds every post of its date range, so the range grows with overlapping loads. An archive of a
+    # disjoint date range replaces it: items between the two ranges may be missing in both.
+
+    def __init__(self, conn: sqlite3.Connection, source, enabled=True):
+        self._conn = conn
+        self._source = source
+        self._enabled = enabled
+        self._files = dict()
+        self._read_first = None
+        self._read_last = None
+        self.skipped_files = 0
+        self.skipped_items = 0
+        c = conn.cursor()
+        c.execute('CREATE TABLE IF NOT EXISTS load_watermarks (source TEXT PRIMARY KEY, first_date INTEGER, '
+                  'last_date INTEGER, loaded INTEGER)')
+        c.execute('CREATE TABLE IF NOT EXISTS load_files (source TEXT, file TEXT, size INTEGER, mtime INTEGER, '
+                  'digest TEXT, PRIMARY KEY (source, file))')
+        conn.commit()
+        c.execute('SELECT first_date, last_date FROM load_watermarks WHERE source = ?', (source,))
+        self.first, self.last = c.fetchone() or (None, None)
+        c.execute('SELECT file, size, mtime, digest FROM load_files WHERE source = ?', (source,))
+        self._stored = {file: (size, mtime, digest) for file, size, mtime, digest in c.fetchall()}
+
+    def unchanged(self, file_name):
+        if not self._enabled:
+            return False
+        size, mtime = file_stat(file_name)
+        key = os.path.basename(file_name)
+        stored = self._stored.get(key)
+        if not stored or stored[:2] != (size, mtime) or stored[2] != Utils.file_digest(file_name):
+            return False
+        self._files[key] = stored
+        self.skipped_files += 1
+        return True
+
+    @contextmanager
+    def open(self, file_name):
+        # text stream of the file to load, the fingerprint is saved with the digest of what was read
+        with open_file(file_name, 'rb') as file:
+            reader = _DigestReader(file)
+            yield io.TextIOWrapper(io.BufferedReader(reader), encoding='utf-8')
+            self._files[os.path.basename(file_name)] = (*file_stat(file_name), reader.digest())
+
+    def seen(self, date):
+        # True for items loaded before, dates of all read items make the range of this load
+        if date is None:
+            return False
+        self._read_first = date if self._read_first is None else min(self._read_first, date)
+        self._read_last = date if self._read_last is None else max(self._read_last, date)
+        # items of the last date can be more than one, they are loaded again and ignored as duplicates
+        if self._enabled and self.first is not None and self.first <= date < self.last:
+            self.skipped_items += 1
+            return True
+        return False
+
+    def save(self):
+        first, last = self.first, self.last
+        if self._read_first is not None:
+            if first is None or self._read_first > last or self._read_last < first:
+                first, last = self._read_first, self._read_last
+            else:
+                first, last = min(first, self._read_first), max(last, self._read_last)
+        c = self._conn.cursor()
+        c.execute('INSERT OR REPLACE INTO load_watermarks (source, first_date, last_date, loaded) '
+                  "VALUES (?, ?, ?, strftime('%s', 'now'))", (self._source, first, last))
+        c.executemany('INSERT OR REPLACE INTO load_files (source, file, size, mtime, digest) VALUES (?, ?, ?, ?, ?)',
+                      [(self._source, key, *fingerprint) for key, fingerprint in self._files.items()])
+        self._conn.commit()
+        self.first, self.last = first, last
+
+
+class _DigestReader(io.RawIOBase):
+    # binary stream hashing the bytes read through it
+
+    def __init__(self, file):
+        self._file = file
+        self._sha = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._file.read(len(buffer))
+        buffer[:len(data)] = data
+        self._sha.update(data)
+        return len(data)
+
+    def digest(self):
+        # the rest after the last item is not read by the loader
+        for chunk in iter(lambda: self._file.read(1024 * 1024), b''):
+            self._sha.update(chunk)
+        return self._sha.hexdigest()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# Load benchmark: loads synthetic archives (tests/synth.py) with FbImporter, MstImporter and TwImporter and records
+# the load time, peak memory and the database size. Not collected by pytest.
+#   python tests/bench_load.py --sizes 10k,100k --json before.json
+#   python tests/bench_load.py --sizes 10k,100k --compare before.json
+# Every load runs in a fresh process on a new database, archives are generated once into --data-dir.
+import argparse
+import json
+import logging
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+from os import path
+from tabulate import tabulate
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+import synth  # noqa: E402
+
+_TABLES = {'facebook': ('fb_posts', 'fb_media'), 'mastodon': ('mst_posts', 'mst_media'),
+           'twitter': ('tw_posts', 'tw_media')}
+
+
+def _archive(data_dir, archive_type, size, seed):
+    archive_dir = f'{data_dir}/{archive_type}-{size}-{seed}'
+    if not path.exists(f'{archive_dir}/.done'):
+        logging.info(f'Generating {archive_type} archive of {size} posts in {archive_dir}')
+        if archive_type == 'facebook':
+            synth.fb_archive(archive_dir, size, seed=seed)
+        elif archive_type == 'twitter':
+            synth.tw_archive(archive_dir, size, seed=seed)
+        else:
+            synth.mst_archive(archive_dir, size, seed=seed)
+        open(f'{archive_dir}/.done', 'w').close()
+    return archive_dir
+
+
+def _child(archive_type, archive_dir, db_file):
+    # runs in a fresh process: one load, the result is printed as JSON for the parent
+    os.environ.update(FB_POSTS_DIR=archive_dir, MST_POSTS_DIR=archive_dir, TW_POSTS_DIR=archive_dir, DB_FILE=db_file)
+    from mevaclibs.envs import LoadEnv
+    from mevaclibs.importers import FbImporter, MstImporter, TwImporter
+    start = time.time()
+    if archive_type == 'facebook':
+        FbImporter(LoadEnv()).load_fb_posts(False)
+    elif archive_type == 'twitter':
+        TwImporter(LoadEnv()).load_tw_posts(False)
+    else:
+        MstImporter(LoadEnv()).load_mst_posts(False)
+    seconds = time.time() - start
+    conn = sqlite3.connect(db_file)
+    posts, media = (conn.execute(f'SELECT COUNT (*) FROM {table}').fetchone()[0] for table in _TABLES[archive_type])
+    # ru_maxrss is in KB on Linux, the workers are counted by the largest one
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print(json.dumps({'seconds': seconds, 'posts': posts, 'media': media, 'peak_rss_mb': rss / 1024}))
+
+
+def _run(archive_type, archive_dir, db_file):
+    for file_name in (db_file, f'{db_file}-wal', f'{db_file}-shm'):
+        if path.exists(file_name):
+            os.remove(file_name)
+    output = subprocess.run([sys.executable, path.abspath(__file__), '--child', archive_type, archive_dir, db_file],
+                            check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    result['db_mb'] = sum(path.getsize(file_name) for file_name in (db_file, f'{db_file}-wal')
+                          if path.exists(file_name)) / 1024 / 1024
+    return result
+
+
+def _delta(value, baseline):
+    if not baseline:
+        return ''
+    return f'{(value - baseline) / baseline * 100:+.1f}%'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark archive loading.')
+    parser.add_argument('--sizes', default='10k,100k', help='Archive sizes, e.g. 10k,100k,1m')
+    parser.add_argument('--types', default='facebook,mastodon', help='Archive types: facebook,mastodon,twitter')
+    parser.add_argument('--repeat', type=int, default=1, help='Loads per archive, the fastest one is reported')
+    parser.add_argument('--seed', type=int, default=1, help='Archive random seed')
+    parser.add_argument('--data-dir', default='/tmp/mevac-bench', help='Archives and databases directory')
+    parser.add_argument('--json', dest='json_file', help='Save the results to a JSON file')
+    parser.add_argument('--compare', help='Results JSON file to compare with')
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=os.environ.get('LOGLEVEL', 'INFO').upper())
+    if args.child:
+        logging.getLogger().setLevel(logging.ERROR)
+        _child(*args.child)
+        return
+
+    baseline = dict()
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = {(result['type'], result['size']): result for result in json.load(file)}
+    results = list()
+    for archive_type in args.types.split(','):
+        for size in (synth.parse_size(size) for size in args.sizes.split(',')):
+            archive_dir = _archive(args.data_dir, archive_type, size, args.seed)
+            runs = [_run(archive_type, archive_dir, f'{args.data_dir}/{archive_type}-{size}.db')
+                    for _ in range(max(args.repeat, 1))]
+            result = dict(min(runs, key=lambda run: run['seconds']), type=archive_type, size=size,
+                          workers=int(os.environ.get('LOAD_WORKERS', os.cpu_count() or 1)))
+            logging.info(f'Loaded {archive_type} {size}: {result["seconds"]:.1f}s')
+            results.append(result)
+
+    rows = list()
+    for result in results:
+        base = baseline.get((result['type'], result['size']), {})
+        rows.append([result['type'], result['size'], result['posts'], f'{result["seconds"]:.2f}',
+                     _delta(result['seconds'], base.get('seconds')), f'{result["posts"] / result["seconds"]:.0f}',
+                     f'{result["peak_rss_mb"]:.0f}', _delta(result['peak_rss_mb'], base.get('peak_rss_mb')),
+                     f'{result["db_mb"]:.1f}', _delta(result['db_mb'], base.get('db_mb'))])
+    print(tabulate(rows, headers=['Archive', 'Size', 'Posts loaded', 'Load, s', 'Δ', 'Posts/s', 'Peak RSS, MB', 'Δ',
+                                  'DB, MB', 'Δ'], tablefmt='presto', disable_numparse=True,
+                   colalign=('left',) + ('right',) * 9))
+    if args.json_file:
+        with open(args.json_file, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Push benchmark: loads a synthetic archive with media (tests/synth.py) and pushes it to the local fake Mastodon
+# server (tests/fake_mastodon.py), end to end through Pusher or AsyncPusher. Not collected by pytest.
+#   python tests/bench_push.py --size 2k --latency 0.05 --json before.json
+#   python tests/bench_push.py --size 2k --latency 0.05 --async --compare before.json
+#   python tests/bench_push.py --size 500 --status-limit 300/60 --media-delay 2 --fail-5xx 0.01
+# MASTODON_* settings (media workers, lookahead, concurrency) are taken from the environment.
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from os import path
+from tabulate import tabulate
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+import synth  # noqa: E402
+from fake_mastodon import FakeMastodon  # noqa: E402
+
+
+def _archive(data_dir, archive_type, size, seed):
+    archive_dir = f'{data_dir}/{archive_type}-{size}-{seed}-media'
+    if not path.exists(f'{archive_dir}/.done'):
+        logging.info(f'Generating {archive_type} archive of {size} posts with media in {archive_dir}')
+        if archive_type == 'facebook':
+            synth.fb_archive(archive_dir, size, seed=seed, media_files=True)
+        elif archive_type == 'twitter':
+            synth.tw_archive(archive_dir, size, seed=seed, media_files=True)
+        else:
+            synth.mst_archive(archive_dir, size, seed=seed, media_files=True)
+        open(f'{archive_dir}/.done', 'w').close()
+    return archive_dir
+
+
+def _limit(value):
+    # calls/seconds, e.g. 300/300
+    if not value:
+        return None
+    calls, seconds = value.split('/')
+    return int(calls), float(seconds)
+
+
+def _delta(value, baseline):
+    if not baseline:
+        return ''
+    return f'{(value - baseline) / baseline * 100:+.1f}%'
+
+
+def _push(args, archive_dir, server):
+    db_file = f'{args.data_dir}/{args.type}-{args.size}-push.db'
+    for file_name in (db_file, f'{db_file}-wal', f'{db_file}-shm'):
+        if path.exists(file_name):
+            os.remove(file_name)
+    os.environ.update(FB_POSTS_DIR=archive_dir, MST_POSTS_DIR=archive_dir, TW_POSTS_DIR=archive_dir, DB_FILE=db_file,
+                      MASTODON_DOMAIN=server.url, MASTODON_CLIENT_ACCESS_TOKEN=server.token)
+    os.environ.setdefault('MASTODON_HTTP_BACKOFF', '0.1')
+    from mevaclibs.envs import LoadEnv, PushEnv
+    from mevaclibs.importers import FbImporter, MstImporter, TwImporter
+    from mevaclibs.pusher import Pusher, AsyncPusher
+    load_env = LoadEnv()
+    if args.type == 'facebook':
+        FbImporter(load_env).load_fb_posts(False)
+    elif args.type == 'twitter':
+        TwImporter(load_env).load_tw_posts(False)
+    else:
+        MstImporter(load_env).load_mst_posts(False)
+    pusher = (AsyncPusher if args.async_push else Pusher)(load_env, PushEnv())
+    start = time.time()
+    if args.type == 'facebook':
+        pusher.push_fb_posts(False)
+    elif args.type == 'twitter':
+        pusher.push_tw_posts(False)
+    else:
+        pusher.push_mst_posts('0', '0', False)
+    seconds = time.time() - start
+    snapshot = pusher.metrics.snapshot()
+    return {'type': args.type, 'size': args.size, 'engine': 'async' if args.async_push else 'sync',
+            'seconds': seconds, 'posts': snapshot['posts'], 'statuses': server.call_count('post_status', 200),
+            'media': server.call_count('upload_media', 200) + server.call_count('upload_media', 202),
+            'requests': server.call_count(), 'ratelimited': server.call_count(code=429),
+            'retries': snapshot['retries'], 'skipped': snapshot['skipped'],
+            'ratelimit_sleep': snapshot['ratelimit_sleep_seconds'],
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pushing to a local fake Mastodon server.')
+    parser.add_argument('--type', choices=['facebook', 'mastodon', 'twitter'], default='facebook', help='Archive type')
+    parser.add_argument('--size', type=synth.parse_size, default=1000, help='Archive size, e.g. 1k')
+    parser.add_argument('--async', dest='async_push', action='store_true', help='Use the asyncio push engine')
+    parser.add_argument('--latency', type=float, default=0.02, help='Server latency per call, seconds')
+    parser.add_argument('--status-limit', type=_limit, help='Statuses rate-limit, calls/seconds, e.g. 300/300')
+    parser.add_argument('--media-limit', type=_limit, help='Media uploads rate-limit, calls/seconds, e.g. 30/1800')
+    parser.add_argument('--media-delay', type=float, default=0, help='Media processing time (202 answers), seconds')
+    parser.add_argument('--fail-422', type=float, default=0, help='Share of calls answered with 422')
+    parser.add_argument('--fail-5xx', type=float, default=0, help='Share of calls answered with 503')
+    parser.add_argument('--seed', type=int, default=1, help='Archive and fault random seed')
+    parser.add_argument('--data-dir', default='/tmp/mevac-bench', help='Archives and databases directory')
+    parser.add_argument('--json', dest='json_file', help='Save the result to a JSON file')
+    parser.add_argument('--compare', help='Result JSON file to compare with')
+    args = parser.parse_args()
+    logging.basicConfig(level=os.environ.get('LOGLEVEL', 'WARNING').upper())
+
+    archive_dir = _archive(args.data_dir, args.type, args.size, args.seed)
+    limits = {bucket: limit for bucket, limit in (('statuses', args.status_limit), ('media', args.media_limit))
+              if limit}
+    with FakeMastodon(latency=args.latency, limits=limits, media_delay=args.media_delay,
+                      fault_rates={422: args.fail_422, 503: args.fail_5xx}, seed=args.seed) as server:
+        result = _push(args, archive_dir, server)
+
+    base = dict()
+    if args.compare:
+        with open(args.compare) as file:
+            base = json.load(file)
+    rate = result['posts'] / result['seconds']
+    base_rate = base['posts'] / base['seconds'] if base else None
+    rows = [['Posts', result['posts'], ''],
+            ['Statuses posted', result['statuses'], ''],
+            ['Media uploaded', result['media'], ''],
+            ['API requests', result['requests'], _delta(result['requests'], base.get('requests'))],
+            ['Push, s', f'{result["seconds"]:.2f}', _delta(result['seconds'], base.get('seconds'))],
+            ['Posts per second', f'{rate:.1f}', _delta(rate, base_rate)],
+            ['Requests per second', f'{result["requests"] / result["seconds"]:.1f}', ''],
+            ['Rate-limited (429)', result['ratelimited'], ''],
+            ['Rate-limit sleep, s', f'{result["ratelimit_sleep"]:.0f}', ''],
+            ['Retries', result['retries'], ''],
+            ['Skipped', result['skipped'], ''],
+            ['Peak RSS, MB', f'{result["peak_rss_mb"]:.0f}', _delta(result['peak_rss_mb'], base.get('peak_rss_mb'))]]
+    print(tabulate(rows, headers=[f'Push {result["type"]} {result["size"]} ({result["engine"]})', 'Value', 'Δ'],
+                   tablefmt='presto', disable_numparse=True, colalign=('left', 'right', 'right')))
+    if args.json_file:
+        with open(args.json_file, 'w') as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+# In-process stand-in for the Mastodon API used by the offline tests and the push benchmark. Implements the calls the
+# client makes: statuses, media upload and status, credentials check and status deletion, with configurable latency,
+# rate-limits with x-ratelimit-* headers, media processing (202 and 206 until ready), Idempotency-Key of status posts
+# and 422/5xx fault injection.
+#   with FakeMastodon(latency=0.05, limits={'statuses': (300, 300)}) as server:
+#       os.environ['MASTODON_DOMAIN'] = server.url
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mevaclibs.text import status_length
+
+_ROUTES = (
+    ('POST', re.compile(r'/api/v1/statuses'), 'statuses', 'post_status'),
+    ('DELETE', re.compile(r'/api/v1/statuses/(\d+)'), 'delete', 'delete_status'),
+    ('POST', re.compile(r'/api/v2/media'), 'media', 'upload_media'),
+    ('GET', re.compile(r'/api/v1/media/(\d+)'), 'statuses', 'get_media'),
+    ('GET', re.compile(r'/api/v1/apps/verify_credentials'), 'statuses', 'verify_credentials'),
+)
+
+
+class _Window:
+    # fixed rate-limit window, starts with the first call as on the server
+    def __init__(self, limit, seconds):
+        self.limit = limit
+        self.seconds = seconds
+        self.reset = 0.0
+        self.remaining = limit
+
+    def take(self):
+        now = time.time()
+        if now >= self.reset:
+            self.reset = now + self.seconds
+            self.remaining = self.limit
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+    def headers(self):
+        reset = datetime.fromtimestamp(self.reset, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        return {'x-ratelimit-limit': str(self.limit), 'x-ratelimit-remaining': str(max(self.remaining, 0)),
+                'x-ratelimit-reset': reset}
+
+
+class FakeMastodon:
+    # limits: bucket ('statuses', 'media', 'delete') -> (calls, window seconds) of every account, unlimited buckets
+    # send no headers. tokens are more accounts besides token, statuses keep the token they were posted with.
+    # fault_rates: HTTP code -> share of status posts and media uploads answered with it, inject() queues codes for
+    # the next calls instead, lose() makes status posts whose answer is lost. A status post with a known
+    # Idempotency-Key gets the status created by the first one for idempotency_ttl seconds, as Mastodon does.
+    # Every call waits latency seconds, +-50% jitter.
+
+    def __init__(self, latency=0.0, limits=None, media_delay=0.0, fault_rates=None, text_size_limit=500,
+                 token='token', seed=1, tokens=(), idempotency_ttl=3600):
+        self.latency = latency
+        self.media_delay = media_delay
+        self.fault_rates = fault_rates or dict()
+        self.text_size_limit = text_size_limit
+        self.token = token
+        self.tokens = (token,) + tuple(tokens)
+        self.statuses = dict()
+        self.media = dict()
+        self.idempotency_ttl = idempotency_ttl
+        # status posts answered with the status of an earlier request
+        self.replayed = 0
+        # (token, idempotency key) -> (status id, time)
+        self._idempotency = dict()
+        self._lost = 0
+        # (method, route, status code) -> calls
+        self.calls = Counter()
+        self._limits = limits or dict()
+        # (token, bucket) -> window
+        self._windows = dict()
+        self._faults = list()
+        self._ids = itertools.count(100000000000000000)
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05},
+                                        name='fake-mastodon', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def inject(self, *codes):
+        # the next status posts and media uploads are answered with these codes, one each
+        with self._lock:
+            self._faults.extend(codes)
+
+    def lose(self, count=1):
+        # the next status posts are created, but answered with 504 as by a proxy timing out
+        with self._lock:
+            self._lost += count
+
+    def call_count(self, route=None, code=None):
+        return sum(count for (_, call_route, call_code), count in self.calls.items()
+                   if (route is None or call_route == route) and (code is None or call_code == code))
+
+    def handle(self, method, path, headers, body):
+        # returns (code, headers, JSON answer)
+        if self.latency:
+            time.sleep(self.latency * self._random.uniform(0.5, 1.5))
+        for route_method, pattern, bucket, name in _ROUTES:
+            match = pattern.fullmatch(path.split('?')[0])
+            if route_method == method and match:
+                break
+        else:
+            return HTTPStatus.NOT_FOUND, dict(), {'error': 'Record not found'}
+        token = (headers.get('Authorization') or '').removeprefix('Bearer ')
+        if token not in self.tokens:
+            return HTTPStatus.UNAUTHORIZED, dict(), {'error': 'The access token is invalid'}
+        with self._lock:
+            if bucket in self._limits and (token, bucket) not in self._windows:
+                self._windows[(token, bucket)] = _Window(*self._limits[bucket])
+            window = self._windows.get((token, bucket))
+            allowed = window.take() if window else True
+            limit_headers = window.headers() if window else dict()
+            fault = None
+            if allowed and name in ('post_status', 'upload_media'):
+                if self._faults:
+                    fault = self._faults.pop(0)
+                else:
+                    for code, rate in self.fault_rates.items():
+                        if self._random.random() < rate:
+                            fault = code
+                            break
+        idempotency_key = headers.get('Idempotency-Key') if name == 'post_status' else None
+        replay = self._replay(token, idempotency_key) if allowed and not fault else None
+        if not allowed:
+            code, answer = HTTPStatus.TOO_MANY_REQUESTS, {'error': 'Too many requests'}
+        elif fault:
+            code, answer = fault, {'error': f'Injected {fault}'}
+        elif replay:
+            code, answer = HTTPStatus.OK, replay
+        else:
+            code, answer = getattr(self, name)(token, body, *match.groups())
+            if idempotency_key and code == HTTPStatus.OK:
+                with self._lock:
+                    self._idempotency[(token, idempotency_key)] = (answer['id'], time.time())
+        with self._lock:
+            if name == 'post_status' and code == HTTPStatus.OK and self._lost:
+                self._lost -= 1
+                code, answer = HTTPStatus.GATEWAY_TIMEOUT, {'error': 'Gateway timeout'}
+            self.calls[(method, name, int(code))] += 1
+        return code, limit_headers, answer
+
+    def _replay(self, token, idempotency_key):
+        # answer of the status posted with the key, if it is remembered and not deleted
+        with self._lock:
+            status_id, posted = self._idempotency.get((token, idempotency_key), (None, 0))
+            status = self.statuses.get(status_id)
+            if status is None or posted + self.idempotency_ttl < time.time():
+                return None
+            self.replayed += 1
+        return self._status_answer(status)
+
+    @staticmethod
+    def _status_answer(status):
+        return {'id': status['id'], 'content': f'<p>{status.get("status") or ""}</p>',
+                'in_reply_to_id': status.get('in_reply_to_id'), 'visibility': status.get('visibility')}
+
+    def post_status(self, token, body):
+        payload = json.loads(body)
+        text = payload.get('status') or ''
+        media_ids = payload.get('media_ids') or list()
+        if not text and not media_ids:
+            return HTTPStatus.UNPROCESSABLE_ENTITY, {'error': "Validation failed: Text can't be blank"}
+        if status_length(text) > self.text_size_limit:
+            return HTTPStatus.UNPROCESSABLE_ENTITY, {'error': 'Validation failed: Text character limit of '
+                                                              f'{self.text_size_limit} exceeded'}
+        if len(media_ids) > 4:
+            return HTTPStatus.UNPROCESSABLE_ENTITY, {'error': 'Validation failed: Too many attachments'}
+        with self._lock:
+            if any(self.media.get(media_id, {}).get('ready', 0) > time.time() for media_id in media_ids):
+                return HTTPStatus.UNPROCESSABLE_ENTITY, {'error': 'Cannot attach files that have not finished '
+                                                                  'processing. Try again in a moment!'}
+            status_id = str(next(self._ids))
+            self.statuses[status_id] = dict(payload, id=status_id, token=token)
+            return HTTPStatus.OK, self._status_answer(self.statuses[status_id])
+
+    def delete_status(self, token, body, status_id):
+        with self._lock:
+            status = self.statuses.pop(status_id, None)
+        if status is None:
+            return HTTPStatus.NOT_FOUND, {'error': 'Record not found'}
+        return HTTPStatus.OK, {'id': status_id, 'text': status.get('status')}
+
+    def upload_media(self, token, body):
+        if b'filename="' not in body[:1024]:
+            return HTTPStatus.UNPROCESSABLE_ENTITY, {'error': 'Validation failed: File is missing'}
+        with self._lock:
+            media_id = str(next(self._ids))
+            self.media[media_id] = {'size': len(body), 'ready': time.time() + self.media_delay}
+        if self.media_delay:
+            return HTTPStatus.ACCEPTED, {'id': media_id, 'type': 'image', 'url': None}
+        return HTTPStatus.OK, {'id': media_id, 'type': 'image', 'url': f'{self.url}/media/{media_id}'}
+
+    def get_media(self, token, body, media_id):
+        with self._lock:
+            media = self.media.get(media_id)
+        if media is None:
+            return HTTPStatus.NOT_FOUND, {'error': 'Record not found'}
+        if media['ready'] > time.time():
+            return HTTPStatus.PARTIAL_CONTENT, {'id': media_id, 'url': None}
+        return HTTPStatus.OK, {'id': media_id, 'url': f'{self.url}/media/{media_id}'}
+
+    def verify_credentials(self, token, body):
+        return HTTPStatus.OK, {'name': 'mevac', 'website': None}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive as the client pool expects, the answer isn't held back waiting for the ACK of the headers
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _serve(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        code, headers, answer = self.server.fake.handle(self.command, self.path, self.headers, body)
+        data = json.dumps(answer).encode()
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_DELETE = _serve
+
+    def log_message(self, format, *args):
+        pass
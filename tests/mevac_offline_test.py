@@ -0,0 +1,1022 @@
+import io
+import itertools
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import unittest
+import zipfile
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
+from PIL import Image
+import synth
+from fake_mastodon import FakeMastodon
+from mevaclibs.archive import archive_root, file_exists, file_size, list_dir, open_file
+from mevaclibs.common import Utils
+from mevaclibs.db import BatchWriter
+from mevaclibs.envs import FB_POST_FILES, MST_POST_FILES, TW_POST_FILES, LoadEnv, PushEnv
+from mevaclibs.importers import FbImporter, MstImporter, TwImporter, _parse_tw_post
+from mevaclibs.mastodon import Mastodon
+from mevaclibs.mediacache import MediaCache
+from mevaclibs.metrics import Metrics
+from mevaclibs.multipart import MultipartFile
+from mevaclibs.multipush import MultiPusher
+from mevaclibs.optimizer import MediaOptimizer, _optimize_media_file
+from mevaclibs.pipeline import transform
+from mevaclibs.pusher import AsyncPusher, Pusher
+from mevaclibs.ratelimit import RateLimiter
+from mevaclibs.report import Report
+from mevaclibs.streams import JsonStream
+from mevaclibs.text import html_to_text, split_status, status_length
+
+
+class TestJsonStream(unittest.TestCase):
+    outbox = {'@context': 'https://www.w3.org/ns/activitystreams', 'totalItems': 3,
+              'meta': {'nested': [1, 2, {'orderedItems': 'not this one'}]},
+              'orderedItems': [{'id': 1, 'text': 'a' * 100}, {'id': 2, 'text': '"[quoted]"'}, 12345]}
+
+    def test_keyed_items(self):
+        data = json.dumps(self.outbox, indent=2)
+        items = list(JsonStream(io.StringIO(data), chunk_size=7).items('orderedItems'))
+        self.assertEqual(items, self.outbox['orderedItems'])
+
+    def test_top_level_array(self):
+        data = json.dumps(self.outbox['orderedItems'])
+        items = list(JsonStream(io.StringIO(data), chunk_size=3).items())
+        self.assertEqual(items, self.outbox['orderedItems'])
+
+    def test_missing_key(self):
+        self.assertEqual(list(JsonStream(io.StringIO('{"a": 1}')).items('orderedItems')), [])
+
+    def test_malformed(self):
+        with self.assertRaises(Exception):
+            list(JsonStream(io.StringIO('[{"a": 1} {"b": 2}]')).items())
+
+
+class TestRateLimiter(unittest.TestCase):
+    @staticmethod
+    def headers(remaining, reset_in):
+        reset = datetime.fromtimestamp(int(time.time()) + reset_in, timezone.utc)
+        return {'x-ratelimit-limit': '300', 'x-ratelimit-remaining': str(remaining),
+                'x-ratelimit-reset': reset.strftime('%Y-%m-%dT%H:%M:%S.000000Z')}
+
+    def test_unknown_bucket(self):
+        with mock.patch('mevaclibs.ratelimit.time.sleep') as sleep:
+            self.assertEqual(RateLimiter().acquire('statuses'), 0)
+            sleep.assert_not_called()
+
+    def test_pacing(self):
+        limiter = RateLimiter()
+        limiter.update('media', self.headers(10, 100))
+        with mock.patch('mevaclibs.ratelimit.time.sleep'):
+            waits = [limiter.acquire('media') for _ in range(10)]
+        self.assertEqual(waits[0], 0)
+        # ten calls spread over the window, the last one close to its end
+        self.assertTrue(all(later > earlier for earlier, later in zip(waits[1:], waits[2:])))
+        self.assertGreater(waits[-1], 80)
+        self.assertLess(waits[-1], 102)
+        # other buckets are not affected
+        self.assertEqual(limiter.acquire('statuses'), 0)
+
+    def test_exhausted(self):
+        limiter = RateLimiter()
+        limiter.update('statuses', self.headers(0, 30))
+        with mock.patch('mevaclibs.ratelimit.time.sleep'):
+            self.assertGreater(limiter.acquire('statuses'), 25)
+
+
+class TestBatchWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.db_file = f'{self.dir.name}/test.db'
+        self.conn = sqlite3.connect(self.db_file)
+        self.addCleanup(self.conn.close)
+        self.conn.execute('CREATE TABLE posts (id INTEGER PRIMARY KEY, text TEXT)')
+        self.conn.commit()
+
+    def committed(self):
+        # rows another connection sees
+        conn = sqlite3.connect(self.db_file)
+        count = conn.execute('SELECT COUNT (*) FROM posts').fetchone()[0]
+        conn.close()
+        return count
+
+    def load(self, ids, batch_size=3):
+        writer = BatchWriter(self.conn, batch_size)
+        for post_id in ids:
+            writer.insert('posts', ('id', 'text'), (post_id, f'post {post_id}'))
+        writer.flush()
+        return writer.inserted('posts'), writer.duplicates('posts')
+
+    def test_batches(self):
+        writer = BatchWriter(self.conn, 3)
+        for post_id in range(1, 3):
+            writer.insert('posts', ('id', 'text'), (post_id, ''))
+        self.assertEqual(self.committed(), 0)
+        # the batch is written when it is full
+        writer.insert('posts', ('id', 'text'), (3, ''))
+        self.assertEqual(self.committed(), 3)
+        writer.insert('posts', ('id', 'text'), (4, ''))
+        self.assertEqual(self.committed(), 3)
+        # the last partial batch is written by the final flush
+        writer.flush()
+        self.assertEqual(self.committed(), 4)
+        self.assertEqual((writer.inserted('posts'), writer.duplicates('posts')), (4, 0))
+
+    def test_duplicates(self):
+        self.assertEqual(self.load(range(1, 8)), (7, 0))
+        # a re-load of a newer archive: the same rows and two new ones, in batches and within a batch
+        self.assertEqual(self.load(list(range(1, 10)) + [9]), (2, 8))
+        self.assertEqual(self.committed(), 9)
+
+    def test_report_triggers(self):
+        # the counters written by the triggers are not counted as inserted rows
+        self.conn.execute('CREATE TABLE fb_posts (id INTEGER PRIMARY KEY, text TEXT, posted INTEGER default 0)')
+        Report.prepare_db(self.conn)
+        for ids, counts in ((range(1, 6), (5, 0)), (range(1, 8), (2, 5))):
+            writer = BatchWriter(self.conn, 2)
+            for post_id in ids:
+                writer.insert('fb_posts', ('id', 'text'), (post_id, ''))
+            writer.flush()
+            self.assertEqual((writer.inserted('fb_posts'), writer.duplicates('fb_posts')), counts)
+
+
+class TestMediaCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = list()
+        for name, content in (('a.jpg', b'same'), ('b.jpg', b'same'), ('c.jpg', b'other')):
+            self.files.append(os.path.join(self.tmp.name, name))
+            with open(self.files[-1], 'wb') as file:
+                file.write(content)
+        self.cache = MediaCache(os.path.join(self.tmp.name, 'test.db'))
+        self.upload = mock.Mock(side_effect=lambda media_file, dry_run: str(100 + self.upload.call_count))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_post(self):
+        ids = [self.cache.upload(media_file, 'fb', 1, self.upload, dry_run=False, post_uploads=3)
+               for media_file in self.files]
+        self.assertEqual(ids, ['101', '101', '102'])
+        self.assertEqual((self.cache.uploaded, self.cache.reused), (2, 1))
+
+    def test_single_upload(self):
+        # the only media of a post is not read, a re-push finds it by the file fingerprint
+        with mock.patch.object(Utils, 'file_digest') as file_digest:
+            self.assertEqual(self.cache.upload(self.files[0], 'fb', 1, self.upload, dry_run=False), '101')
+            self.assertEqual(self.cache.upload(self.files[0], 'fb', 1, self.upload, dry_run=False), '101')
+            self.assertEqual(self.cache.upload(self.files[1], 'fb', 1, self.upload, dry_run=False), '102')
+        file_digest.assert_not_called()
+
+    def test_attached(self):
+        self.assertEqual(self.cache.upload(self.files[0], 'fb', 1, self.upload, dry_run=False), '101')
+        # another post gets its own attachment
+        self.assertEqual(self.cache.upload(self.files[1], 'fb', 2, self.upload, dry_run=False), '102')
+        self.cache.attach('fb', 1)
+        self.assertEqual(self.cache.upload(self.files[1], 'fb', 1, self.upload, dry_run=False), '103')
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_push(self, export_file):
+        metrics = Metrics('push', export_file)
+        metrics.start('facebook', 10)
+        for _ in range(4):
+            metrics.inc('posts')
+        metrics.inc('skipped')
+        metrics.report()
+        return metrics
+
+    def test_json(self):
+        export_file = os.path.join(self.tmp.name, 'push.json')
+        self.run_push(export_file)
+        with open(export_file) as file:
+            snapshot = json.load(file)
+        self.assertEqual((snapshot['posts'], snapshot['posts_pending'], snapshot['skipped']), (4, 6, 1))
+        self.assertIsNotNone(snapshot['eta_seconds'])
+
+    def test_prometheus(self):
+        export_file = os.path.join(self.tmp.name, 'push.prom')
+        self.run_push(export_file)
+        with open(export_file) as file:
+            lines = file.read().splitlines()
+        self.assertIn('mevac_posts_total{operation="push",source="facebook"} 4', lines)
+        self.assertIn('mevac_posts_pending{operation="push",source="facebook"} 6', lines)
+        self.assertIn('# TYPE mevac_skipped_total counter', lines)
+
+
+class TestMediaOptimizer(unittest.TestCase):
+    # two copies of a big photo and two of a small one which is not smaller when re-encoded
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.media_dir = f'{self.dir.name}/media'
+        os.makedirs(self.media_dir)
+        big = Image.frombytes('RGB', (800, 800), random.Random(1).randbytes(800 * 800 * 3))
+        small = Image.frombytes('RGB', (64, 64), random.Random(2).randbytes(64 * 64 * 3))
+        for name, image, quality in (('big1.jpg', big, 95), ('big2.jpg', big, 95), ('small1.jpg', small, 1),
+                                     ('small2.jpg', small, 1)):
+            image.save(f'{self.dir.name}/{name}', quality=quality, optimize=True)
+        self.env = mock.patch.dict(os.environ, FB_POSTS_DIR=self.dir.name, MST_POSTS_DIR=self.dir.name,
+                                   DB_FILE=f'{self.dir.name}/mevac.db', LOAD_WORKERS='2', MEDIA_MAX_PIXELS='40000',
+                                   MEDIA_OPTIMIZE_DIR=self.media_dir)
+        self.env.start()
+        self.addCleanup(self.env.stop)
+        conn = sqlite3.connect(os.environ['DB_FILE'])
+        conn.execute('CREATE TABLE fb_media (id INTEGER PRIMARY KEY, post_id INTEGER, uri TEXT, '
+                     'posted INTEGER default 0)')
+        conn.executemany('INSERT INTO fb_media (post_id, uri) VALUES (?, ?)',
+                         [(1, 'big1.jpg'), (2, 'big2.jpg'), (3, 'small1.jpg'), (4, 'small2.jpg')])
+        conn.commit()
+        conn.close()
+
+    def test_optimize(self):
+        MediaOptimizer(LoadEnv()).optimize_media('fb', self.dir.name, False)
+        conn = sqlite3.connect(os.environ['DB_FILE'])
+        rows = dict((uri, (target, bytes_in, bytes_out)) for uri, target, bytes_in, bytes_out in
+                    conn.execute('SELECT uri, path, bytes_in, bytes_out FROM media_optimized'))
+        conn.close()
+        # the copies share one optimized file
+        self.assertEqual(rows['big1.jpg'][0], rows['big2.jpg'][0])
+        self.assertLess(rows['big1.jpg'][2], rows['big1.jpg'][1])
+        self.assertEqual(os.listdir(self.media_dir), [os.path.basename(rows['big1.jpg'][0])])
+        self.assertEqual(rows['small1.jpg'], (None, rows['small1.jpg'][1], rows['small1.jpg'][1]))
+        self.assertEqual(rows['small2.jpg'], rows['small1.jpg'])
+
+    def test_settings(self):
+        # the push uploads an optimized file made with its own settings only
+        MediaOptimizer(LoadEnv()).optimize_media('fb', self.dir.name, False)
+        with mock.patch.dict(os.environ, MASTODON_DOMAIN='localhost', MASTODON_CLIENT_ACCESS_TOKEN='token'):
+            pusher = Pusher(LoadEnv(), PushEnv())
+            self.assertTrue(pusher._media_file('fb', self.dir.name, 'big1.jpg').startswith(self.media_dir))
+            with mock.patch.dict(os.environ, MEDIA_MAX_PIXELS='90000'):
+                pusher = Pusher(LoadEnv(), PushEnv())
+            self.assertEqual(pusher._media_file('fb', self.dir.name, 'big1.jpg'), f'{self.dir.name}/big1.jpg')
+
+    def test_not_smaller(self):
+        # the task making the shared file does not remove it from under another one
+        task = ('small1.jpg', f'{self.dir.name}/small1.jpg', self.media_dir, 40000, 85)
+        self.assertIsNone(_optimize_media_file(task)[2])
+        self.assertEqual(os.listdir(self.media_dir), [])
+        task = ('big1.jpg', f'{self.dir.name}/big1.jpg', self.media_dir, 40000, 85)
+        target = _optimize_media_file(task)[2]
+        with mock.patch('PIL.Image.open') as image_open:
+            self.assertEqual(_optimize_media_file(task[:1] + (f'{self.dir.name}/big2.jpg',) + task[2:])[2], target)
+            image_open.assert_not_called()
+        self.assertTrue(os.path.exists(target))
+
+
+class TestMultipartFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.tmp.name, 'video.mp4')
+        self.content = os.urandom(100000)
+        with open(self.file_name, 'wb') as file:
+            file.write(self.content)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_body(self):
+        progress = mock.Mock()
+        with MultipartFile(self.file_name, progress=progress) as body:
+            chunks = list(iter(lambda: body.read(4096), b''))
+            data = b''.join(chunks)
+            self.assertEqual(len(data), len(body))
+            self.assertTrue(max(len(chunk) for chunk in chunks) <= 4096)
+            boundary = body.content_type.split('boundary=')[1]
+            head, rest = data.split(b'\r\n\r\n', 1)
+            self.assertIn(b'name="file"; filename="video.mp4"', head)
+            self.assertIn(b'Content-Type: video/mp4', head)
+            self.assertEqual(rest, self.content + f'\r\n--{boundary}--\r\n'.encode())
+            self.assertEqual(progress.call_args.args, (len(self.content), len(self.content)))
+            # a retry sends the same body again
+            body.seek(0)
+            self.assertEqual(body.read(), data)
+
+
+class TestMastodonClient(unittest.TestCase):
+    # the API client against the local fake server
+    def client(self, server, **env):
+        env = dict({'MASTODON_DOMAIN': server.url, 'MASTODON_CLIENT_ACCESS_TOKEN': server.token,
+                    'MASTODON_HTTP_BACKOFF': '0', 'MASTODON_MEDIA_TIMEOUT': '1'}, **env)
+        with mock.patch.dict(os.environ, env):
+            return Mastodon(PushEnv())
+
+    def test_long_status(self):
+        with FakeMastodon() as server:
+            mst = self.client(server)
+            self.assertEqual(mst.verify_credentials(), 'mevac')
+            post_ids = mst.post_fb_status(' '.join(['word'] * 300), visibility='public', dry_run=False)
+            self.assertEqual(len(post_ids), 4)
+            replies = [server.statuses[post_id].get('in_reply_to_id') for post_id in post_ids]
+            self.assertEqual(replies, [None] + post_ids[:-1])
+            self.assertEqual(mst.delete_entity(post_ids[0]), post_ids[0])
+
+    def test_server_errors(self):
+        # 5xx is retried, 422 skips the status
+        with FakeMastodon() as server:
+            mst = self.client(server)
+            server.inject(503, 502)
+            self.assertNotEqual(mst.post_mst_status('retried', dry_run=False), '0')
+            server.inject(422)
+            self.assertEqual(mst.post_mst_status('skipped', dry_run=False), '0')
+            self.assertEqual(server.call_count('post_status'), 4)
+            self.assertEqual(len(server.statuses), 1)
+
+    def test_rate_limit(self):
+        # the budget is used up by another client, the 429 answer tells when to retry
+        with FakeMastodon(limits={'statuses': (1, 1)}) as server:
+            self.client(server).post_mst_status('other app', dry_run=False)
+            self.assertNotEqual(self.client(server).post_mst_status('retried', dry_run=False), '0')
+            self.assertEqual(server.call_count('post_status', 429), 1)
+            self.assertEqual(len(server.statuses), 2)
+
+    def test_media_processing(self):
+        with tempfile.TemporaryDirectory() as tmp, FakeMastodon(media_delay=1) as server:
+            media_file = os.path.join(tmp, 'photo.jpg')
+            with open(media_file, 'wb') as file:
+                file.write(os.urandom(1000))
+            mst = self.client(server)
+            media_id = mst.upload_media(media_file, dry_run=False)
+            self.assertEqual(server.media[media_id]['size'] > 1000, True)
+            self.assertEqual(len(mst.post_fb_status('with media', [media_id], dry_run=False)), 1)
+            self.assertEqual(server.call_count('upload_media', 202), 1)
+            self.assertGreater(server.call_count('get_media', 206) + server.call_count('get_media', 200), 0)
+            self.assertEqual(server.call_count('post_status', 422), 0)
+
+
+class TestMultiPusher(unittest.TestCase):
+    # Facebook and Mastodon archives loaded into one database, pushed to two accounts of the fake server
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        synth.fb_archive(self.dir.name, 30, media_files=True)
+        synth.mst_archive(self.dir.name, 30, media_files=True)
+        self.server = FakeMastodon(tokens=('fb', 'mst'))
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.env = mock.patch.dict(os.environ, FB_POSTS_DIR=self.dir.name, MST_POSTS_DIR=self.dir.name,
+                                   DB_FILE=f'{self.dir.name}/mevac.db', LOAD_WORKERS='1', MASTODON_HTTP_BACKOFF='0',
+                                   MASTODON_DOMAIN=self.server.url, PUSH_TARGETS=f'{self.dir.name}/targets.json')
+        self.env.start()
+        self.addCleanup(self.env.stop)
+        FbImporter(LoadEnv()).load_fb_posts(False)
+        MstImporter(LoadEnv()).load_mst_posts(False)
+
+    def push(self, targets):
+        with open(os.environ['PUSH_TARGETS'], 'w') as file:
+            json.dump(targets, file)
+        pusher = MultiPusher(LoadEnv())
+        try:
+            pusher.push(False)
+        finally:
+            self.stat = {row[0]: row for row in pusher._stat}
+
+    def pending(self, table):
+        conn = sqlite3.connect(os.environ['DB_FILE'])
+        count = conn.execute(f'SELECT COUNT (*) FROM {table} WHERE posted = 0').fetchone()[0]
+        conn.close()
+        return count
+
+    def test_accounts(self):
+        # the token of the target is used over a MASTODON_CLIENT_ACCESS_TOKEN setting
+        self.push([{'source': 'facebook', 'account': 'fb', 'token': 'fb', 'MASTODON_VISIBILITY': 'public',
+                    'MASTODON_CLIENT_ACCESS_TOKEN': 'mst'},
+                   {'source': 'mastodon', 'account': 'mst', 'token': 'mst'}])
+        self.assertEqual((self.pending('fb_posts'), self.pending('mst_posts')), (0, 0))
+        statuses = self.server.statuses.values()
+        self.assertEqual({status['visibility'] for status in statuses if status['token'] == 'fb'}, {'public'})
+        self.assertEqual(sum(status['token'] == 'fb' for status in statuses), int(self.stat['fb'][3]))
+        self.assertEqual(sum(status['token'] == 'mst' for status in statuses), int(self.stat['mst'][3]))
+
+    def test_failed_account(self):
+        # a target failing doesn't stop the others
+        with self.assertRaises(Exception):
+            self.push([{'source': 'facebook', 'account': 'fb', 'token': 'wrong'},
+                       {'source': 'mastodon', 'account': 'mst', 'token': 'mst'}])
+        self.assertTrue(self.stat['fb'][-1].startswith('failed'))
+        self.assertEqual(self.stat['mst'][-1], 'done')
+        self.assertEqual(self.pending('mst_posts'), 0)
+
+    def test_targets(self):
+        for targets in ([{'source': 'myspace', 'token': 'fb'}], [{'source': 'facebook'}],
+                        [{'source': 'facebook', 'token': 'fb'}, {'source': 'facebook', 'token': 'mst'}]):
+            with self.subTest(targets=targets), self.assertRaises(Exception):
+                self.push(targets)
+
+
+class TestPushJournal(unittest.TestCase):
+    # status posts whose answer is lost are resent with their idempotency keys, in the same run or after a crash
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        synth.fb_archive(self.dir.name, 20, media_files=True)
+        synth.mst_archive(self.dir.name, 20, media_files=True)
+        self.server = FakeMastodon()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.env = mock.patch.dict(os.environ, FB_POSTS_DIR=self.dir.name, MST_POSTS_DIR=self.dir.name,
+                                   DB_FILE=f'{self.dir.name}/mevac.db', LOAD_WORKERS='1', MASTODON_HTTP_BACKOFF='0',
+                                   MASTODON_DOMAIN=self.server.url, MASTODON_CLIENT_ACCESS_TOKEN=self.server.token)
+        self.env.start()
+        self.addCleanup(self.env.stop)
+        FbImporter(LoadEnv()).load_fb_posts(False)
+        MstImporter(LoadEnv()).load_mst_posts(False)
+
+    def query(self, sql):
+        conn = sqlite3.connect(os.environ['DB_FILE'])
+        rows = conn.execute(sql).fetchall()
+        conn.close()
+        return rows
+
+    def test_lost_answer(self):
+        self.server.lose(3)
+        Pusher(LoadEnv(), PushEnv()).push_fb_posts(False)
+        self.assertEqual(self.server.replayed, 3)
+        posted = self.query('SELECT posted FROM fb_parts WHERE posted != 0')
+        self.assertEqual({str(post_id) for post_id, in posted}, set(self.server.statuses))
+        self.assertEqual(len(posted), len(self.server.statuses))
+        self.assertEqual(self.query('SELECT COUNT (*) FROM push_journal'), [(0,)])
+
+    def test_crash(self):
+        # the answer of the first status is lost and the push stops, the next run gets the status posted then
+        self.server.lose(1)
+        with mock.patch.dict(os.environ, MASTODON_HTTP_RETRIES='0'), self.assertRaises(Exception):
+            Pusher(LoadEnv(), PushEnv()).push_mst_posts('0', '0', False)
+        self.assertEqual(len(self.server.statuses), 1)
+        self.assertEqual(self.query('SELECT j.source, p.posted FROM push_journal j JOIN mst_posts p '
+                                    'ON j.item = CAST(p.id AS TEXT)'), [('mst', 0)])
+        pusher = Pusher(LoadEnv(), PushEnv())
+        pusher.push_mst_posts('0', '0', False)
+        self.assertEqual(self.server.replayed, 1)
+        self.assertEqual(pusher._journal.resumed, 1)
+        posted = self.query('SELECT parent_id FROM mst_posts WHERE posted != 2')
+        tags = sum(parent_id == 0 for parent_id, in posted)
+        self.assertEqual(len(self.server.statuses), len(posted) + tags)
+        self.assertEqual(self.query('SELECT COUNT (*) FROM push_journal'), [(0,)])
+
+
+class TestTransform(unittest.TestCase):
+    def test_ordered(self):
+        items = (n for n in range(2000))
+        self.assertEqual(list(transform(abs, items, workers=3, chunk_size=7)), list(range(2000)))
+
+    def test_inline(self):
+        self.assertEqual(list(transform(str, range(3))), ['0', '1', '2'])
+
+
+class TestMstPushOrder(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE mst_posts (id INTEGER PRIMARY KEY, parent_id INTEGER default 0, '
+                          'original_date INTEGER, privacy TEXT, language TEXT, text TEXT, sensitive INTEGER, '
+                          'posted INTEGER default 0)')
+
+    def push_order(self, posts, parent_id='0'):
+        self.conn.executemany('INSERT INTO mst_posts (id, parent_id, posted) VALUES (?, ?, ?)', posts)
+        return [post[0] for post in Pusher._mst_push_order(SimpleNamespace(_conn=self.conn), parent_id, '0')]
+
+    def test_threads(self):
+        # (id, parent_id, posted): replies follow their parent, a reply to a posted post is not reachable
+        posts = [(1, 0, 0), (2, 1, 0), (3, 0, 0), (4, 2, 0), (5, 1, 0), (6, 3, 0), (7, 8, 0), (8, 0, 1)]
+        self.assertEqual(self.push_order(posts), [1, 2, 4, 5, 3, 6])
+
+    def test_subtree(self):
+        self.assertEqual(self.push_order([(1, 0, 0), (2, 1, 0), (3, 2, 0), (4, 0, 0)], '1'), [2, 3])
+
+    def test_deep_thread(self):
+        posts = [(n, n - 1, 0) for n in range(1, 5001)]
+        self.assertEqual(self.push_order(posts), list(range(1, 5001)))
+
+
+class TestReport(unittest.TestCase):
+    # 2020-01-15 and 2021-06-15 UTC
+    dates = (1579046400, 1623715200)
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE fb_posts (id INTEGER PRIMARY KEY, text TEXT, posted INTEGER default 0)')
+        self.conn.execute('CREATE TABLE fb_media (id INTEGER PRIMARY KEY, post_id INTEGER, uri TEXT, '
+                          'posted INTEGER default 0)')
+        self.conn.execute('CREATE TABLE fb_parts (post_id INTEGER, part INTEGER, text TEXT, size_limit INTEGER, '
+                          'posted INTEGER default 0, PRIMARY KEY (post_id, part))')
+
+    def add_post(self, post_id, text, parts, size_limit=500):
+        self.conn.execute('INSERT INTO fb_posts (id, text) VALUES (?, ?)', (post_id, text))
+        self.conn.execute('INSERT INTO fb_media (post_id, uri) VALUES (?, ?)', (post_id, f'{post_id}.jpg'))
+        self.conn.executemany('INSERT INTO fb_parts (post_id, part, text, size_limit) VALUES (?, ?, ?, ?)',
+                              [(post_id, n, 'part', size_limit) for n in range(1, parts + 1)])
+
+    def test_counters(self):
+        # rows loaded before the counters existed are counted once, later changes by the triggers
+        self.add_post(self.dates[0], 'one', 1)
+        self.add_post(self.dates[0] + 60, 'two ' * 200, 2)
+        Report.prepare_db(self.conn)
+        self.add_post(self.dates[1], 'three', 1)
+        self.conn.execute('UPDATE fb_posts SET posted = 111 WHERE id = ?', (self.dates[0],))
+        self.conn.execute('UPDATE fb_parts SET posted = 111 WHERE post_id = ?', (self.dates[0],))
+        self.conn.execute('UPDATE fb_media SET posted = 112 WHERE post_id = ?', (self.dates[0],))
+        self.conn.execute('UPDATE fb_posts SET posted = 2 WHERE id = ?', (self.dates[0] + 60,))
+        self.conn.execute('UPDATE fb_parts SET posted = 113 WHERE post_id = ? AND part = 1', (self.dates[0] + 60,))
+        posts, media, periods = Report(self.conn, 500).facebook()
+        self.assertEqual(dict(posts), {'Imported': 3, 'Pushed': 2, 'Partially pushed': 1, 'Not pushed': 1,
+                                       'Long posts': 1, 'Split again on push': 0, 'Statuses': 4,
+                                       'Statuses to push': 2, 'API calls to push': 4})
+        self.assertEqual(dict(media), {'Imported': 3, 'Pushed': 1, 'Not pushed': 2})
+        self.assertEqual(periods, [['2020', 2, 2, 1, 1, 2, 1], ['2021', 1, 0, 0, 1, 1, 0]])
+        _, _, periods = Report(self.conn, 500, 'month').facebook()
+        self.assertEqual([period[0] for period in periods], ['2020-01', '2021-06'])
+
+    def test_size_limit(self):
+        # posts planned for another limit or without parts are split again for the current one
+        text = ' '.join(['word'] * 100)
+        self.add_post(self.dates[0], text, 1, 1000)
+        self.add_post(self.dates[1], text, 0)
+        posts, _, periods = Report(self.conn, 300).facebook()
+        self.assertEqual(dict(posts)['Split again on push'], 2)
+        self.assertEqual(dict(posts)['Statuses to push'], 4)
+        self.assertEqual([period[4] for period in periods], [2, 2])
+        self.conn.execute('DELETE FROM fb_parts')
+        self.assertEqual(dict(Report(self.conn, 1000).facebook()[0])['Statuses'], 2)
+
+    def test_threads(self):
+        # failed posts count as pushed and as failed, as in the Facebook report
+        self.conn.execute('CREATE TABLE mst_posts (id INTEGER PRIMARY KEY, original_date INTEGER, '
+                          'posted INTEGER default 0)')
+        self.conn.execute('CREATE TABLE mst_media (id INTEGER PRIMARY KEY, post_id INTEGER, posted INTEGER default 0)')
+        Report.prepare_db(self.conn)
+        self.conn.executemany('INSERT INTO mst_posts (id, original_date, posted) VALUES (?, ?, ?)',
+                              [(1, self.dates[0], 111), (2, self.dates[0], 2), (3, self.dates[1], 0)])
+        self.conn.executemany('INSERT INTO mst_media (post_id, posted) VALUES (?, ?)', [(1, 112), (3, 0)])
+        posts, media, periods = Report(self.conn, 500).mastodon()
+        self.assertEqual(dict(posts), {'Imported': 3, 'Pushed': 2, 'Failed': 1, 'Not pushed': 1})
+        self.assertEqual(dict(media), {'Imported': 2, 'Pushed': 1, 'Not pushed': 1})
+        self.assertEqual(periods, [['2020', 2, 2, 1, 1, 1], ['2021', 1, 0, 0, 1, 0]])
+
+
+class TestFbImporter(unittest.TestCase):
+    @staticmethod
+    def post(n):
+        # your_posts*.json item, every third one with a photo
+        post = {'timestamp': 1600000000 + n * 60, 'data': [{'post': f'post {n}'}]}
+        if n % 3 == 0:
+            post['attachments'] = [{'data': [{'media': {'uri': f'posts/media/{n}.jpg'}}]}]
+        return post
+
+    def test_shards(self):
+        # posts/your_posts_1.json and your_posts_2.json load as the same posts in one file, in worker processes
+        posts = [self.post(n) for n in range(120)]
+        rows = list()
+        with tempfile.TemporaryDirectory() as data_dir:
+            for shards in (1, 2):
+                posts_dir = f'{data_dir}/{shards}/posts'
+                os.makedirs(posts_dir)
+                for shard in range(shards):
+                    with open(f'{posts_dir}/your_posts_{shard + 1}.json', 'w') as file:
+                        json.dump(posts[shard * 120 // shards:(shard + 1) * 120 // shards], file)
+                with mock.patch.dict(os.environ, FB_POSTS_DIR=posts_dir, MST_POSTS_DIR=posts_dir, LOAD_WORKERS='2',
+                                     DB_FILE=f'{data_dir}/{shards}.db'):
+                    FbImporter(LoadEnv()).load_fb_posts(False)
+                    conn = sqlite3.connect(os.environ['DB_FILE'])
+                    rows.append((conn.execute('SELECT id, text FROM fb_posts ORDER BY id').fetchall(),
+                                 conn.execute('SELECT post_id, uri FROM fb_media ORDER BY id').fetchall()))
+                    conn.close()
+        self.assertEqual(len(rows[0][0]), 120)
+        self.assertEqual(len(rows[0][1]), 40)
+        self.assertEqual(rows[0], rows[1])
+
+
+class TestMstImporter(unittest.TestCase):
+    @staticmethod
+    def item(n, parent=None):
+        # outbox.json public status, a reply to status parent when given
+        actor = 'https://x.example/users/me'
+        published = f'2020-01-{n // 24 + 1:02}T{n % 24:02}:00:00Z'
+        return {'id': f'{actor}/statuses/{n}/activity', 'type': 'Create', 'published': published,
+                'to': ['https://www.w3.org/ns/activitystreams#Public'], 'cc': [f'{actor}/followers'],
+                'object': {'id': f'{actor}/statuses/{n}', 'inReplyTo': f'{actor}/statuses/{parent}' if parent else None,
+                           'sensitive': False, 'contentMap': {'en': f'<p>post {n}</p>'}, 'attachment': list()}}
+
+    def test_order(self):
+        # replies coming before their parents in the outbox are kept, with the same parents as in the archive order
+        rng = random.Random(1)
+        items = [self.item(n, rng.choice(range(1, n)) if n > 1 and rng.random() < 0.3 else None) for n in range(1, 200)]
+        shuffled = list(items)
+        rng.shuffle(shuffled)
+        rows = list()
+        with tempfile.TemporaryDirectory() as data_dir:
+            for n, ordered_items in enumerate((items, list(reversed(items)), shuffled)):
+                with open(f'{data_dir}/outbox.json', 'w') as file:
+                    json.dump({'orderedItems': ordered_items}, file)
+                with mock.patch.dict(os.environ, FB_POSTS_DIR=data_dir, MST_POSTS_DIR=data_dir, LOAD_WORKERS='1',
+                                     DB_FILE=f'{data_dir}/{n}.db'):
+                    MstImporter(LoadEnv()).load_mst_posts(False)
+                    conn = sqlite3.connect(os.environ['DB_FILE'])
+                    rows.append(dict(conn.execute('SELECT id, parent_id FROM mst_posts').fetchall()))
+                    conn.close()
+        posts = rows[0]
+        self.assertEqual(len(posts), 199)
+        self.assertGreater(sum(1 for parent_id in posts.values() if parent_id), 10)
+        self.assertTrue(all(parent_id in posts for parent_id in posts.values() if parent_id))
+        self.assertEqual(rows[1], posts)
+        self.assertEqual(rows[2], posts)
+
+
+class TestDryRun(unittest.TestCase):
+    def test_missing_media(self):
+        # the archive references media it doesn't contain, a dry-run push sends and reads nothing
+        items = [TestMstImporter.item(n) for n in range(1, 30)]
+        for item in items[::3]:
+            item['object']['attachment'] = [{'url': f'/media_attachments/{item["object"]["id"][-2:]}.jpg'}]
+        with tempfile.TemporaryDirectory() as data_dir:
+            with open(f'{data_dir}/your_posts_1.json', 'w') as file:
+                json.dump([TestFbImporter.post(n) for n in range(30)], file)
+            with open(f'{data_dir}/outbox.json', 'w') as file:
+                json.dump({'orderedItems': items}, file)
+            with mock.patch.dict(os.environ, FB_POSTS_DIR=data_dir, MST_POSTS_DIR=data_dir, LOAD_WORKERS='1',
+                                 DB_FILE=f'{data_dir}/mevac.db', MASTODON_DOMAIN='localhost',
+                                 MASTODON_CLIENT_ACCESS_TOKEN='token'), \
+                    mock.patch.object(Mastodon, '_request') as request:
+                FbImporter(LoadEnv()).load_fb_posts(False)
+                MstImporter(LoadEnv()).load_mst_posts(False)
+                conn = sqlite3.connect(os.environ['DB_FILE'])
+                media = conn.execute('SELECT (SELECT COUNT (*) FROM fb_media), (SELECT COUNT (*) FROM mst_media)')
+                self.assertEqual(media.fetchone(), (10, 10))
+                conn.close()
+                for engine in (Pusher, AsyncPusher):
+                    with self.subTest(engine=engine.__name__):
+                        engine(LoadEnv(), PushEnv()).push_fb_posts(True)
+                        engine(LoadEnv(), PushEnv()).push_mst_posts('0', '0', True)
+            request.assert_not_called()
+
+
+class TestMediaWorkers(unittest.TestCase):
+    def test_attachments(self):
+        # uploads of the post and the upcoming ones finish in any order, statuses get their media in the post order
+        rng = random.Random(1)
+        posts = [{'timestamp': 1600000000 + n * 60, 'data': [{'post': f'post {n}'}],
+                  'attachments': [{'data': [{'media': {'uri': f'posts/media/{n}_{k}.jpg'}} for k in range(n % 4)]}]}
+                 for n in range(40)]
+        statuses = dict()
+
+        def upload_media(media_file, dry_run, idempotency_key=None):
+            time.sleep(rng.random() / 50)
+            return os.path.basename(media_file)
+
+        def post_fb_status(texts, media_ids=None, visibility='private', dry_run=True, in_reply_to_id='0',
+                           idempotency_keys=None):
+            statuses[texts[0].split('\r')[1]] = media_ids
+            return ['1'] * len(texts)
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            with open(f'{data_dir}/your_posts_1.json', 'w') as file:
+                json.dump(posts, file)
+            os.makedirs(f'{data_dir}/media')
+            for n in range(40):
+                for k in range(n % 4):
+                    with open(f'{data_dir}/media/{n}_{k}.jpg', 'w') as file:
+                        file.write(f'{n}_{k}')
+            with mock.patch.dict(os.environ, FB_POSTS_DIR=data_dir, MST_POSTS_DIR=data_dir, LOAD_WORKERS='1',
+                                 DB_FILE=f'{data_dir}/mevac.db', MASTODON_DOMAIN='localhost',
+                                 MASTODON_CLIENT_ACCESS_TOKEN='token', MASTODON_MEDIA_WORKERS='4',
+                                 MASTODON_MEDIA_LOOKAHEAD='3'), \
+                    mock.patch.object(Mastodon, 'upload_media', side_effect=upload_media), \
+                    mock.patch.object(Mastodon, 'post_fb_status', side_effect=post_fb_status):
+                FbImporter(LoadEnv()).load_fb_posts(False)
+                Pusher(LoadEnv(), PushEnv()).push_fb_posts(False)
+        self.assertEqual(len(statuses), 40)
+        for n in range(40):
+            self.assertEqual(statuses[f'post {n}'], [f'{n}_{k}.jpg' for k in range(n % 4)])
+
+
+class TestPushEngines(unittest.TestCase):
+    # a push interrupted with one engine is resumed with the other one
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        rng = random.Random(1)
+        items = [TestMstImporter.item(n, rng.choice(range(1, n)) if n > 1 and rng.random() < 0.4 else None)
+                 for n in range(1, 60)]
+        with open(f'{self.dir.name}/outbox.json', 'w') as file:
+            json.dump({'orderedItems': items}, file)
+        self.env = mock.patch.dict(os.environ, FB_POSTS_DIR=self.dir.name, MST_POSTS_DIR=self.dir.name,
+                                   DB_FILE=f'{self.dir.name}/mevac.db', LOAD_WORKERS='1', MASTODON_DOMAIN='localhost',
+                                   MASTODON_CLIENT_ACCESS_TOKEN='token')
+        self.env.start()
+        self.addCleanup(self.env.stop)
+        MstImporter(LoadEnv()).load_mst_posts(False)
+        self.statuses = dict()
+        self.status_ids = itertools.count(100)
+        # status ids by idempotency key, a resent request gets the status created by the first one, as on the server
+        self.keys = dict()
+
+    def push(self, engine, after=None):
+        # the push stops before status number `after`, as on a crash
+        calls = itertools.count()
+
+        def post_mst_status(text, lang, media_ids, visibility, sensitivity, in_reply_to_id, dry_run,
+                            idempotency_key=None):
+            if next(calls) == after:
+                raise Exception('Interrupted')
+            if idempotency_key in self.keys:
+                return self.keys[idempotency_key]
+            status_id = str(next(self.status_ids))
+            self.statuses[status_id] = (text, in_reply_to_id)
+            if idempotency_key:
+                self.keys[idempotency_key] = status_id
+            return status_id
+
+        with mock.patch.object(Mastodon, 'post_mst_status', side_effect=post_mst_status):
+            engine(LoadEnv(), PushEnv()).push_mst_posts('0', '0', False)
+
+    def resume(self, first, second):
+        with self.assertRaises(Exception):
+            self.push(first, 20)
+        self.assertEqual(len(self.statuses), 20)
+        self.push(second)
+        conn = sqlite3.connect(os.environ['DB_FILE'])
+        posts = {post_id: (parent_id, str(posted)) for post_id, parent_id, posted in
+                 conn.execute('SELECT id, parent_id, posted FROM mst_posts')}
+        conn.close()
+        self.assertEqual(len(posts), 59)
+        # every post once and the date tags reply of every thread start
+        tags = [in_reply_to_id for text, in_reply_to_id in self.statuses.values() if 'Posted #day' in text]
+        self.assertEqual(sorted(posted for _, posted in posts.values()),
+                         sorted(status_id for status_id, (text, _) in self.statuses.items() if '#day' not in text))
+        starts = set(posted for parent_id, posted in posts.values() if not parent_id)
+        self.assertEqual(len(tags), len(set(tags)))
+        self.assertEqual(set(tags), starts)
+        replies = [(parent_id, posted) for parent_id, posted in posts.values() if parent_id]
+        self.assertGreater(len(replies), 5)
+        for parent_id, status_id in replies:
+            parent_status_id = posts[parent_id][1]
+            self.assertEqual(self.statuses[status_id][1], parent_status_id)
+            # the parent is posted first
+            self.assertLess(int(parent_status_id), int(status_id))
+
+    def test_sync_to_async(self):
+        self.resume(Pusher, AsyncPusher)
+
+    def test_async_to_sync(self):
+        self.resume(AsyncPusher, Pusher)
+
+
+class TestArchive(unittest.TestCase):
+    # Facebook export layout, media uris are relative to the posts directory
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.zip = f'{self.dir.name}/facebook.zip'
+        with zipfile.ZipFile(self.zip, 'w', zipfile.ZIP_DEFLATED) as archive:
+            # listed first, it is not in a posts directory
+            archive.writestr('a/your_posts_2.json', '[]')
+            archive.writestr('your_facebook_activity/posts/your_posts_1.json', json.dumps(list(synth.fb_posts(50))))
+            archive.writestr('your_facebook_activity/posts/media/Album1/1_0.jpg', b'\xff\xd8' + b'x' * 1000)
+            archive.writestr('your_facebook_activity/other/your_posts_x.txt', 'not a posts file')
+
+    def test_members(self):
+        root = archive_root(self.zip, FB_POST_FILES, 'posts')
+        self.assertEqual(root, f'{self.zip}/your_facebook_activity/posts')
+        self.assertEqual(list_dir(root), ['your_posts_1.json'])
+        self.assertEqual(archive_root(self.dir.name, FB_POST_FILES, 'posts'), self.dir.name)
+        with self.assertRaises(Exception):
+            archive_root(self.zip, MST_POST_FILES)
+        self.assertTrue(file_exists(f'{root}/media/Album1/1_0.jpg'))
+        self.assertFalse(file_exists(f'{root}/media/Album1/2_0.jpg'))
+        self.assertEqual(file_size(f'{root}/media//Album1/1_0.jpg'), 1002)
+        with open_file(f'{root}/your_posts_1.json') as file:
+            self.assertEqual(len(list(JsonStream(file).items())), 50)
+        with MultipartFile(f'{root}/media/Album1/1_0.jpg') as body:
+            self.assertEqual(len(body.read()), len(body))
+            body.seek(0)
+            self.assertIn(b'\xff\xd8' + b'x' * 1000, body.read())
+
+    def test_load(self):
+        # the same posts as from the extracted directory
+        counts = list()
+        for location in (self.zip, f'{self.dir.name}/posts'):
+            if location != self.zip:
+                with zipfile.ZipFile(self.zip) as archive:
+                    archive.extractall(location)
+                location = f'{location}/your_facebook_activity/posts'
+            with mock.patch.dict(os.environ, FB_POSTS_DIR=location, MST_POSTS_DIR=location, LOAD_WORKERS='1',
+                                 DB_FILE=f'{self.dir.name}/{len(counts)}.db'):
+                FbImporter(LoadEnv()).load_fb_posts(False)
+                conn = sqlite3.connect(os.environ['DB_FILE'])
+                counts.append(conn.execute('SELECT COUNT (*), SUM(LENGTH(text)) FROM fb_posts').fetchone())
+                conn.close()
+        self.assertEqual(counts[0], counts[1])
+
+
+class TestTwImporter(unittest.TestCase):
+    tweet = {'id_str': '20', 'created_at': 'Wed Oct 10 20:19:24 +0000 2018', 'lang': 'en', 'possibly_sensitive': True,
+             'in_reply_to_status_id_str': '10', 'in_reply_to_user_id_str': '1',
+             'full_text': '@me @me Tom &amp; Jerry https://t.co/a https://t.co/m',
+             'entities': {'urls': [{'url': 'https://t.co/a', 'expanded_url': 'https://example.com/a'}]},
+             'extended_entities': {'media': [
+                 {'url': 'https://t.co/m', 'type': 'photo', 'media_url_https': 'https://pbs.twimg.com/media/p.jpg'},
+                 {'url': 'https://t.co/m', 'type': 'video', 'media_url_https': 'https://pbs.twimg.com/t.jpg',
+                  'video_info': {'variants': [
+                      {'content_type': 'application/x-mpegURL', 'url': 'https://v/a.m3u8'},
+                      {'content_type': 'video/mp4', 'bitrate': '256000', 'url': 'https://v/l.mp4'},
+                      {'content_type': 'video/mp4', 'bitrate': '2176000', 'url': 'https://v/h.mp4?tag=1'}]}}]}}
+
+    def test_parse(self):
+        self.assertEqual(_parse_tw_post({'tweet': self.tweet}, '1', 'tweets_media'),
+                         (20, 10, 1539202764, 'en', 'Tom & Jerry https://example.com/a', 1,
+                          ['tweets_media/20-p.jpg', 'tweets_media/20-h.mp4'], '20'))
+        # replies to other accounts and retweets are not imported
+        self.assertIsNone(_parse_tw_post(self.tweet, '2', 'tweets_media'))
+        self.assertIsNone(_parse_tw_post(dict(self.tweet, full_text='RT @friend: text'), '1', 'tweets_media'))
+
+    def test_load(self):
+        # the newest tweets come first, a reply and its parent can be in different parts
+        tweets = list(synth.tw_items(100))
+        with tempfile.TemporaryDirectory() as data_dir:
+            for file_name, part, items in (('tweets.js', 0, tweets[:50]), ('tweets-part1.js', 1, tweets[50:])):
+                with open(f'{data_dir}/{file_name}', 'w') as file:
+                    file.write(f'window.YTD.tweets.part{part} = {json.dumps(items)}')
+            with open(f'{data_dir}/account.js', 'w') as file:
+                file.write(f'window.YTD.account.part0 = [{{"account": {{"accountId": "{synth.ACCOUNT_ID}"}}}}]')
+            with mock.patch.dict(os.environ, FB_POSTS_DIR=data_dir, MST_POSTS_DIR=data_dir, TW_POSTS_DIR=data_dir,
+                                 DB_FILE=f'{data_dir}/mevac.db', LOAD_WORKERS='1'):
+                importer = TwImporter(LoadEnv())
+                importer.load_tw_posts(False)
+                conn = sqlite3.connect(os.environ['DB_FILE'])
+                posts = dict(conn.execute('SELECT id, parent_id FROM tw_posts').fetchall())
+                self.assertGreater(len(posts), 70)
+                self.assertTrue(all(parent_id in posts for parent_id in posts.values() if parent_id))
+                self.assertTrue(any(parent_id for parent_id in posts.values()))
+                media = conn.execute('SELECT uri FROM tw_media').fetchall()
+                self.assertTrue(all(uri.startswith('tweets_media/') for uri, in media))
+                importer.collect_stat()
+                self.assertEqual(dict(importer._env.stat_tw_posts)['Imported'], len(posts))
+                self.assertEqual(dict(importer._env.stat_tw_media)['Imported'], len(media))
+                conn.close()
+
+    def test_zip_root(self):
+        # the archive viewer scripts are not tweets files
+        with tempfile.TemporaryDirectory() as data_dir:
+            with zipfile.ZipFile(f'{data_dir}/twitter.zip', 'w') as archive:
+                archive.writestr('assets/js/tweet-viewer.js', '')
+                archive.writestr('data/tweetdeck.js', '')
+                archive.writestr('data/tweets-part1.js', 'window.YTD.tweets.part1 = []')
+            self.assertEqual(archive_root(f'{data_dir}/twitter.zip', TW_POST_FILES), f'{data_dir}/twitter.zip/data')
+
+
+class TestIncrementalLoad(unittest.TestCase):
+    # a newer archive holds the posts of the older one and 50 new posts
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.env = mock.patch.dict(os.environ, FB_POSTS_DIR=self.dir.name, MST_POSTS_DIR=self.dir.name,
+                                   DB_FILE=f'{self.dir.name}/mevac.db', LOAD_WORKERS='1')
+        self.env.start()
+        self.addCleanup(self.env.stop)
+
+    def write(self, file_name, content):
+        with open(f'{self.dir.name}/{file_name}', 'w') as file:
+            json.dump(content, file)
+
+    def count(self, table):
+        conn = sqlite3.connect(os.environ['DB_FILE'])
+        count = conn.execute(f'SELECT COUNT (*) FROM {table}').fetchone()[0]
+        conn.close()
+        return count
+
+    def load(self, importer, method):
+        importer = importer(LoadEnv())
+        getattr(importer, method)(False)
+        return importer._metrics.snapshot()['posts']
+
+    def test_facebook(self):
+        posts = list(synth.fb_posts(200))
+        self.write('your_posts_1.json', posts[:150])
+        self.assertEqual(self.load(FbImporter, 'load_fb_posts'), 150)
+        loaded = self.count('fb_posts')
+        # the file is not read again
+        self.assertEqual(self.load(FbImporter, 'load_fb_posts'), 0)
+        # the same archive downloaded again: the posts loaded before are dropped, but the ones of the last date
+        self.write('your_posts_1.json', posts[:150])
+        self.assertEqual(self.load(FbImporter, 'load_fb_posts'), 1)
+        self.write('your_posts_1.json', posts)
+        self.assertEqual(self.load(FbImporter, 'load_fb_posts'), 51)
+        new = self.count('fb_posts') - loaded
+        os.remove(os.environ['DB_FILE'])
+        self.load(FbImporter, 'load_fb_posts')
+        self.assertEqual(self.count('fb_posts'), loaded + new)
+        with mock.patch.dict(os.environ, LOAD_INCREMENTAL='False'):
+            self.assertEqual(self.load(FbImporter, 'load_fb_posts'), 200)
+
+    def test_hashing(self):
+        # a file is hashed by itself only to confirm the size and mtime of the one loaded before
+        self.write('your_posts_1.json', list(synth.fb_posts(50)))
+        with mock.patch('mevaclibs.watermark.Utils.file_digest', wraps=Utils.file_digest) as file_digest:
+            self.load(FbImporter, 'load_fb_posts')
+            self.assertEqual(file_digest.call_count, 0)
+            self.assertEqual(self.load(FbImporter, 'load_fb_posts'), 0)
+            self.assertEqual(file_digest.call_count, 1)
+            with mock.patch.dict(os.environ, LOAD_INCREMENTAL='False'):
+                self.assertEqual(self.load(FbImporter, 'load_fb_posts'), 50)
+            self.write('your_posts_1.json', list(synth.fb_posts(60)))
+            self.load(FbImporter, 'load_fb_posts')
+            self.assertEqual(file_digest.call_count, 1)
+
+    def test_mastodon(self):
+        # replies to posts loaded by the previous run are attached to them
+        items = list(synth.mst_items(200))
+        self.write('outbox.json', {'orderedItems': items[:150]})
+        self.load(MstImporter, 'load_mst_posts')
+        self.write('outbox.json', {'orderedItems': items})
+        self.assertLess(self.load(MstImporter, 'load_mst_posts'), 60)
+        posts, media = self.count('mst_posts'), self.count('mst_media')
+        os.remove(os.environ['DB_FILE'])
+        self.load(MstImporter, 'load_mst_posts')
+        self.assertEqual((self.count('mst_posts'), self.count('mst_media')), (posts, media))
+
+
+class TestSplitStatus(unittest.TestCase):
+    def test_status_length(self):
+        self.assertEqual(status_length('see https://example.com/' + 'a' * 100 + '.'), 4 + 23 + 1)
+        self.assertEqual(status_length('hi @alice@mastodon.social'), len('hi @alice'))
+
+    def test_short(self):
+        self.assertEqual(split_status('short text', 500, 20), ['short text'])
+
+    def test_parts(self):
+        text = ' '.join(f'word{n}' for n in range(300))
+        parts = split_status(text, 100, 20)
+        self.assertTrue(parts[0].startswith('1. word0 '))
+        self.assertTrue(parts[1].startswith('2. -> '))
+        self.assertLessEqual(len(parts[0]), 80)
+        self.assertTrue(all(len(part) <= 100 for part in parts))
+        words = ' '.join(part.split(' ', 2 if n else 1)[-1] for n, part in enumerate(parts))
+        self.assertEqual(words, text)
+
+    def test_links(self):
+        # links count as 23 characters, a long link doesn't force a split
+        text = ' '.join(['https://example.com/' + 'a' * 200] * 4)
+        self.assertEqual(split_status(text, 100), [text])
+
+    def test_long_word(self):
+        parts = split_status('x' * 250, 100)
+        self.assertEqual(''.join(part.split(' ')[-1] for part in parts), 'x' * 250)
+        self.assertTrue(all(len(part) <= 100 for part in parts))
+
+
+class TestOldDatabase(unittest.TestCase):
+    def test_fb_parts(self):
+        # a database loaded by 0.0.6 has no fb_parts, its posts are split on push
+        statuses = itertools.count(100)
+        with tempfile.TemporaryDirectory() as data_dir:
+            conn = sqlite3.connect(f'{data_dir}/mevac.db')
+            conn.execute('CREATE TABLE fb_posts (id INTEGER PRIMARY KEY, text TEXT, posted INTEGER default 0)')
+            conn.execute('CREATE TABLE fb_media (id INTEGER PRIMARY KEY, post_id INTEGER, uri TEXT, '
+                         'posted INTEGER default 0)')
+            conn.executemany('INSERT INTO fb_posts (id, text) VALUES (?, ?)',
+                             [(1600000000, 'short'), (1600000100, ' '.join(f'word{n}' for n in range(300)))])
+            conn.commit()
+            with mock.patch.dict(os.environ, FB_POSTS_DIR=data_dir, MST_POSTS_DIR=data_dir,
+                                 DB_FILE=f'{data_dir}/mevac.db', MASTODON_DOMAIN='localhost',
+                                 MASTODON_CLIENT_ACCESS_TOKEN='token'), \
+                    mock.patch.object(Mastodon, 'post_fb_status',
+                                      side_effect=lambda texts, *args: [str(next(statuses)) for _ in texts]):
+                result = Pusher(LoadEnv(), PushEnv()).push_fb_posts(False)
+            parts = conn.execute('SELECT post_id, posted FROM fb_parts ORDER BY post_id, part').fetchall()
+            posted = conn.execute('SELECT posted FROM fb_posts ORDER BY id').fetchall()
+            conn.close()
+        self.assertGreater(len(result), 2)
+        self.assertEqual([str(post_id) for _, post_id in parts], result)
+        self.assertEqual(posted, [(100,), (101,)])
+
+
+class TestHtmlToText(unittest.TestCase):
+    # golden outputs of BeautifulSoup(html, 'html.parser').get_text(separator='\n') for Mastodon status HTML
+    corpus = os.path.join(os.path.dirname(__file__), 'testdata', 'mst_html.json')
+
+    def test_corpus(self):
+        with open(self.corpus) as file:
+            for case in json.load(file):
+                with self.subTest(html=case['html']):
+                    self.assertEqual(html_to_text(case['html']), case['text'])
+
+
+if __name__ == '__main__':
+    unittest.main()
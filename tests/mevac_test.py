@@ -56,8 +56,8 @@ class TestFbImporter(unittest.TestCase):
 
     def run_importer(self):
         importer = FbImporter(self.load_env)
-        self.assertIsInstance(importer._facebook_post_file, str)
-        self.assertNotEqual(importer._facebook_post_file, '')
+        self.assertIsInstance(importer._facebook_post_files, list)
+        self.assertNotEqual(importer._facebook_post_files, [])
         importer.load_fb_posts(dry_run=False)
         self.assertIsNotNone(self.load_env.stat_fb_posts)
         importer.collect_stat()
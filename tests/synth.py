@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# Synthetic Facebook, Mastodon and Twitter archives for the benchmarks, not collected by pytest.
+#   python tests/synth.py facebook 100k /tmp/fb
+#   python tests/synth.py mastodon 1m /tmp/mst --media-files
+#   python tests/synth.py twitter 100k /tmp/tw/data
+# The archives are written item by item, a 1M posts archive needs no more memory than a 10k one. The same seed and
+# size give the same archive.
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timezone
+
+START = 1262304000
+# the posts are spread over 15 years whatever the size
+SPAN = 15 * 365 * 86400
+DOMAIN = 'https://mastodon.example'
+ACTOR = f'{DOMAIN}/users/me'
+ACCOUNT_ID = '1000001'
+WORDS = ('the', 'a', 'of', 'and', 'to', 'in', 'is', 'it', 'that', 'was', 'for', 'on', 'with', 'as', 'at', 'by',
+         'migration', 'archive', 'photo', 'weekend', 'friends', 'coffee', 'mountains', 'city', 'music', 'today',
+         'привет', 'друзья', 'фото', 'сегодня', 'Zürich', 'café', '🙂', '🎉')
+# minimal JPEG: SOI, a comment made unique per file, EOI, enough for uploads, not for the optimizer
+_JPEG_START = b'\xff\xd8\xff\xfe'
+_JPEG_END = b'\xff\xd9'
+
+
+def parse_size(value):
+    # 10k, 100k, 1m or a plain number
+    value = value.lower()
+    scale = {'k': 1000, 'm': 1000000}.get(value[-1:], 1)
+    return int(value.rstrip('km')) * scale
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def _text_words(rng):
+    # most posts are short, a tail is over the 500 characters status limit
+    roll = rng.random()
+    if roll < 0.7:
+        return rng.randint(3, 40)
+    if roll < 0.95:
+        return rng.randint(40, 120)
+    return rng.randint(120, 600)
+
+
+def _write_media(out_dir, uri):
+    # the file content depends on the uri only, the archive is the same with and without the media files
+    rng = random.Random(uri)
+    file_name = f'{out_dir}/{uri}'
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    comment = uri.encode() + rng.randbytes(rng.randint(64, 2048))
+    with open(file_name, 'wb') as file:
+        file.write(_JPEG_START + (len(comment) + 2).to_bytes(2, 'big') + comment + _JPEG_END)
+
+
+def _json_array(file, items):
+    # writes a JSON array item by item
+    file.write('[\n')
+    for n, item in enumerate(items):
+        if n:
+            file.write(',\n')
+        file.write(json.dumps(item, ensure_ascii=False, indent=2))
+    file.write('\n]\n')
+
+
+def fb_posts(posts, seed=1, out_dir='', media_files=False):
+    # your_posts items: text in the export mojibake (UTF-8 bytes as latin1), links, 1-6 photos and videos (the
+    # importer keeps 4), a few items without text and media which are not imported
+    rng = random.Random(seed)
+    step = max(SPAN // max(posts, 1), 1)
+    for n in range(posts):
+        timestamp = START + n * step + rng.randint(0, step - 1)
+        post = {'timestamp': timestamp}
+        roll = rng.random()
+        if roll < 0.03:
+            post['data'] = [{'update_timestamp': timestamp}]
+            yield post
+            continue
+        text = ''
+        if roll > 0.15:
+            text = _text(rng, _text_words(rng))
+            if rng.random() < 0.2:
+                text += f' https://link.example/{n}/{"x" * rng.randint(5, 60)}'
+            post['data'] = [{'post': text.encode('utf8').decode('latin1')}, {'update_timestamp': timestamp}]
+        attachments = list()
+        if not text or rng.random() < 0.35:
+            for k in range(rng.choice((1, 1, 1, 2, 3, 4, 6))):
+                # the importer keeps the uri part after posts/, relative to the archive directory
+                uri = f'media/Album{n % 50}/{n}_{k}.{"mp4" if rng.random() < 0.1 else "jpg"}'
+                attachments.append({'media': {'uri': f'your_facebook_activity/posts/{uri}',
+                                              'creation_timestamp': timestamp, 'title': ''}})
+                if media_files:
+                    _write_media(out_dir, uri)
+        if rng.random() < 0.05:
+            attachments.append({'external_context': {'url': f'https://shared.example/{n}'}})
+        if attachments:
+            post['attachments'] = [{'data': attachments}]
+        yield post
+
+
+def fb_archive(out_dir, posts, shards=0, seed=1, media_files=False):
+    # your_posts_1.json ... your_posts_N.json, big exports are split into files of up to 10k items
+    os.makedirs(out_dir, exist_ok=True)
+    shards = shards or max((posts + 9999) // 10000, 1)
+    items = fb_posts(posts, seed, out_dir, media_files)
+    for shard in range(shards):
+        count = posts // shards + (1 if shard < posts % shards else 0)
+        with open(f'{out_dir}/your_posts_{shard + 1}.json', 'w') as file:
+            _json_array(file, (next(items) for _ in range(count)))
+
+
+def _status_id(timestamp, n):
+    # snowflake ids as Mastodon makes them: milliseconds << 16 + sequence
+    return (timestamp * 1000 << 16) + n % 65536
+
+
+def _mst_content(rng, words):
+    # status HTML as Mastodon renders it: paragraphs, line breaks, hashtags, mentions and links
+    paragraphs = list()
+    for _ in range(rng.choice((1, 1, 1, 2, 3))):
+        parts = list()
+        for word in _text(rng, max(words // 2, 1)).split(' '):
+            roll = rng.random()
+            if roll < 0.03:
+                parts.append(f'<a href="{DOMAIN}/tags/{word}" class="mention hashtag" rel="tag">#<span>{word}</span>'
+                             f'</a>')
+            elif roll < 0.04:
+                parts.append(f'<span class="h-card"><a href="https://other.example/@friend" class="u-url mention">'
+                             f'@<span>friend</span></a></span>')
+            elif roll < 0.05:
+                parts.append(f'<a href="https://link.example/{word}" target="_blank" rel="nofollow noopener">'
+                             f'<span class="invisible">https://</span><span class="">link.example/{word}</span>'
+                             f'<span class="invisible"></span></a>')
+            elif roll < 0.07:
+                parts.append(f'{word}<br />')
+            else:
+                parts.append(word.replace('&', '&amp;'))
+        paragraphs.append(f'<p>{" ".join(parts)}</p>')
+    return ''.join(paragraphs)
+
+
+def mst_items(posts, seed=1, out_dir='', media_files=False):
+    # outbox items: public, private and direct statuses, boosts, self-reply threads, replies to remote accounts
+    rng = random.Random(seed)
+    step = max(SPAN // max(posts, 1), 1)
+    recent = list()
+    held = None
+    for n in range(posts):
+        timestamp = START + n * step + rng.randint(0, step - 1)
+        status_id = _status_id(timestamp, n)
+        published = datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        if rng.random() < 0.05:
+            item = {'id': f'{ACTOR}/statuses/{status_id}/activity', 'type': 'Announce', 'actor': ACTOR,
+                    'published': published, 'to': ['https://www.w3.org/ns/activitystreams#Public'],
+                    'cc': [f'{ACTOR}/followers'], 'object': f'https://other.example/users/x/statuses/{n}'}
+            yield item
+            continue
+        roll = rng.random()
+        to = ['https://www.w3.org/ns/activitystreams#Public'] if roll < 0.8 else \
+            [f'{ACTOR}/followers'] if roll < 0.95 else list()
+        cc = [f'{ACTOR}/followers']
+        in_reply_to = None
+        roll = rng.random()
+        if roll < 0.3 and recent:
+            # self-reply, mostly to one of the latest posts, threads grow deep
+            parent = recent[-1] if rng.random() < 0.7 else rng.choice(recent)
+            in_reply_to = f'{ACTOR}/statuses/{parent}'
+        elif roll < 0.35:
+            in_reply_to = f'https://other.example/users/friend/statuses/{n}'
+            cc.append('https://other.example/users/friend')
+        attachments = [{'type': 'Document', 'mediaType': 'image/jpeg',
+                        'url': f'/media_attachments/files/{status_id}/{k}.jpg', 'name': None}
+                       for k in range(rng.choice((0, 0, 0, 1, 1, 2, 4)))]
+        if media_files:
+            for attachment in attachments:
+                _write_media(out_dir, attachment['url'].lstrip('/'))
+        language = rng.choice(('en', 'en', 'en', 'de', 'ru'))
+        item = {'id': f'{ACTOR}/statuses/{status_id}/activity', 'type': 'Create', 'actor': ACTOR,
+                'published': published, 'to': to, 'cc': cc,
+                'object': {'id': f'{ACTOR}/statuses/{status_id}', 'type': 'Note', 'summary': None,
+                           'inReplyTo': in_reply_to, 'published': published, 'url': f'{DOMAIN}/@me/{status_id}',
+                           'attributedTo': ACTOR, 'to': to, 'cc': cc, 'sensitive': rng.random() < 0.02,
+                           'content': '', 'contentMap': {language: _mst_content(rng, _text_words(rng))},
+                           'attachment': attachments, 'tag': list()}}
+        item['object']['content'] = item['object']['contentMap'][language]
+        recent.append(status_id)
+        del recent[:-50]
+        # a few posts come after the next one, which can be a reply to them
+        if held is None and rng.random() < 0.02:
+            held = item
+            continue
+        yield item
+        if held is not None:
+            yield held
+            held = None
+    if held is not None:
+        yield held
+
+
+def mst_archive(out_dir, posts, seed=1, media_files=False):
+    # outbox.json as in the Mastodon export
+    os.makedirs(out_dir, exist_ok=True)
+    with open(f'{out_dir}/outbox.json', 'w') as file:
+        file.write(f'{{"@context": "https://www.w3.org/ns/activitystreams", "id": "outbox.json", '
+                   f'"type": "OrderedCollection", "totalItems": {posts}, "orderedItems": ')
+        _json_array(file, mst_items(posts, seed, out_dir, media_files))
+        file.write('}\n')
+
+
+def _tweet_time(n, step):
+    # no random part: a reply, written before its parent, knows the parent id
+    return START + n * step + n * 7919 % step
+
+
+def tw_items(posts, seed=1, out_dir='', media_files=False):
+    # tweets.js items, newest first as in the export: self-reply threads, replies to other accounts, retweets, t.co
+    # links, photos and videos
+    rng = random.Random(seed)
+    step = max(SPAN // max(posts, 1), 1)
+    for n in reversed(range(posts)):
+        timestamp = _tweet_time(n, step)
+        tweet_id = _status_id(timestamp, n)
+        tweet = {'id_str': str(tweet_id), 'id': str(tweet_id), 'retweeted': False, 'favorite_count': '0',
+                 'created_at': datetime.fromtimestamp(timestamp, timezone.utc).strftime('%a %b %d %H:%M:%S +0000 %Y'),
+                 'lang': rng.choice(('en', 'en', 'en', 'de', 'ru', 'und')),
+                 'entities': {'hashtags': list(), 'symbols': list(), 'user_mentions': list(), 'urls': list()}}
+        if rng.random() < 0.05:
+            tweet['full_text'] = f'RT @friend: {_text(rng, rng.randint(3, 30))}'
+            yield {'tweet': tweet}
+            continue
+        text = _text(rng, rng.randint(3, 40))
+        roll = rng.random()
+        if roll < 0.25 and n:
+            # self-reply, mostly to the previous tweet, threads grow deep
+            parent = n - 1 if rng.random() < 0.7 else rng.randint(max(n - 50, 0), n - 1)
+            tweet.update(in_reply_to_status_id_str=str(_status_id(_tweet_time(parent, step), parent)),
+                         in_reply_to_user_id_str=ACCOUNT_ID, in_reply_to_screen_name='me')
+        elif roll < 0.35:
+            tweet.update(in_reply_to_status_id_str=str(n * 3 + 1), in_reply_to_user_id_str='42',
+                         in_reply_to_screen_name='friend')
+            text = f'@friend {text}'
+        if rng.random() < 0.15:
+            tweet['entities']['urls'].append({'url': f'https://t.co/l{n}', 'expanded_url': f'https://link.example/{n}',
+                                              'display_url': f'link.example/{n}'})
+            text += f' https://t.co/l{n}'
+        if rng.random() < 0.25:
+            media = list()
+            for k in range(rng.choice((1, 1, 1, 2, 4))):
+                name = f'{tweet_id}{k}.jpg'
+                item = {'url': f'https://t.co/m{n}', 'id_str': f'{tweet_id}{k}', 'type': 'photo',
+                        'media_url_https': f'https://pbs.twimg.example/media/{name}'}
+                if rng.random() < 0.1:
+                    name = f'{tweet_id}{k}.mp4'
+                    item.update(type='video', video_info={'variants': [
+                        {'content_type': 'application/x-mpegURL', 'url': f'https://video.twimg.example/{k}.m3u8'},
+                        {'bitrate': '832000', 'content_type': 'video/mp4',
+                         'url': f'https://video.twimg.example/vid/{name}?tag=12'}]})
+                media.append(item)
+                if media_files:
+                    _write_media(out_dir, f'tweets_media/{tweet_id}-{name}')
+            tweet['entities']['media'] = media[:1]
+            tweet['extended_entities'] = {'media': media}
+            text += f' https://t.co/m{n}'
+        tweet['full_text'] = text
+        tweet['display_text_range'] = ['0', str(len(text))]
+        yield {'tweet': tweet}
+
+
+def tw_archive(out_dir, posts, seed=1, media_files=False):
+    # the data directory of the export: account.js, tweets.js and tweets-part1.js ... for big archives
+    os.makedirs(out_dir, exist_ok=True)
+    with open(f'{out_dir}/account.js', 'w') as file:
+        file.write(f'window.YTD.account.part0 = '
+                   f'{json.dumps([{"account": {"accountId": ACCOUNT_ID, "username": "me"}}], indent=2)}\n')
+    shards = max((posts + 9999) // 10000, 1)
+    items = tw_items(posts, seed, out_dir, media_files)
+    for shard in range(shards):
+        count = posts // shards + (1 if shard < posts % shards else 0)
+        with open(f'{out_dir}/tweets{f"-part{shard}" if shard else ""}.js', 'w') as file:
+            file.write(f'window.YTD.tweets.part{shard} = ')
+            _json_array(file, (next(items) for _ in range(count)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic archive.')
+    parser.add_argument('type', choices=['facebook', 'mastodon', 'twitter'], help='Archive type')
+    parser.add_argument('size', type=parse_size, help='Posts count: 10k, 100k, 1m or a number')
+    parser.add_argument('out_dir', help='Archive directory')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--media-files', action='store_true', help='Write the media files too')
+    args = parser.parse_args()
+    if args.type == 'facebook':
+        fb_archive(args.out_dir, args.size, seed=args.seed, media_files=args.media_files)
+    elif args.type == 'twitter':
+        tw_archive(args.out_dir, args.size, seed=args.seed, media_files=args.media_files)
+    else:
+        mst_archive(args.out_dir, args.size, seed=args.seed, media_files=args.media_files)
+
+
+if __name__ == '__main__':
+    main()